@@ -0,0 +1,365 @@
+import math
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+import faiss
+import numpy as np
+
+
+INDEX_TYPES = ["flat", "ivf-flat", "ivf-pq", "hnsw"]
+
+# Chunk counts at which "auto" moves to the next index type.
+AUTO_HNSW_MIN_CHUNKS = 20_000
+AUTO_IVF_FLAT_MIN_CHUNKS = 250_000
+AUTO_IVF_PQ_MIN_CHUNKS = 2_000_000
+
+TRAINING_POINTS_PER_CENTROID = 64
+MAX_TRAINING_POINTS = 262_144
+
+# How the in-memory index stores each vector component. float16 and int8 use FAISS scalar
+# quantizers; int8 is trained on the vectors' per-dimension range.
+VECTOR_DTYPES = ["float32", "float16", "int8"]
+_SQ_STORAGE = {"float16": "SQfp16", "int8": "SQ8"}
+_BYTES_PER_VALUE = {"float32": 4, "float16": 2, "int8": 1}
+DEFAULT_RESCORE = 4
+
+COMPRESSION_SWEEP = [
+    {"dtype": "float16"},
+    {"dtype": "int8"},
+    {"dtype": "float32", "dimension": 1024},
+    {"dtype": "float16", "dimension": 1024},
+    {"dtype": "int8", "dimension": 1024},
+    {"dtype": "int8", "dimension": 512},
+    {"dtype": "int8", "dimension": 256}
+]
+
+
+def _default_nlist(chunk_count: int) -> int:
+    nlist = int(4 * math.sqrt(max(chunk_count, 1)))
+    # faiss wants roughly 39+ training points per centroid
+    return max(1, min(nlist, 65536, chunk_count // 39 or 1))
+
+
+def _default_pq_m(dimension: int) -> int:
+    for m in (dimension // 32, dimension // 16, dimension // 8, dimension // 4):
+        if m and dimension % m == 0:
+            return m
+    return 1
+
+
+def resolve_compression(spec: Union[str, dict, None], dimension: int) -> Optional[dict]:
+    # Compressed vector storage from the "dtype", "dimension" (a shorter prefix of the embedding)
+    # and "rescore" keys of an index spec. None means full float32 vectors, searched as they are.
+    if not isinstance(spec, dict):
+        return None
+    dtype = spec.get("dtype", "float32")
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unsupported vector dtype: {dtype}. Choose from {VECTOR_DTYPES}")
+    truncated = int(spec.get("dimension") or dimension)
+    if not 0 < truncated <= dimension:
+        raise ValueError(f"Truncated dimension {truncated} must be between 1 and the embedding dimension {dimension}")
+    if dtype == "float32" and truncated == dimension:
+        return None
+    return {"dtype": dtype, "dimension": truncated, "rescore": max(1, int(spec.get("rescore", DEFAULT_RESCORE)))}
+
+
+def bytes_per_vector(compression: Optional[dict], dimension: int) -> int:
+    if compression is None:
+        return dimension * 4
+    return compression["dimension"] * _BYTES_PER_VALUE[compression["dtype"]]
+
+
+def compress_vectors(compression: Optional[dict], vectors: np.ndarray) -> np.ndarray:
+    # Matryoshka-style truncation: text-embedding-3 vectors keep most of their meaning in a
+    # prefix of their dimensions, which is re-normalised to unit length. The dtype is applied by
+    # the index itself.
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if compression is None or compression["dimension"] == vectors.shape[1]:
+        return np.ascontiguousarray(vectors)
+    truncated = np.array(vectors[:, :compression["dimension"]], dtype=np.float32)
+    faiss.normalize_L2(truncated)
+    return truncated
+
+
+def new_flat_index(dimension: int, compression: Optional[dict] = None) -> faiss.Index:
+    if compression is None:
+        return faiss.IndexFlatL2(dimension)
+    return faiss.index_factory(compression["dimension"], _SQ_STORAGE.get(compression["dtype"], "Flat"))
+
+
+def training_sample(parts: Sequence[np.ndarray], size: int = MAX_TRAINING_POINTS, seed: int = 0) -> np.ndarray:
+    # Up to size rows drawn uniformly across several blocks of vectors (a store's segments),
+    # without concatenating the blocks first.
+    lengths = [len(part) for part in parts]
+    offsets = np.cumsum([0] + lengths)
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(offsets[-1], size=min(offsets[-1], size), replace=False))
+    return np.concatenate([
+        np.asarray(part[rows[(rows >= start) & (rows < end)] - start], dtype=np.float32)
+        for part, start, end in zip(parts, offsets[:-1], offsets[1:])
+    ])
+
+
+def add_vectors(index: faiss.Index, vectors: np.ndarray, compression: Optional[dict] = None, seed: int = 0):
+    # Compresses and adds in blocks, so a converted copy of a whole segment is never held at
+    # once. An untrained scalar quantizer is trained on the first vectors it is given; callers
+    # that have more vectors to add train it on a sample of all of them first.
+    if not len(vectors):
+        return
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(len(vectors), size=min(len(vectors), MAX_TRAINING_POINTS), replace=False))
+        index.train(compress_vectors(compression, vectors[sample_rows]))
+    for start in range(0, len(vectors), 65536):
+        index.add(compress_vectors(compression, vectors[start:start + 65536]))
+
+
+def rescore(
+    queries: np.ndarray,
+    positions: np.ndarray,
+    vectors_at: Callable[[Sequence[int]], np.ndarray],
+    k: int
+) -> tuple:
+    # Re-ranks each query's candidates by exact squared L2 distance to their full-precision
+    # vectors (what IndexFlatL2 would return) and keeps the best k, padded like a FAISS result.
+    scores = np.full((len(queries), k), np.finfo(np.float32).max, dtype=np.float32)
+    result = np.full((len(queries), k), -1, dtype=np.int64)
+    candidates = np.unique(positions[positions >= 0])
+    if not len(candidates):
+        return scores, result
+    full_vectors = vectors_at(candidates)
+    for i, (query, query_positions) in enumerate(zip(queries, positions)):
+        rows = np.searchsorted(candidates, query_positions[query_positions >= 0])
+        distances = ((full_vectors[rows] - query) ** 2).sum(axis=1)
+        order = np.argsort(distances, kind="stable")[:k]
+        scores[i, :len(order)] = distances[order]
+        result[i, :len(order)] = candidates[rows[order]]
+    return scores, result
+
+
+def resolve_index_spec(spec: Union[str, dict, None], chunk_count: int, dimension: int) -> dict:
+    if isinstance(spec, dict):
+        params = dict(spec)
+    else:
+        params = {"type": (spec or "auto").lower()}
+    # A truncated index is built over the shorter prefix.
+    dimension = int(params.get("dimension") or dimension)
+    
+    index_type = params["type"]
+    if index_type == "auto":
+        if chunk_count >= AUTO_IVF_PQ_MIN_CHUNKS:
+            index_type = "ivf-pq"
+        elif chunk_count >= AUTO_IVF_FLAT_MIN_CHUNKS:
+            index_type = "ivf-flat"
+        elif chunk_count >= AUTO_HNSW_MIN_CHUNKS:
+            index_type = "hnsw"
+        else:
+            index_type = "flat"
+        params["type"] = index_type
+    
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}. Choose from {INDEX_TYPES + ['auto']}")
+    
+    if index_type in ("ivf-flat", "ivf-pq"):
+        params.setdefault("nlist", _default_nlist(chunk_count))
+        params.setdefault("nprobe", min(params["nlist"], max(8, params["nlist"] // 16)))
+    if index_type == "ivf-pq":
+        params.setdefault("m", _default_pq_m(dimension))
+        params.setdefault("nbits", 8)
+        if dimension % params["m"]:
+            raise ValueError(f"PQ m={params['m']} must divide the vector dimension {dimension}")
+    if index_type == "hnsw":
+        params.setdefault("m", 32)
+        params.setdefault("ef_construction", 200)
+        params.setdefault("ef_search", 64)
+    return params
+
+
+def _factory_string(params: dict) -> str:
+    # PQ codes are already compressed, so dtype only changes the storage of the other types.
+    index_type = params["type"]
+    storage = _SQ_STORAGE.get(params.get("dtype"), "Flat")
+    if index_type == "flat":
+        return storage
+    if index_type == "ivf-flat":
+        return f"IVF{params['nlist']},{storage}"
+    if index_type == "ivf-pq":
+        return f"IVF{params['nlist']},PQ{params['m']}x{params['nbits']}"
+    return f"HNSW{params['m']},{storage}"
+
+
+def apply_search_params(index: faiss.Index, params: dict):
+    parameter_space = faiss.ParameterSpace()
+    if "nprobe" in params and params["type"] in ("ivf-flat", "ivf-pq"):
+        parameter_space.set_index_parameter(index, "nprobe", int(params["nprobe"]))
+    if "ef_search" in params and params["type"] == "hnsw":
+        parameter_space.set_index_parameter(index, "efSearch", int(params["ef_search"]))
+
+
+def filtered_search(index: faiss.Index, vectors: np.ndarray, k: int, allowed: np.ndarray):
+    # Searches only the positions set in the boolean mask allowed. FAISS checks the selector
+    # while it scans, so excluded rows never take up one of the k results. Passing search
+    # parameters replaces the index's own nprobe / efSearch, so those are carried over.
+    bitmap = np.packbits(np.asarray(allowed, dtype=bool), bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(allowed), faiss.swig_ptr(bitmap))
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    elif isinstance(faiss.downcast_index(index), faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=faiss.downcast_index(index).hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(vectors, k, params=params)
+
+
+def build_index(params: dict, vectors: np.ndarray, seed: int = 0) -> faiss.Index:
+    # vectors are full precision; params may ask for compressed storage (see resolve_compression).
+    compression = resolve_compression(params, vectors.shape[1])
+    dimension = compression["dimension"] if compression else vectors.shape[1]
+    index = faiss.index_factory(dimension, _factory_string(params))
+    if params["type"] == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = int(params["ef_construction"])
+    
+    if not index.is_trained:
+        # Coarse quantizers need a sample per centroid; a scalar quantizer alone only needs each
+        # dimension's range, taken from as many points as allowed.
+        sample_size = min(
+            len(vectors),
+            MAX_TRAINING_POINTS,
+            max(params["nlist"], 2 ** params.get("nbits", 0)) * TRAINING_POINTS_PER_CENTROID if "nlist" in params else MAX_TRAINING_POINTS
+        )
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(len(vectors), size=sample_size, replace=False))
+        index.train(compress_vectors(compression, vectors[sample_rows]))
+    
+    add_vectors(index, vectors, compression)
+    apply_search_params(index, params)
+    return index
+
+
+def search_param_sweep(params: dict) -> List[Dict]:
+    if params["type"] in ("ivf-flat", "ivf-pq"):
+        values = sorted({v for v in (1, 2, 4, 8, 16, 32, 64, 128, 256, params["nprobe"]) if v <= params["nlist"]})
+        return [{"nprobe": v} for v in values]
+    if params["type"] == "hnsw":
+        values = sorted({16, 32, 64, 128, 256, 512, params["ef_search"]})
+        return [{"ef_search": v} for v in values]
+    return [{}]
+
+
+def _exact_baseline(vectors: np.ndarray, k: int, num_queries: int, seed: int) -> tuple:
+    # Queries are drawn from the stored vectors themselves; the exact flat search over the same
+    # rows is the ground truth that each setting is scored against.
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    queries = np.ascontiguousarray(vectors[query_rows], dtype=np.float32)
+    k = min(k, len(vectors))
+    
+    baseline = faiss.IndexFlatL2(vectors.shape[1])
+    add_vectors(baseline, vectors)
+    started = time.perf_counter()
+    _, truth = baseline.search(queries, k)
+    return queries, truth, k, (time.perf_counter() - started) / len(queries)
+
+
+def _recall(found: np.ndarray, truth: np.ndarray, k: int) -> float:
+    return float(np.mean([len(set(f[f >= 0]).intersection(t)) / k for f, t in zip(found, truth)]))
+
+
+def evaluate_index(
+    index: faiss.Index,
+    params: dict,
+    vectors: np.ndarray,
+    k: int = 10,
+    num_queries: int = 200,
+    seed: int = 0
+) -> dict:
+    # A compressed index is searched with compressed queries, against full-precision truth.
+    queries, truth, k, baseline_latency = _exact_baseline(vectors, k, num_queries, seed)
+    index_queries = compress_vectors(resolve_compression(params, vectors.shape[1]), queries)
+    
+    results = []
+    for setting in search_param_sweep(params):
+        apply_search_params(index, {**params, **setting})
+        started = time.perf_counter()
+        _, found = index.search(index_queries, k)
+        latency = (time.perf_counter() - started) / len(queries)
+        results.append({
+            **setting,
+            "recall_at_k": _recall(found, truth, k),
+            "latency_ms": latency * 1000,
+            "speedup": baseline_latency / latency if latency else None
+        })
+    apply_search_params(index, params)
+    
+    return {
+        "index": params,
+        "rows": int(len(vectors)),
+        "k": k,
+        "num_queries": len(queries),
+        "baseline_latency_ms": baseline_latency * 1000,
+        "results": results
+    }
+
+
+def evaluate_compression(
+    vectors: np.ndarray,
+    settings: Optional[List[dict]] = None,
+    k: int = 10,
+    num_queries: int = 200,
+    seed: int = 0
+) -> dict:
+    # Memory saved against recall lost, for each compression setting over an exact (flat)
+    # index: recall of the compressed index alone, and after re-scoring its rescore × k best
+    # candidates on the full-precision vectors.
+    queries, truth, k, baseline_latency = _exact_baseline(vectors, k, num_queries, seed)
+    full_bytes = bytes_per_vector(None, vectors.shape[1])
+    
+    results = []
+    seen = set()
+    for setting in settings or COMPRESSION_SWEEP:
+        if setting.get("dimension", 0) > vectors.shape[1]:
+            continue
+        compression = resolve_compression(setting, vectors.shape[1])
+        key = (compression["dtype"], compression["dimension"]) if compression else None
+        if key in seen:
+            continue
+        seen.add(key)
+        index = new_flat_index(vectors.shape[1], compression)
+        add_vectors(index, vectors, compression, seed)
+        index_queries = compress_vectors(compression, queries)
+        _, found = index.search(index_queries, k)
+        
+        started = time.perf_counter()
+        rescore_k = k * (compression["rescore"] if compression else 1)
+        _, candidates = index.search(index_queries, rescore_k)
+        _, rescored = rescore(queries, candidates, lambda positions: np.asarray(vectors[positions], dtype=np.float32), k)
+        latency = (time.perf_counter() - started) / len(queries)
+        
+        vector_bytes = bytes_per_vector(compression, vectors.shape[1])
+        recall_rescored = _recall(rescored, truth, k)
+        results.append({
+            "dtype": compression["dtype"] if compression else "float32",
+            "dimension": compression["dimension"] if compression else vectors.shape[1],
+            "rescore": rescore_k // k,
+            "bytes_per_vector": vector_bytes,
+            "memory_bytes": vector_bytes * len(vectors),
+            "memory_saved": 1 - vector_bytes / full_bytes,
+            "recall_at_k": _recall(found, truth, k),
+            "recall_at_k_rescored": recall_rescored,
+            "recall_lost": 1 - recall_rescored,
+            "latency_ms": latency * 1000
+        })
+    
+    return {
+        "rows": int(len(vectors)),
+        "dimension": int(vectors.shape[1]),
+        "k": k,
+        "num_queries": len(queries),
+        "full_precision_bytes": full_bytes * len(vectors),
+        "baseline_latency_ms": baseline_latency * 1000,
+        "results": results
+    }
@@ -1,14 +1,25 @@
+import time
+_RERUN_STARTED = time.perf_counter()
+
 import streamlit as st
 import os
+import sys
 from datetime import datetime
 from dotenv import load_dotenv
-import time
 
-from document_processor import DocumentProcessor
-from vector_store_manager import VectorStoreManager
-from rag_engine import RAGEngine
+from metrics import metrics
 
-load_dotenv()
+# langchain, faiss and the OpenAI clients are imported by load_components(), after the page
+# header is on screen, and the objects built from them are shared by every session.
+if not os.getenv("OPENAI_API_KEY"):
+    load_dotenv()
+
+# Per-session chat history: the oldest messages are dropped once either limit is reached, and
+# only the latest CHAT_WINDOW messages are drawn until older ones are asked for.
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "200"))
+CHAT_HISTORY_MAX_CHARS = int(os.getenv("CHAT_HISTORY_MAX_CHARS", "500000"))
+CHAT_WINDOW = int(os.getenv("CHAT_WINDOW", "20"))
+SOURCES_SHOWN = 3
 
 st.set_page_config(
     page_title="RAG Document Q&A System",
@@ -16,8 +27,9 @@ st.set_page_config(
     layout="wide"
 )
 
-# Custom CSS for ChatGPT-like interface
-st.markdown("""
+# Custom CSS for ChatGPT-like interface. Streamlit drops elements a rerun doesn't emit again,
+# so it is sent on every rerun, with its whitespace collapsed.
+CUSTOM_CSS = """
 <style>
     .chat-container {
         max-height: 500px;
@@ -104,32 +116,84 @@ st.markdown("""
         margin: 1rem 0;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(" ".join(CUSTOM_CSS.split()), unsafe_allow_html=True)
+
+def load_components():
+    # The first session in a process pays for the imports and clients ("cold"); later sessions
+    # get the same process-wide objects back at once.
+    with metrics.span("app_init", component="vector_store_manager", cold='vector_store_manager' not in sys.modules):
+        from vector_store_manager import shared_vector_store_manager
+        st.session_state.vector_store_manager = shared_vector_store_manager()
+    with metrics.span("app_init", component="rag_engine", cold='rag_engine' not in sys.modules):
+        from rag_engine import shared_rag_engine
+        st.session_state.rag_engine = shared_rag_engine()
+    with metrics.span("app_init", component="ingestion_queue", cold='ingestion_jobs' not in sys.modules):
+        from ingestion_jobs import shared_ingestion_queue
+        st.session_state.ingestion_queue = shared_ingestion_queue()
 
 def initialize_session_state():
-    if 'vector_store_manager' not in st.session_state:
-        st.session_state.vector_store_manager = VectorStoreManager()
-    
-    if 'document_processor' not in st.session_state:
-        st.session_state.document_processor = DocumentProcessor()
+    # Everything below only needs setting once per session.
+    if st.session_state.get('session_initialized'):
+        return
     
-    if 'rag_engine' not in st.session_state:
-        st.session_state.rag_engine = RAGEngine()
+    load_components()
     
     if 'current_vector_store' not in st.session_state:
         st.session_state.current_vector_store = None
     
+    if 'current_store_handle' not in st.session_state:
+        st.session_state.current_store_handle = None
+    
     if 'current_store_name' not in st.session_state:
         st.session_state.current_store_name = None
     
+    if 'extra_store_handles' not in st.session_state:
+        st.session_state.extra_store_handles = {}
+    
+    if 'ingestion_jobs' not in st.session_state:
+        st.session_state.ingestion_jobs = []
+    
     if 'qa_chain' not in st.session_state:
         st.session_state.qa_chain = None
     
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
     
+    if 'chat_visible' not in st.session_state:
+        st.session_state.chat_visible = CHAT_WINDOW
+    
+    if 'chat_dropped' not in st.session_state:
+        st.session_state.chat_dropped = 0
+    
     if 'user_input' not in st.session_state:
         st.session_state.user_input = ""
+    
+    st.session_state.session_initialized = True
+
+def set_current_store(store_name, store_handle):
+    # Releasing the previous handle unpins that store in the shared cache so it can be evicted.
+    if st.session_state.current_store_handle is not None:
+        st.session_state.current_store_handle.release()
+    
+    st.session_state.current_store_handle = store_handle
+    st.session_state.current_store_name = store_name
+    # The chat scope names files of the previous store, so it starts empty again.
+    st.session_state.pop('scope_files', None)
+    st.session_state.pop('scope_dates', None)
+    st.session_state.current_vector_store = store_handle.vector_store if store_handle else None
+    st.session_state.qa_chain = (
+        st.session_state.rag_engine.create_qa_chain(store_handle.vector_store) if store_handle else None
+    )
+
+def set_extra_stores(store_names):
+    handles = st.session_state.extra_store_handles
+    for store_name in [name for name in handles if name not in store_names]:
+        handles.pop(store_name).release()
+    missing = [name for name in store_names if name not in handles]
+    if missing:
+        with st.spinner(f"Loading knowledge bases: {', '.join(missing)}"):
+            handles.update(st.session_state.vector_store_manager.acquire_vector_stores(missing))
 
 def sidebar_knowledge_base_management():
     st.sidebar.header("📚 Knowledge Base Management")
@@ -148,25 +212,51 @@ def sidebar_knowledge_base_management():
         
         if selected_store != "None" and selected_store != st.session_state.current_store_name:
             with st.spinner(f"Loading knowledge base: {selected_store}"):
-                vector_store = st.session_state.vector_store_manager.load_vector_store(selected_store)
-                if vector_store:
-                    st.session_state.current_vector_store = vector_store
-                    st.session_state.current_store_name = selected_store
-                    st.session_state.qa_chain = st.session_state.rag_engine.create_qa_chain(vector_store)
+                store_handle = st.session_state.vector_store_manager.acquire_vector_store(selected_store)
+                if store_handle:
+                    set_current_store(selected_store, store_handle)
                     st.sidebar.success(f"Loaded: {selected_store}")
                 else:
                     st.sidebar.error(f"Failed to load: {selected_store}")
+        
+        other_stores = [name for name in available_stores if name != st.session_state.current_store_name]
+        if st.session_state.current_store_name in available_stores and other_stores:
+            extra_stores = st.sidebar.multiselect(
+                "Also search these knowledge bases:",
+                other_stores,
+                default=[name for name in st.session_state.extra_store_handles if name in other_stores],
+                help="Questions are searched across all selected knowledge bases in parallel."
+            )
+            set_extra_stores(extra_stores)
     else:
         st.sidebar.info("No existing knowledge bases found.")
     
     st.sidebar.subheader("Create New Knowledge Base")
     new_store_name = st.sidebar.text_input("Enter name for new knowledge base:")
+    new_store_index = st.sidebar.selectbox(
+        "Index type:",
+        ["auto", "flat", "hnsw", "ivf-flat", "ivf-pq"],
+        help="'auto' picks exact search for small knowledge bases and an approximate index as they grow."
+    )
+    new_store_dtype = st.sidebar.selectbox(
+        "Vector storage:",
+        ["float32", "float16", "int8"],
+        help="float16 halves and int8 quarters the memory the index takes; results are re-scored on the full vectors."
+    )
+    new_store_dimension = st.sidebar.selectbox(
+        "Indexed dimensions:",
+        ["all", 2048, 1024, 512, 256],
+        help="Index only a prefix of each embedding to save memory; results are re-scored on the full vectors."
+    )
     
     if st.sidebar.button("Create New Knowledge Base"):
         if new_store_name and new_store_name not in available_stores:
-            st.session_state.current_store_name = new_store_name
-            st.session_state.current_vector_store = None
-            st.session_state.qa_chain = None
+            set_current_store(new_store_name, None)
+            if new_store_dtype != "float32" or new_store_dimension != "all":
+                new_store_index = {"type": new_store_index, "dtype": new_store_dtype}
+                if new_store_dimension != "all":
+                    new_store_index["dimension"] = new_store_dimension
+            st.session_state.new_store_index_spec = new_store_index
             st.sidebar.success(f"Ready to create: {new_store_name}")
         elif new_store_name in available_stores:
             st.sidebar.error("Knowledge base name already exists!")
@@ -196,58 +286,138 @@ def document_upload_section():
         with col2:
             process_btn = st.button("🚀 Process Documents", type="primary", disabled=not uploaded_files)
         
+        if uploaded_files and process_btn and st.session_state.current_vector_store is not None:
+            # Files whose exact bytes are already in the knowledge base are skipped before parsing.
+            from document_processor import file_content_hash
+            known_hashes = st.session_state.vector_store_manager.get_file_hashes(st.session_state.current_store_name)
+            unchanged = [f.name for f in uploaded_files if known_hashes.get(f.name) == file_content_hash(f.getvalue())]
+            if unchanged:
+                st.info(f"✔️ Already up to date, skipped: {', '.join(unchanged)}")
+                uploaded_files = [f for f in uploaded_files if f.name not in unchanged]
+        
         if uploaded_files and process_btn:
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            try:
-                status_text.text("📖 Reading documents...")
-                progress_bar.progress(25)
-                documents = st.session_state.document_processor.process_documents(uploaded_files)
-                
-                status_text.text("🔍 Creating embeddings...")
-                progress_bar.progress(50)
-                
-                if st.session_state.current_vector_store is None:
-                    status_text.text("🏗️ Creating knowledge base...")
-                    progress_bar.progress(75)
-                    st.session_state.current_vector_store = st.session_state.vector_store_manager.create_vector_store(
-                        documents, st.session_state.current_store_name
-                    )
-                    status_text.text("✅ Knowledge base created!")
-                    st.success(f"🎉 Created new knowledge base '{st.session_state.current_store_name}' with {len(documents)} document chunks.")
-                else:
-                    status_text.text("📚 Adding to existing knowledge base...")
-                    progress_bar.progress(75)
-                    st.session_state.current_vector_store = st.session_state.vector_store_manager.add_documents_to_store(
-                        st.session_state.current_vector_store, documents, st.session_state.current_store_name
-                    )
-                    status_text.text("✅ Documents added!")
-                    st.success(f"🎉 Added {len(documents)} document chunks to '{st.session_state.current_store_name}'.")
-                
-                progress_bar.progress(100)
-                st.session_state.qa_chain = st.session_state.rag_engine.create_qa_chain(st.session_state.current_vector_store)
-                
-                time.sleep(1)
-                progress_bar.empty()
-                status_text.empty()
-                
-                with st.expander("👀 View processed documents"):
-                    for i, doc in enumerate(documents[:5]):
-                        st.text(f"📄 Chunk {i+1}: {doc.page_content[:200]}...")
-                        if i >= 4 and len(documents) > 5:
-                            st.text(f"... and {len(documents) - 5} more chunks")
-                            break
-                            
-            except Exception as e:
-                progress_bar.empty()
-                status_text.empty()
-                st.error(f"❌ Error processing documents: {str(e)}")
+            # Parsing and indexing run in a background job, so a long upload neither blocks this
+            # session nor is lost when the browser disconnects.
+            job_id = st.session_state.ingestion_queue.submit(
+                st.session_state.current_store_name,
+                uploaded_files,
+                index_spec=st.session_state.get('new_store_index_spec', 'auto')
+            )
+            st.session_state.ingestion_jobs.append(job_id)
+        
+        ingestion_jobs_panel()
         
         st.markdown('</div>', unsafe_allow_html=True)
 
+def describe_job_progress(job):
+    progress, stats = job["progress"], job["stats"]
+    return (
+        f"📖 {progress.get('files_done', 0)}/{progress.get('files_total', len(job['files']))} files, "
+        f"{progress.get('pages', 0)} pages, {progress.get('chunks', 0)} chunks · 🔍 {stats.get('batches', 0)} batches embedded, "
+        f"{stats.get('indexed', 0)} chunks indexed, {stats.get('duplicates', 0)} duplicates linked"
+    )
+
+def on_job_finished(job):
+    # The finished job's store is reloaded once, if this session is looking at it.
+    stats = job["stats"]
+    if job["status"] == "done":
+        st.success(f"🎉 Indexed {stats.get('indexed', 0)} document chunks into '{job['store_name']}'.")
+        if stats.get("duplicates"):
+            st.info(f"♻️ Linked {stats['duplicates']} near-duplicate chunks to text already in the knowledge base or repeated in the upload instead of embedding them.")
+        if stats.get("replaced_files"):
+            st.info(
+                f"🔁 Updated {stats['replaced_files']} changed files: {stats.get('unchanged_chunks', 0)} chunks unchanged, "
+                f"{stats.get('deleted', 0)} removed, {stats.get('indexed', 0)} added ({stats.get('reused', 0)} without re-embedding)."
+            )
+        if job["store_name"] == st.session_state.current_store_name:
+            set_current_store(
+                job["store_name"],
+                st.session_state.vector_store_manager.acquire_vector_store(job["store_name"])
+            )
+    elif job["status"] == "failed":
+        st.error(f"❌ Error processing documents for '{job['store_name']}': {job['error']}")
+    else:
+        st.info(f"🛑 Cancelled the upload to '{job['store_name']}'.")
+    for filename, error in job["failed_files"]:
+        st.warning(f"⚠️ Skipped {filename}: {error}")
+
+def ingestion_jobs_panel():
+    # Shows this session's ingestion jobs, across knowledge bases. main() keeps rerunning the
+    # script while any of them is still queued or running.
+    jobs = [st.session_state.ingestion_queue.get(job_id) for job_id in st.session_state.ingestion_jobs]
+    jobs = [job for job in jobs if job is not None]
+    for job in jobs:
+        if job["status"] == "queued":
+            col1, col2 = st.columns([5, 1])
+            col1.text(f"⏳ '{job['store_name']}': {len(job['files'])} files waiting to be processed")
+        elif job["status"] == "running":
+            col1, col2 = st.columns([5, 1])
+            with col1:
+                fraction = job["progress"].get("files_done", 0) / max(len(job["files"]), 1)
+                st.progress(min(int(fraction * 95), 95), text=f"'{job['store_name']}': {describe_job_progress(job)}")
+        else:
+            on_job_finished(job)
+            st.session_state.ingestion_jobs.remove(job["id"])
+            continue
+        if col2.button("Cancel", key=f"cancel-job-{job['id']}", disabled=job["cancel_requested"]):
+            st.session_state.ingestion_queue.cancel(job["id"])
+            st.rerun()
+
+def text_preview(text):
+    return text[:100] + "..." if len(text) > 100 else text
+
+def document_previews(documents):
+    return [(doc.metadata.get('filename', 'Unknown'), text_preview(doc.page_content)) for doc in documents[:SOURCES_SHOWN]]
+
+def source_refs(documents):
+    # What the chat history keeps for a source: its store, chunk id and file name. The text is
+    # read back from the store when the message is drawn.
+    return [
+        (doc.metadata.get('store', st.session_state.current_store_name), doc.metadata.get('chunk_id'), doc.metadata.get('filename', 'Unknown'))
+        for doc in documents[:SOURCES_SHOWN]
+    ]
+
+def loaded_store(store_name):
+    if store_name == st.session_state.current_store_name:
+        return st.session_state.current_vector_store
+    handle = st.session_state.extra_store_handles.get(store_name)
+    return handle.vector_store if handle else None
+
+def ref_previews(refs):
+    # Stores that aren't open in this session are not loaded just to draw old messages.
+    previews = []
+    for store_name, chunk_id, filename in refs:
+        vector_store = loaded_store(store_name)
+        doc = vector_store.document(chunk_id) if chunk_id and hasattr(vector_store, "document") else None
+        if doc is not None:
+            previews.append((filename, text_preview(doc.page_content)))
+        elif vector_store is not None and chunk_id:
+            previews.append((filename, "(no longer in the knowledge base)"))
+        else:
+            previews.append((filename, f"(from knowledge base '{store_name}')"))
+    return previews
+
+def assistant_message_html(content, sources=None, timestamp=""):
+    # sources are (file name, preview) pairs.
+    sources_html = ""
+    if sources:
+        sources_html = '<div class="sources-section"><strong>📚 Sources:</strong>'
+        for filename, content_preview in sources:
+            sources_html += f'<div class="source-doc"><strong>📄 {filename}:</strong><br>{content_preview}</div>'
+        sources_html += '</div>'
+    
+    return f"""
+        <div class="assistant-message">
+            <div class="assistant-bubble">
+                🤖 {content}
+                {sources_html}
+                <div class="timestamp">{timestamp}</div>
+            </div>
+        </div>
+        """
+
 def display_chat_message(message, is_user=True):
-    timestamp = datetime.now().strftime("%I:%M %p")
+    timestamp = message.get('timestamp', datetime.now()).strftime("%I:%M %p")
     
     if is_user:
         st.markdown(f"""
@@ -259,24 +429,38 @@ def display_chat_message(message, is_user=True):
         </div>
         """, unsafe_allow_html=True)
     else:
-        sources_html = ""
-        if message.get('sources'):
-            sources_html = '<div class="sources-section"><strong>📚 Sources:</strong>'
-            for i, source in enumerate(message['sources'][:3]):
-                filename = source.metadata.get('filename', 'Unknown')
-                content_preview = source.page_content[:100] + "..." if len(source.page_content) > 100 else source.page_content
-                sources_html += f'<div class="source-doc"><strong>📄 {filename}:</strong><br>{content_preview}</div>'
-            sources_html += '</div>'
-        
-        st.markdown(f"""
-        <div class="assistant-message">
-            <div class="assistant-bubble">
-                🤖 {message['content']}
-                {sources_html}
-                <div class="timestamp">{timestamp}</div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(assistant_message_html(message['content'], ref_previews(message.get('sources', ())), timestamp), unsafe_allow_html=True)
+
+def append_chat_message(message):
+    history = st.session_state.chat_history
+    history.append(message)
+    total_chars = sum(len(entry['content']) for entry in history)
+    dropped = 0
+    while len(history) - dropped > 1 and (
+        len(history) - dropped > CHAT_HISTORY_MAX_MESSAGES or total_chars > CHAT_HISTORY_MAX_CHARS
+    ):
+        total_chars -= len(history[dropped]['content'])
+        dropped += 1
+    if dropped:
+        del history[:dropped]
+        st.session_state.chat_dropped += dropped
+
+def chat_scope_filter():
+    # Restricts retrieval to some files and / or an upload date range; the filter is applied
+    # inside the search, so a narrow scope still gets k chunks from the chosen files.
+    store_info = st.session_state.vector_store_manager.get_store_info(st.session_state.current_store_name)
+    source_files = list(store_info.get("source_files", {})) if store_info else []
+    
+    with st.expander("🎯 Search scope", expanded=bool(st.session_state.get('scope_files'))):
+        selected_files = st.multiselect("Only search these files:", source_files, key="scope_files")
+        uploaded_between = st.date_input("Only documents uploaded between:", value=(), key="scope_dates")
+    
+    scope = {}
+    if selected_files:
+        scope["filename"] = selected_files
+    if len(uploaded_between) == 2:
+        scope["uploaded_at"] = {"gte": uploaded_between[0].isoformat(), "lte": uploaded_between[1].isoformat()}
+    return scope or None
 
 def chat_interface():
     st.markdown("### 💬 Chat with your Documents")
@@ -300,12 +484,22 @@ def chat_interface():
             </div>
             """, unsafe_allow_html=True)
         
-        # Display chat history
-        for message in st.session_state.chat_history:
+        # Only the latest window of the history is drawn; older messages are paged in on request.
+        history = st.session_state.chat_history
+        hidden = max(len(history) - st.session_state.chat_visible, 0)
+        if hidden:
+            if st.button(f"⬆️ Load {min(CHAT_WINDOW, hidden)} older messages ({hidden} hidden)", key="load_older_messages"):
+                st.session_state.chat_visible += CHAT_WINDOW
+                st.rerun()
+        elif st.session_state.chat_dropped:
+            st.caption(f"{st.session_state.chat_dropped} older messages were removed to stay within this session's history limit.")
+        for message in history[hidden:]:
             display_chat_message(message, message['role'] == 'user')
         
         st.markdown('</div>', unsafe_allow_html=True)
     
+    scope = chat_scope_filter()
+    
     # Chat input section
     st.markdown('<div class="chat-input">', unsafe_allow_html=True)
     
@@ -328,31 +522,55 @@ def chat_interface():
     
     # Process user input
     if send_button and user_input.strip():
-        # Add user message to chat history
-        st.session_state.chat_history.append({
+        # Add user message to chat history; sending jumps back to the latest window.
+        st.session_state.chat_visible = CHAT_WINDOW
+        append_chat_message({
             'role': 'user',
             'content': user_input,
             'timestamp': datetime.now()
         })
         
-        # Show typing indicator
-        with st.spinner("🤔 Thinking..."):
-            result = st.session_state.rag_engine.query(st.session_state.qa_chain, user_input)
+        # Stream the answer into the chat: sources appear as soon as retrieval is done and the
+        # bubble is redrawn as each token arrives.
+        with chat_container:
+            display_chat_message(st.session_state.chat_history[-1], is_user=True)
+            answer_placeholder = st.empty()
+        
+        extra_stores = [handle.vector_store for handle in st.session_state.extra_store_handles.values()]
+        if extra_stores:
+            result = st.session_state.rag_engine.stream_multi_query(
+                [st.session_state.current_vector_store] + extra_stores, user_input, filter=scope
+            )
+            if result.get("incomplete_stores"):
+                st.warning(f"⏱️ Partial results: {', '.join(result['incomplete_stores'])} did not answer in time.")
+        else:
+            result = st.session_state.rag_engine.stream_query(st.session_state.current_vector_store, user_input, filter=scope)
+        sources = result["source_documents"]
+        previews = document_previews(sources)
+        answer = ""
+        
+        try:
+            if not result["success"]:
+                raise RuntimeError(result["answer"])
             
-            if result["success"]:
-                # Add assistant response to chat history
-                st.session_state.chat_history.append({
-                    'role': 'assistant',
-                    'content': result["answer"],
-                    'sources': result["source_documents"],
-                    'timestamp': datetime.now()
-                })
-            else:
-                st.session_state.chat_history.append({
-                    'role': 'assistant',
-                    'content': f"❌ Sorry, I encountered an error: {result['answer']}",
-                    'timestamp': datetime.now()
-                })
+            answer_placeholder.markdown(assistant_message_html("🤔 Thinking...", previews), unsafe_allow_html=True)
+            for token in result["tokens"]:
+                answer += token
+                answer_placeholder.markdown(assistant_message_html(answer + "▌", previews), unsafe_allow_html=True)
+            
+            # The history keeps references to the source chunks, not the chunks themselves.
+            append_chat_message({
+                'role': 'assistant',
+                'content': answer,
+                'sources': source_refs(sources),
+                'timestamp': datetime.now()
+            })
+        except Exception as e:
+            append_chat_message({
+                'role': 'assistant',
+                'content': f"❌ Sorry, I encountered an error: {str(e)}",
+                'timestamp': datetime.now()
+            })
         
         # Rerun to update the chat display
         st.rerun()
@@ -360,11 +578,35 @@ def chat_interface():
     # Clear chat button
     if st.session_state.chat_history and st.button("🗑️ Clear Chat", help="Clear conversation history"):
         st.session_state.chat_history = []
+        st.session_state.chat_visible = CHAT_WINDOW
+        st.session_state.chat_dropped = 0
         st.rerun()
 
+def record_rerun_timing():
+    # A session's first run ends when its page is interactive; every later interaction is a rerun.
+    elapsed = time.perf_counter() - _RERUN_STARTED
+    first_run = 'last_rerun_seconds' not in st.session_state
+    metrics.observe("app_rerun", elapsed, first_run=first_run)
+    if first_run:
+        st.session_state.time_to_interactive = elapsed
+    st.session_state.last_rerun_seconds = elapsed
+
+def startup_timing_report():
+    with st.sidebar.expander("🚀 Startup & Rerun Timings"):
+        if 'time_to_interactive' in st.session_state:
+            st.text(
+                f"This session: interactive after {st.session_state.time_to_interactive * 1000:.0f} ms, "
+                f"last rerun {st.session_state.last_rerun_seconds * 1000:.0f} ms"
+            )
+        for timing in metrics.snapshot()["timings"]:
+            if timing["name"] in ("app_init", "app_rerun"):
+                labels = ", ".join(f"{key}={value}" for key, value in timing["labels"].items())
+                st.text(
+                    f"{timing['name']} ({labels}): {timing['count']}× "
+                    f"{timing['mean_seconds'] * 1000:.1f} ms avg, {timing['max_seconds'] * 1000:.1f} ms max"
+                )
+
 def main():
-    initialize_session_state()
-    
     # Header
     st.markdown("""
     <div style="text-align: center; padding: 1rem 0; background: linear-gradient(90deg, #667eea 0%, #764ba2 100%); color: white; border-radius: 10px; margin-bottom: 2rem;">
@@ -377,6 +619,10 @@ def main():
         st.error("🔑 Please set your OPENAI_API_KEY in the .env file.")
         st.stop()
     
+    if not st.session_state.get('session_initialized'):
+        with st.spinner("Starting up..."):
+            initialize_session_state()
+    
     # Sidebar for knowledge base management
     sidebar_knowledge_base_management()
     
@@ -391,12 +637,36 @@ def main():
     if st.session_state.current_vector_store:
         st.sidebar.markdown("---")
         st.sidebar.subheader("📊 Knowledge Base Stats")
-        try:
-            doc_count = len(st.session_state.current_vector_store.docstore._dict)
-            st.sidebar.metric("Document Chunks", doc_count)
+        store_info = st.session_state.vector_store_manager.get_store_info(st.session_state.current_store_name)
+        if store_info:
+            st.sidebar.metric("Document Chunks", store_info["document_count"])
+            st.sidebar.metric("Source Files", len(store_info["source_files"]))
+            st.sidebar.metric("Duplicate Chunks Skipped", store_info["duplicate_count"])
+            st.sidebar.metric("Size on Disk", f"{store_info['size_bytes'] / (1024 * 1024):.1f} MB")
             st.sidebar.metric("Current KB", st.session_state.current_store_name)
-        except:
+            answer_cache_stats = st.session_state.rag_engine.answer_cache.stats()
+            st.sidebar.metric("Answer Cache Hit Rate", f"{answer_cache_stats['hit_rate']:.0%}")
+            with st.sidebar.expander("📁 Files"):
+                for filename, count in store_info["source_files"].items():
+                    col1, col2 = st.columns([4, 1])
+                    col1.text(f"{filename} ({count} chunks)")
+                    if col2.button("🗑️", key=f"delete-file-{filename}", help=f"Remove {filename} from this knowledge base"):
+                        removed = st.session_state.vector_store_manager.delete_file(
+                            st.session_state.current_store_name, filename, st.session_state.current_vector_store
+                        )
+                        st.success(f"Removed {removed} chunks from {filename}")
+                        st.rerun()
+            with st.sidebar.expander("⏱️ Pipeline Timings"):
+                for timing in metrics.snapshot()["timings"]:
+                    labels = ", ".join(f"{key}={value}" for key, value in timing["labels"].items())
+                    st.text(
+                        f"{timing['name']}{f' ({labels})' if labels else ''}: {timing['count']}× "
+                        f"{timing['mean_seconds'] * 1000:.1f} ms avg, {timing['max_seconds'] * 1000:.1f} ms max"
+                    )
+                st.download_button("Prometheus metrics", metrics.render_prometheus(), file_name="metrics.prom")
+        else:
             st.sidebar.text("Stats unavailable")
+
         
         # Add some helpful tips
         st.sidebar.markdown("---")
@@ -407,6 +677,14 @@ def main():
         - Clear chat to start fresh conversations
         - Upload more documents to expand knowledge
         """)
+    
+    startup_timing_report()
+    record_rerun_timing()
+    
+    # Poll the background ingestion jobs this session is waiting for.
+    if st.session_state.ingestion_jobs:
+        time.sleep(1)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
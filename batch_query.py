@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import json
+import sys
+from typing import Iterator, List
+
+from dotenv import load_dotenv
+
+from rag_engine import RAGEngine
+from vector_store_manager import VectorStoreManager
+
+
+def read_questions(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {"question": record}
+            if not record.get("question"):
+                raise ValueError(f"Line {line_number} has no 'question' field")
+            record.setdefault("id", line_number)
+            yield record
+
+
+def iter_batches(records: Iterator[dict], batch_size: int) -> Iterator[List[dict]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def format_result(record: dict, result: dict) -> dict:
+    return {
+        **record,
+        "answer": result["answer"],
+        "success": result["success"],
+        "cached": result.get("cached", False),
+        "sources": [
+            {
+                "filename": doc.metadata.get("filename", "Unknown"),
+                "page": doc.metadata.get("page"),
+                "content": doc.page_content
+            }
+            for doc in result["source_documents"]
+        ]
+    }
+
+
+async def run(args) -> int:
+    vector_store = VectorStoreManager().load_vector_store(args.store)
+    if vector_store is None:
+        print(f"Knowledge base not found: {args.store}", file=sys.stderr)
+        return 1
+    
+    rag_engine = RAGEngine(model_name=args.model)
+    filter = json.loads(args.filter) if args.filter else None
+    answered = 0
+    failed = 0
+    
+    with open(args.output, "w", encoding="utf-8") as out:
+        for batch in iter_batches(read_questions(args.input), args.batch_size):
+            results = await rag_engine.abatch_query(
+                vector_store,
+                [record["question"] for record in batch],
+                k=args.k,
+                max_concurrency=args.concurrency,
+                filter=filter
+            )
+            for record, result in zip(batch, results):
+                out.write(json.dumps(format_result(record, result), ensure_ascii=False) + "\n")
+                answered += 1
+                failed += 0 if result["success"] else 1
+            out.flush()
+            print(f"Answered {answered} questions ({failed} failed)", file=sys.stderr)
+    
+    stats = rag_engine.answer_cache.stats()
+    print(f"Done: {answered} answered, {failed} failed, answer cache hit rate {stats['hit_rate']:.0%}", file=sys.stderr)
+    return 0 if not failed else 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions against a knowledge base.")
+    parser.add_argument("--store", required=True, help="Name of the knowledge base in vector_stores/")
+    parser.add_argument("--input", required=True, help="JSONL file with one {\"question\": ...} object per line")
+    parser.add_argument("--output", required=True, help="JSONL file to write answers and sources to")
+    parser.add_argument("--k", type=int, default=4, help="Number of chunks to retrieve per question")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum concurrent LLM calls")
+    parser.add_argument("--batch-size", type=int, default=100, help="Questions embedded and searched per batch")
+    parser.add_argument("--filter", help="JSON metadata filter, e.g. '{\"filename\": [\"contract.pdf\"]}'")
+    parser.add_argument("--model", default="gpt-4-1106-preview", help="Chat model used to answer")
+    args = parser.parse_args()
+    
+    load_dotenv()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
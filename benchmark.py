@@ -0,0 +1,305 @@
+import argparse
+import json
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import zlib
+from io import BytesIO
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from docx import Document as DocxDocument
+from langchain.schema.embeddings import Embeddings
+from langchain_community.chat_models.fake import FakeListChatModel
+
+from document_processor import DocumentProcessor
+from lexical_index import tokenize
+from rag_engine import AnswerCache, RAGEngine
+from vector_store_manager import LoadedStoreCache, VectorStoreManager
+
+
+class HashingEmbeddings(Embeddings):
+    # Deterministic bag-of-words vectors: texts sharing terms get similar vectors, so retrieval
+    # behaves plausibly without calling an embedding API.
+    def __init__(self, dimension: int = 256):
+        self.dimension = dimension
+        self.document_calls = 0
+        self.query_calls = 0
+    
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in tokenize(text):
+            h = zlib.crc32(token.encode("utf-8"))
+            vector[h % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.document_calls += 1
+        return [self._embed(text) for text in texts]
+    
+    def embed_query(self, text: str) -> List[float]:
+        self.query_calls += 1
+        return self._embed(text)
+
+
+class SyntheticUpload(BytesIO):
+    # Quacks like Streamlit's UploadedFile.
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+
+class SyntheticCorpus:
+    def __init__(self, seed: int = 0, vocabulary_size: int = 2000):
+        self.rng = random.Random(seed)
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        self.vocabulary = [
+            "".join(self.rng.choice(letters) for _ in range(self.rng.randint(3, 10)))
+            for _ in range(vocabulary_size)
+        ]
+        self.identifiers: List[str] = []
+        self.sentences: List[str] = []
+    
+    def sentence(self) -> str:
+        words = self.rng.choices(self.vocabulary, k=self.rng.randint(8, 20))
+        if self.rng.random() < 0.15:
+            identifier = self.rng.choice(["PN-{:05d}", "E{:04d}", "REV-{:03d}"]).format(self.rng.randint(0, 99999))
+            words.insert(self.rng.randint(0, len(words)), identifier)
+            self.identifiers.append(identifier)
+        sentence = " ".join(words).capitalize() + "."
+        self.sentences.append(sentence)
+        return sentence
+    
+    def page(self, words_per_page: int) -> str:
+        sentences = []
+        count = 0
+        while count < words_per_page:
+            sentences.append(self.sentence())
+            count += len(sentences[-1].split())
+        return " ".join(sentences)
+    
+    def questions(self, count: int) -> List[str]:
+        questions = []
+        for _ in range(count):
+            if self.identifiers and self.rng.random() < 0.5:
+                questions.append(f"What does {self.rng.choice(self.identifiers)} refer to?")
+            else:
+                words = self.rng.choice(self.sentences).rstrip(".").split()
+                start = self.rng.randint(0, max(len(words) - 6, 0))
+                questions.append("What is said about " + " ".join(words[start:start + 6]).lower() + "?")
+        return questions
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: List[str], line_width: int = 95) -> bytes:
+    # A minimal single-font PDF; enough for PdfReader's text extraction.
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for text in pages:
+        lines, line = [], ""
+        for word in text.split():
+            if line and len(line) + len(word) + 1 > line_width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+        content = "BT /F1 9 Tf 11 TL 40 760 Td " + " ".join(f"({_pdf_escape(l)}) Tj T*" for l in lines) + " ET"
+        stream = content.encode("latin-1", errors="replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % len(objects)
+        )
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids)
+    )
+    
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref_offset = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+    return out.getvalue()
+
+
+def make_docx(pages: List[str]) -> bytes:
+    document = DocxDocument()
+    for i, text in enumerate(pages):
+        document.add_heading(f"Section {i + 1}", level=1)
+        for sentence_group in text.split(". "):
+            document.add_paragraph(sentence_group)
+    out = BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def build_corpus(corpus: SyntheticCorpus, pdf_files: int, docx_files: int, pages_per_file: int, words_per_page: int) -> List[SyntheticUpload]:
+    uploads = []
+    for i in range(pdf_files):
+        pages = [corpus.page(words_per_page) for _ in range(pages_per_file)]
+        uploads.append(SyntheticUpload(f"synthetic-{i:03d}.pdf", make_pdf(pages)))
+    for i in range(docx_files):
+        pages = [corpus.page(words_per_page) for _ in range(pages_per_file)]
+        uploads.append(SyntheticUpload(f"synthetic-{i:03d}.docx", make_docx(pages)))
+    return uploads
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _latency_summary(latencies: List[float]) -> dict:
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": float(latencies_ms.mean()) if len(latencies) else None,
+        "p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies) else None,
+        "p95_ms": float(np.percentile(latencies_ms, 95)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies_ms, 99)) if len(latencies) else None
+    }
+
+
+def _timed(fn) -> Tuple[object, float]:
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def run_benchmark(args, workdir: Path) -> dict:
+    corpus = SyntheticCorpus(seed=args.seed)
+    uploads = build_corpus(corpus, args.pdf_files, args.docx_files, args.pages_per_file, args.words_per_page)
+    corpus_bytes = sum(len(upload.getvalue()) for upload in uploads)
+    results = {
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "corpus": {"files": len(uploads), "bytes": corpus_bytes}
+    }
+    
+    processor = DocumentProcessor(parallel=args.parallel)
+    pages, parse_seconds = _timed(lambda: list(processor.iter_documents(uploads)))
+    results["parse"] = {
+        "pages": len(pages),
+        "seconds": parse_seconds,
+        "pages_per_second": len(pages) / parse_seconds if parse_seconds else None,
+        "mb_per_second": corpus_bytes / (1024 * 1024) / parse_seconds if parse_seconds else None,
+        "failed_files": len(processor.failed_files),
+        "peak_rss_mb": _peak_rss_mb()
+    }
+    
+    chunks, split_seconds = _timed(lambda: processor.split_documents(pages))
+    results["split"] = {
+        "chunks": len(chunks),
+        "seconds": split_seconds,
+        "chunks_per_second": len(chunks) / split_seconds if split_seconds else None,
+        "peak_rss_mb": _peak_rss_mb()
+    }
+    
+    embeddings = HashingEmbeddings(args.dimension)
+    manager = VectorStoreManager(embeddings=embeddings, vector_stores_dir=workdir, store_cache=LoadedStoreCache())
+    batches = [chunks[start:start + processor.batch_size] for start in range(0, len(chunks), processor.batch_size)]
+    # Ingest with an exact index and build the ANN index separately, so its cost is measured
+    # synchronously instead of in the background thread ingestion would start.
+    _, ingest_seconds = _timed(lambda: manager.ingest_document_batches(batches, args.store, index_spec="flat"))
+    _, ann_seconds = _timed(lambda: manager.rebuild_index(args.store, index_spec=args.index_spec))
+    store_info = manager.get_store_info(args.store)
+    store_path = workdir / args.store
+    results["index"] = {
+        "chunks": store_info["document_count"],
+        "duplicates_skipped": store_info["duplicate_count"],
+        "ingest_seconds": ingest_seconds,
+        "chunks_per_second": len(chunks) / ingest_seconds if ingest_seconds else None,
+        "ann_build_seconds": ann_seconds,
+        "index": store_info["index"],
+        "disk_bytes": sum(item.stat().st_size for item in store_path.rglob("*") if item.is_file()),
+        "peak_rss_mb": _peak_rss_mb()
+    }
+    
+    results["compression"] = manager.evaluate_compression(args.store, k=args.k, num_queries=min(args.queries, 200))
+    
+    # A fresh cache so the store is really read back from disk.
+    loader = VectorStoreManager(embeddings=embeddings, vector_stores_dir=workdir, store_cache=LoadedStoreCache())
+    vector_store, load_seconds = _timed(lambda: loader.load_vector_store(args.store))
+    results["load"] = {"seconds": load_seconds, "peak_rss_mb": _peak_rss_mb()}
+    
+    engine = RAGEngine(
+        llm=FakeListChatModel(responses=["This is a synthetic answer."]),
+        answer_cache=AnswerCache(max_entries=0)
+    )
+    qa_chain = engine.create_qa_chain(vector_store, k=args.k)
+    questions = corpus.questions(args.queries)
+    
+    retrieval_latencies = []
+    embedding_calls_before = embeddings.query_calls
+    for question in questions:
+        _, seconds = _timed(lambda: engine.retrieve(vector_store, question, k=args.k))
+        retrieval_latencies.append(seconds)
+    embedded_queries = embeddings.query_calls - embedding_calls_before
+    
+    query_latencies = []
+    failures = 0
+    for question in questions:
+        result, seconds = _timed(lambda: engine.query(qa_chain, question))
+        query_latencies.append(seconds)
+        failures += 0 if result["success"] else 1
+    
+    results["query"] = {
+        "retrieval": _latency_summary(retrieval_latencies),
+        "end_to_end": _latency_summary(query_latencies),
+        "failures": failures,
+        "embedding_skipped_fraction": 1 - embedded_queries / len(questions) if questions else None,
+        "peak_rss_mb": _peak_rss_mb()
+    }
+    results["peak_rss_mb"] = _peak_rss_mb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of parsing, indexing and querying with fake embeddings and LLM.")
+    parser.add_argument("--pdf-files", type=int, default=4, help="Number of synthetic PDF files")
+    parser.add_argument("--docx-files", type=int, default=2, help="Number of synthetic DOCX files")
+    parser.add_argument("--pages-per-file", type=int, default=50, help="Pages (or DOCX sections) per file")
+    parser.add_argument("--words-per-page", type=int, default=400, help="Approximate words per page")
+    parser.add_argument("--queries", type=int, default=200, help="Number of synthetic questions")
+    parser.add_argument("--k", type=int, default=4, help="Chunks retrieved per question")
+    parser.add_argument("--dimension", type=int, default=256, help="Dimension of the fake embeddings")
+    parser.add_argument("--index-spec", default="auto", help="Index type: flat, ivf-flat, ivf-pq, hnsw or auto")
+    parser.add_argument("--parallel", action="store_true", help="Parse on a process pool")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic corpus")
+    parser.add_argument("--store", default="benchmark", help="Name of the knowledge base created in the work directory")
+    parser.add_argument("--workdir", help="Directory to build the knowledge base in (default: a temporary directory)")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    
+    if args.workdir:
+        results = run_benchmark(args, Path(args.workdir))
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmark(args, Path(workdir))
+    
+    report = json.dumps(results, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(report + "\n", encoding="utf-8")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
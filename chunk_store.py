@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.schema import Document
+
+
+IDS_FILE = "ids.npy"
+TEXT_FILE = "text.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+METADATA_FILE = "metadata.bin"
+METADATA_OFFSETS_FILE = "metadata_offsets.npy"
+FILES_FILE = "files.json"
+
+
+def source_name(metadata: dict) -> str:
+    return metadata.get("filename") or metadata.get("source", "unknown")
+
+
+def _file_rows(documents: List[Document]) -> Dict[str, List[int]]:
+    file_rows: Dict[str, List[int]] = {}
+    for row, doc in enumerate(documents):
+        file_rows.setdefault(source_name(doc.metadata), []).append(row)
+    return file_rows
+
+
+def save_npy_durably(path: Path, array: np.ndarray):
+    with open(path, "wb") as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_chunk_segment(segment_dir: Path, ids: List[str], documents: List[Document]):
+    count = len(ids)
+    text_offsets = np.zeros(count + 1, dtype=np.int64)
+    metadata_offsets = np.zeros(count + 1, dtype=np.int64)
+    
+    with open(segment_dir / TEXT_FILE, "wb") as text_file, open(segment_dir / METADATA_FILE, "wb") as metadata_file:
+        for row, doc in enumerate(documents):
+            text = doc.page_content.encode("utf-8")
+            metadata = json.dumps(doc.metadata, separators=(",", ":"), default=str).encode("utf-8")
+            text_file.write(text)
+            metadata_file.write(metadata)
+            text_offsets[row + 1] = text_offsets[row] + len(text)
+            metadata_offsets[row + 1] = metadata_offsets[row] + len(metadata)
+        for f in (text_file, metadata_file):
+            f.flush()
+            os.fsync(f.fileno())
+    
+    save_npy_durably(segment_dir / TEXT_OFFSETS_FILE, text_offsets)
+    save_npy_durably(segment_dir / METADATA_OFFSETS_FILE, metadata_offsets)
+    save_npy_durably(segment_dir / IDS_FILE, np.array([chunk_id.encode("ascii") for chunk_id in ids], dtype=bytes))
+    # Rows per source file, so a file's chunks can be found without reading every chunk's metadata.
+    with open(segment_dir / FILES_FILE, "wb") as f:
+        f.write(json.dumps(_file_rows(documents)).encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _mmap_file(path: Path) -> Union[mmap.mmap, bytes]:
+    if path.stat().st_size == 0:
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ChunkSegment:
+    def __init__(self, segment_dir: Path):
+        self.path = Path(segment_dir)
+        self.ids = np.load(self.path / IDS_FILE, mmap_mode="r")
+        self._text_offsets = np.load(self.path / TEXT_OFFSETS_FILE, mmap_mode="r")
+        self._metadata_offsets = np.load(self.path / METADATA_OFFSETS_FILE, mmap_mode="r")
+        self._text = _mmap_file(self.path / TEXT_FILE)
+        self._metadata = _mmap_file(self.path / METADATA_FILE)
+        self._file_rows: Optional[Dict[str, List[int]]] = None
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def chunk_id(self, row: int) -> str:
+        return self.ids[row].decode("ascii")
+    
+    def chunk_ids(self) -> List[str]:
+        return [chunk_id.decode("ascii") for chunk_id in self.ids]
+    
+    def text(self, row: int) -> str:
+        return self._text[self._text_offsets[row]:self._text_offsets[row + 1]].decode("utf-8")
+    
+    def metadata(self, row: int) -> dict:
+        return json.loads(self._metadata[self._metadata_offsets[row]:self._metadata_offsets[row + 1]])
+    
+    def document(self, row: int) -> Document:
+        return Document(page_content=self.text(row), metadata=self.metadata(row))
+    
+    def iter_documents(self) -> Iterator[Tuple[str, Document]]:
+        for row in range(len(self)):
+            yield self.chunk_id(row), self.document(row)
+    
+    def file_rows(self) -> Dict[str, List[int]]:
+        if self._file_rows is None:
+            path = self.path / FILES_FILE
+            if path.exists():
+                with open(path, "r", encoding="utf-8") as f:
+                    self._file_rows = json.load(f)
+            else:
+                # Segments written before the per-file map existed are scanned once.
+                file_rows: Dict[str, List[int]] = {}
+                for row in range(len(self)):
+                    file_rows.setdefault(source_name(self.metadata(row)), []).append(row)
+                self._file_rows = file_rows
+        return self._file_rows
+
+
+class ChunkStore(Docstore, AddableMixin):
+    def __init__(self, segments: Optional[List[ChunkSegment]] = None):
+        self._segments: List[ChunkSegment] = []
+        self._deleted_rows: List[frozenset] = []
+        # id -> (segment, row) is only built on the first lookup, so opening a store
+        # doesn't touch every chunk. It is published only once complete, since a shared store
+        # may get its first lookups from several sessions at once.
+        self._locations: Optional[Dict[str, Tuple[int, int]]] = None
+        self._locations_lock = threading.Lock()
+        self._pending: Dict[str, Document] = {}
+        for segment in segments or []:
+            self.attach_segment(segment)
+    
+    def _index(self) -> Dict[str, Tuple[int, int]]:
+        locations = self._locations
+        if locations is None:
+            with self._locations_lock:
+                if self._locations is None:
+                    locations = {}
+                    for segment_index in range(len(self._segments)):
+                        self._index_segment(segment_index, locations)
+                    self._locations = locations
+                locations = self._locations
+        return locations
+    
+    def _index_segment(self, segment_index: int, locations: Dict[str, Tuple[int, int]]):
+        deleted_rows = self._deleted_rows[segment_index]
+        for row, chunk_id in enumerate(self._segments[segment_index].chunk_ids()):
+            if row not in deleted_rows:
+                locations[chunk_id] = (segment_index, row)
+    
+    def attach_segment(self, segment: ChunkSegment, deleted_rows: Iterable[int] = ()):
+        # deleted_rows are rows tombstoned on disk; they are never returned by search.
+        with self._locations_lock:
+            self._segments.append(segment)
+            self._deleted_rows.append(frozenset(int(row) for row in deleted_rows))
+            if self._locations is not None:
+                self._index_segment(len(self._segments) - 1, self._locations)
+        if self._pending:
+            for chunk_id in segment.chunk_ids():
+                self._pending.pop(chunk_id, None)
+    
+    def search(self, search: str) -> Union[str, Document]:
+        if search in self._pending:
+            return self._pending[search]
+        
+        location = self._index().get(search)
+        if location is None:
+            return f"ID {search} not found."
+        
+        segment_index, row = location
+        return self._segments[segment_index].document(row)
+    
+    def location(self, chunk_id: str) -> Optional[Tuple[int, int]]:
+        # (segment, row) of a live chunk; None if it was deleted or isn't in a segment yet.
+        return self._index().get(chunk_id)
+    
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = set(texts).intersection(self._pending)
+        overlapping.update(chunk_id for chunk_id in texts if chunk_id in self._index())
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self._pending.update(texts)
+    
+    def delete(self, ids: List) -> None:
+        locations = self._index()
+        for chunk_id in ids:
+            if self._pending.pop(chunk_id, None) is None and locations.pop(chunk_id, None) is None:
+                raise ValueError(f"ID {chunk_id} not found.")
+    
+    def __len__(self) -> int:
+        return len(self._index()) + len(self._pending)
\ No newline at end of file
@@ -0,0 +1,173 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import tiktoken
+from langchain.schema import Document
+
+from lexical_index import tokenize
+from metrics import metrics
+
+
+def _source_key(doc: Document) -> Tuple[str, object, object]:
+    # start_index is relative to the page, or to the section for Word documents.
+    return doc.metadata.get("filename") or doc.metadata.get("source", ""), doc.metadata.get("page"), doc.metadata.get("section_index")
+
+
+def _text_overlap(first: str, second: str, min_overlap: int, max_overlap: int) -> int:
+    # Length of the longest suffix of first that is also a prefix of second, which is what the
+    # splitter's chunk_overlap leaves between neighbouring chunks.
+    probe = second[:min_overlap]
+    if len(probe) < min_overlap:
+        return 0
+    tail_start = max(0, len(first) - max_overlap)
+    position = first.find(probe, tail_start)
+    while position != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        position = first.find(probe, position + 1)
+    return 0
+
+
+class ApproximateEncoding:
+    # Stands in for a tiktoken encoding that can't be loaded (tiktoken downloads its BPE files
+    # on first use): each token is a run of about four characters, roughly what cl100k averages
+    # on English text.
+    name = "approximate"
+    
+    def encode(self, text: str, **kwargs) -> List[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    
+    def decode(self, tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+
+def load_encoding(model_name: Optional[str] = None):
+    # The model's tiktoken encoding, or cl100k_base, or ApproximateEncoding when neither is
+    # available offline.
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name) if model_name else tiktoken.get_encoding("cl100k_base")
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return ApproximateEncoding()
+
+
+class ContextPacker:
+    # Turns retrieved chunks into the context that is sent to the LLM: chunks from the same
+    # page that overlap or touch are merged, optionally reordered with MMR, and packed into a
+    # token budget in relevance order.
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        model_name: str = "gpt-4-1106-preview",
+        mmr_lambda: Optional[float] = None,
+        max_gap: int = 2,
+        min_text_overlap: int = 20,
+        max_text_overlap: int = 1000
+    ):
+        self.max_tokens = max_tokens
+        self.mmr_lambda = mmr_lambda
+        self.max_gap = max_gap
+        self.min_text_overlap = min_text_overlap
+        self.max_text_overlap = max_text_overlap
+        self.encoding = load_encoding(model_name)
+    
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+    
+    def _merge_pair(self, first: Document, second: Document) -> Optional[Document]:
+        first_start = first.metadata.get("start_index")
+        second_start = second.metadata.get("start_index")
+        if first_start is not None and second_start is not None:
+            first_end = first_start + len(first.page_content)
+            gap = second_start - first_end
+            if second_start < first_start or gap > self.max_gap:
+                return None
+            if second_start + len(second.page_content) <= first_end:
+                text = first.page_content
+            elif gap > 0:
+                text = first.page_content + " " * gap + second.page_content
+            else:
+                text = first.page_content + second.page_content[-gap:]
+        else:
+            overlap = _text_overlap(first.page_content, second.page_content, self.min_text_overlap, self.max_text_overlap)
+            if not overlap:
+                return None
+            text = first.page_content + second.page_content[overlap:]
+        
+        metadata = dict(first.metadata)
+        metadata["merged_chunks"] = first.metadata.get("merged_chunks", 1) + second.metadata.get("merged_chunks", 1)
+        return Document(page_content=text, metadata=metadata)
+    
+    def merge(self, documents: List[Document]) -> List[Document]:
+        # Each merged document keeps the rank of its best-ranked chunk.
+        groups: Dict[Tuple[str, object, object], List[Tuple[int, Document]]] = {}
+        for rank, doc in enumerate(documents):
+            groups.setdefault(_source_key(doc), []).append((rank, doc))
+        
+        merged: List[Tuple[int, Document]] = []
+        for group in groups.values():
+            group.sort(key=lambda item: (item[1].metadata.get("start_index", -1), item[0]))
+            changed = True
+            while changed:
+                changed = False
+                for i in range(len(group)):
+                    for j in range(len(group)):
+                        if i == j:
+                            continue
+                        combined = self._merge_pair(group[i][1], group[j][1])
+                        if combined is not None:
+                            group[i] = (min(group[i][0], group[j][0]), combined)
+                            del group[j]
+                            changed = True
+                            break
+                    if changed:
+                        break
+            merged.extend(group)
+        
+        merged.sort(key=lambda item: item[0])
+        return [doc for _, doc in merged]
+    
+    def _mmr_order(self, documents: List[Document]) -> List[Document]:
+        # Relevance is taken from the retrieval rank and similarity is term overlap, so no chunk
+        # vectors are needed at this stage.
+        term_sets = [set(tokenize(doc.page_content)) for doc in documents]
+        relevance = [1.0 - rank / len(documents) for rank in range(len(documents))]
+        selected: List[int] = []
+        remaining = list(range(len(documents)))
+        while remaining:
+            def score(i: int) -> float:
+                redundancy = max(
+                    (len(term_sets[i] & term_sets[j]) / (len(term_sets[i] | term_sets[j]) or 1) for j in selected),
+                    default=0.0
+                )
+                return self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * redundancy
+            best = max(remaining, key=score)
+            selected.append(best)
+            remaining.remove(best)
+        return [documents[i] for i in selected]
+    
+    def pack(self, documents: List[Document]) -> List[Document]:
+        merged = self.merge(documents)
+        if self.mmr_lambda is not None and len(merged) > 1:
+            merged = self._mmr_order(merged)
+        
+        packed: List[Document] = []
+        used_tokens = 0
+        for doc in merged:
+            if any(doc.page_content in kept.page_content for kept in packed):
+                continue
+            tokens = self.count_tokens(doc.page_content)
+            if used_tokens + tokens <= self.max_tokens:
+                packed.append(doc)
+                used_tokens += tokens
+            elif not packed:
+                # A single chunk larger than the whole budget is cut rather than dropped.
+                text = self.encoding.decode(self.encoding.encode(doc.page_content, disallowed_special=())[:self.max_tokens])
+                packed.append(Document(page_content=text, metadata={**doc.metadata, "truncated": True}))
+                used_tokens = self.max_tokens
+        
+        metrics.increment("context_tokens", used_tokens)
+        metrics.increment("context_chunks", len(packed))
+        metrics.increment("context_chunks_merged", len(documents) - len(merged))
+        return packed
\ No newline at end of file
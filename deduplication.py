@@ -0,0 +1,132 @@
+import json
+import re
+import threading
+import zlib
+from collections import defaultdict
+from pathlib import Path
+from typing import Collection, Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from chunk_store import save_npy_durably
+
+
+SIGNATURES_FILE = "minhash.npy"
+DUPLICATES_FILE = "duplicates.json"
+
+NUM_PERMUTATIONS = 64
+SHINGLE_SIZE = 3
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    # MinHash over word shingles: two chunks' signatures agree in about as many positions as
+    # the Jaccard similarity of their shingle sets, whatever their length.
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    permuted = (hashes[:, None] * _PERM_A + _PERM_B) % _MERSENNE_PRIME
+    return (permuted & np.uint64(0xFFFFFFFF)).min(axis=0).astype(np.uint32)
+
+
+def minhash_signatures(texts: List[str]) -> np.ndarray:
+    if not texts:
+        return np.zeros((0, NUM_PERMUTATIONS), dtype=np.uint32)
+    return np.stack([minhash_signature(text) for text in texts])
+
+
+def write_segment_signatures(segment_dir: Path, texts: List[str]) -> np.ndarray:
+    signatures = minhash_signatures(texts)
+    save_npy_durably(Path(segment_dir) / SIGNATURES_FILE, signatures)
+    return signatures
+
+
+def load_segment_signatures(segment) -> np.ndarray:
+    path = segment.path / SIGNATURES_FILE
+    if path.exists():
+        return np.load(path, mmap_mode="r")
+    # Segments written before deduplication existed get their signatures computed on first use.
+    signatures = minhash_signatures([segment.text(row) for row in range(len(segment))])
+    try:
+        save_npy_durably(path, signatures)
+    except OSError:
+        pass
+    return signatures
+
+
+def load_segment_links(segment) -> Dict[int, str]:
+    # Row -> id of the chunk it duplicates, for the near-duplicate rows of a segment. Entries
+    # without a row come from segments that left duplicates out instead of storing them.
+    path = segment.path / DUPLICATES_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return {int(entry["row"]): entry["duplicate_of"] for entry in json.load(f) if "row" in entry}
+
+
+class NearDuplicateIndex:
+    # Locality-sensitive hashing over MinHash signatures: signatures are split into bands and
+    # only chunks sharing a band bucket are compared.
+    def __init__(self, threshold: float = 0.9, bands: int = 8):
+        if NUM_PERMUTATIONS % bands:
+            raise ValueError(f"bands must divide {NUM_PERMUTATIONS}")
+        self.threshold = threshold
+        self.bands = bands
+        self._rows = NUM_PERMUTATIONS // bands
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+        self._keys: List[Hashable] = []
+        self._signatures: List[np.ndarray] = []
+        self._removed: Set[Hashable] = set()
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._keys)
+    
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [
+            (band, signature[band * self._rows:(band + 1) * self._rows].tobytes())
+            for band in range(self.bands)
+        ]
+    
+    def add(self, key: Hashable, signature: np.ndarray):
+        signature = np.asarray(signature, dtype=np.uint32)
+        with self._lock:
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._signatures.append(signature)
+            for band_key in self._band_keys(signature):
+                self._buckets[band_key].append(slot)
+    
+    def add_many(self, keys: List[Hashable], signatures: np.ndarray):
+        for key, signature in zip(keys, signatures):
+            self.add(key, signature)
+    
+    def remove(self, keys: Collection[Hashable]):
+        # Removed keys stay in their buckets but are never returned as a match again.
+        with self._lock:
+            self._removed.update(keys)
+    
+    def find(
+        self,
+        signature: np.ndarray,
+        threshold: Optional[float] = None,
+        exclude: Collection[Hashable] = ()
+    ) -> Optional[Tuple[Hashable, float]]:
+        threshold = self.threshold if threshold is None else threshold
+        signature = np.asarray(signature, dtype=np.uint32)
+        with self._lock:
+            candidates = {slot for band_key in self._band_keys(signature) for slot in self._buckets.get(band_key, ())}
+            best = None
+            for slot in candidates:
+                if self._keys[slot] in self._removed or self._keys[slot] in exclude:
+                    continue
+                similarity = float(np.mean(self._signatures[slot] == signature))
+                if similarity >= threshold and (best is None or similarity > best[1]):
+                    best = (self._keys[slot], similarity)
+            return best
\ No newline at end of file
@@ -1,69 +1,430 @@
+import hashlib
+import multiprocessing
 import os
+import re
 import tempfile
-from typing import List, Optional
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from io import BytesIO
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from pathlib import Path
+from xml.etree import ElementTree
 
-from langchain.document_loaders import PyPDFLoader
+from PyPDF2 import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-from docx import Document as DocxDocument
+
+from metrics import metrics
+
+
+SUPPORTED_FILE_TYPES = ['pdf', 'docx', 'doc']
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def file_content_hash(data: bytes) -> str:
+    # Identifies a version of an uploaded file; stores use it to skip re-uploads of unchanged files.
+    return hashlib.sha256(data).hexdigest()
+
+
+def _docx_heading_levels(archive: zipfile.ZipFile) -> Dict[str, int]:
+    # Paragraph style id -> heading level (0 for Title). Custom heading styles usually carry an
+    # outline level; the built-in ones are recognised by name, since their ids are localised.
+    try:
+        styles = ElementTree.fromstring(archive.read("word/styles.xml"))
+    except KeyError:
+        return {}
+    levels = {}
+    for style in styles.iter(f"{_W}style"):
+        style_id = style.get(f"{_W}styleId")
+        name_element = style.find(f"{_W}name")
+        name = (name_element.get(f"{_W}val") or "").lower() if name_element is not None else ""
+        outline = style.find(f"{_W}pPr/{_W}outlineLvl")
+        heading = re.fullmatch(r"heading\s*(\d)", name)
+        if outline is not None and int(outline.get(f"{_W}val", 9)) < 9:
+            levels[style_id] = int(outline.get(f"{_W}val")) + 1
+        elif heading:
+            levels[style_id] = int(heading.group(1))
+        elif name == "title":
+            levels[style_id] = 0
+    return levels
+
+
+def _docx_paragraph_text(paragraph: ElementTree.Element) -> Tuple[str, int]:
+    # The paragraph's text and the number of explicit page breaks in it. Deleted revisions
+    # (w:delText) and field codes (w:instrText) are not w:t, so they are skipped.
+    parts = []
+    page_breaks = 0
+    for node in paragraph.iter():
+        if node.tag == f"{_W}t":
+            parts.append(node.text or "")
+        elif node.tag == f"{_W}tab":
+            parts.append("\t")
+        elif node.tag in (f"{_W}br", f"{_W}cr"):
+            if node.get(f"{_W}type") == "page":
+                page_breaks += 1
+            else:
+                parts.append("\n")
+    return "".join(parts), page_breaks
+
+
+def _docx_heading_level(paragraph: ElementTree.Element, style_levels: Dict[str, int]) -> Optional[int]:
+    properties = paragraph.find(f"{_W}pPr")
+    if properties is None:
+        return None
+    outline = properties.find(f"{_W}outlineLvl")
+    if outline is not None:
+        level = int(outline.get(f"{_W}val", 9))
+        return level + 1 if level < 9 else None
+    style = properties.find(f"{_W}pStyle")
+    return style_levels.get(style.get(f"{_W}val")) if style is not None else None
+
+
+def _docx_table_text(table: ElementTree.Element) -> str:
+    # One line per row with cells separated by " | "; a nested table's text stays in its cell.
+    rows = []
+    for row in table.findall(f"{_W}tr"):
+        cells = [
+            " ".join(text for text, _ in map(_docx_paragraph_text, cell.iter(f"{_W}p")) if text).strip()
+            for cell in row.findall(f"{_W}tc")
+        ]
+        if any(cells):
+            rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+
+def _ordered_results(executor: Executor, fn: Callable, tasks: Iterable, window: int) -> Iterator[Any]:
+    # Like executor.map, but only submits the next task once the oldest result is taken, keeping
+    # window tasks in flight instead of submitting all of them up front. Results are yielded in
+    # task order.
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, task))
+    while pending:
+        yield pending.popleft().result()
 
 
 class DocumentProcessor:
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(
+        self,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+        batch_size: int = 256,
+        parallel: bool = False,
+        max_workers: Optional[int] = None,
+        pages_per_task: int = 50,
+        max_section_chars: int = 100_000
+    ):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
             length_function=len,
+            # Lets RAGEngine merge neighbouring chunks back together when packing the context.
+            add_start_index=True,
         )
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pages_per_task = pages_per_task
+        self.max_section_chars = max_section_chars
+        self.failed_files: List[Tuple[str, str]] = []
+    
+    def iter_pdf_pages(
+        self,
+        source: Union[str, BinaryIO],
+        source_name: Optional[str] = None,
+        start_page: int = 0,
+        end_page: Optional[int] = None
+    ) -> Iterator[Document]:
+        reader = PdfReader(source)
+        source_name = source_name or str(source)
+        end_page = len(reader.pages) if end_page is None else min(end_page, len(reader.pages))
+        for page_number in range(start_page, end_page):
+            started = time.perf_counter()
+            text = reader.pages[page_number].extract_text() or ""
+            metrics.observe("parse_page", time.perf_counter() - started, file_type="pdf")
+            metrics.increment("pages_parsed", file_type="pdf")
+            yield Document(page_content=text, metadata={"source": source_name, "page": page_number})
     
-    def load_pdf(self, file_path: str) -> List[Document]:
-        loader = PyPDFLoader(file_path)
-        return loader.load()
+    def load_pdf(self, file_path: Union[str, BinaryIO], source_name: Optional[str] = None) -> List[Document]:
+        return list(self.iter_pdf_pages(file_path, source_name))
     
-    def load_docx(self, file_path: str) -> List[Document]:
-        doc = DocxDocument(file_path)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
+    def iter_docx_sections(self, source: Union[str, BinaryIO], source_name: Optional[str] = None) -> Iterator[Document]:
+        # Streams word/document.xml with iterparse and yields one Document per heading section,
+        # tables included, discarding each paragraph once it is read, so time and memory stay
+        # linear in the file size. A section longer than max_section_chars is yielded in parts.
+        source_name = source_name or str(source)
+        started = time.perf_counter()
+        headings: List[Tuple[int, str]] = []
+        parts: List[str] = []
+        size = 0
+        section_index = 0
+        page = 0
+        section_page = 0
+        
+        def section() -> Optional[Document]:
+            text = "\n".join(parts)
+            if not text.strip():
+                return None
+            metadata = {"source": source_name, "page": section_page, "section_index": section_index}
+            if headings:
+                metadata["section"] = headings[-1][1]
+                metadata["section_path"] = " > ".join(heading for _, heading in headings)
+                metadata["heading_level"] = headings[-1][0]
+            metrics.increment("pages_parsed", file_type="docx")
+            return Document(page_content=text, metadata=metadata)
         
-        return [Document(page_content=text, metadata={"source": file_path})]
+        with zipfile.ZipFile(source) as archive:
+            style_levels = _docx_heading_levels(archive)
+            with archive.open("word/document.xml") as xml:
+                body = None
+                depth = 0
+                table_depth = 0
+                for event, element in ElementTree.iterparse(xml, events=("start", "end")):
+                    if event == "start":
+                        depth += 1
+                        if element.tag == f"{_W}body":
+                            body = element
+                        elif element.tag == f"{_W}tbl":
+                            table_depth += 1
+                        continue
+                    
+                    depth -= 1
+                    text = None
+                    if element.tag == f"{_W}tbl":
+                        table_depth -= 1
+                        if not table_depth:
+                            text = _docx_table_text(element)
+                            element.clear()
+                    elif element.tag == f"{_W}p" and not table_depth:
+                        text, page_breaks = _docx_paragraph_text(element)
+                        level = _docx_heading_level(element, style_levels)
+                        if level is not None and text.strip():
+                            document = section()
+                            if document is not None:
+                                yield document
+                                section_index += 1
+                            parts, size, section_page = [], 0, page
+                            while headings and headings[-1][0] >= level:
+                                headings.pop()
+                            headings.append((level, text.strip()))
+                        page += page_breaks
+                        element.clear()
+                    
+                    if text:
+                        parts.append(text)
+                        size += len(text) + 1
+                        if size >= self.max_section_chars:
+                            document = section()
+                            if document is not None:
+                                yield document
+                                section_index += 1
+                            parts, size, section_page = [], 0, page
+                    # Blocks already read are detached from the body so the tree never grows.
+                    if depth == 2 and body is not None and element is not body:
+                        body.remove(element)
+        
+        document = section()
+        if document is not None:
+            yield document
+        metrics.observe("parse_file", time.perf_counter() - started, file_type="docx")
     
-    def process_uploaded_file(self, uploaded_file, file_type: str) -> List[Document]:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_type}') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
+    def load_docx(self, file_path: Union[str, BinaryIO], source_name: Optional[str] = None) -> List[Document]:
+        return list(self.iter_docx_sections(file_path, source_name))
+    
+    def iter_uploaded_file(self, uploaded_file, file_type: str) -> Iterator[Document]:
+        # Streamlit's UploadedFile is already an in-memory BytesIO, so parse it directly instead of
+        # copying it to a temporary file first.
+        stream = uploaded_file if hasattr(uploaded_file, 'seek') else BytesIO(uploaded_file.getvalue())
+        stream.seek(0)
         
-        try:
-            if file_type.lower() == 'pdf':
-                documents = self.load_pdf(tmp_file_path)
-            elif file_type.lower() in ['docx', 'doc']:
-                documents = self.load_docx(tmp_file_path)
-            else:
-                raise ValueError(f"Unsupported file type: {file_type}")
-            
-            for doc in documents:
-                doc.metadata['filename'] = uploaded_file.name
-            
-            return documents
-        finally:
-            os.unlink(tmp_file_path)
+        if file_type.lower() == 'pdf':
+            documents = self.iter_pdf_pages(stream, uploaded_file.name)
+        elif file_type.lower() in ['docx', 'doc']:
+            documents = self.iter_docx_sections(stream, uploaded_file.name)
+        else:
+            raise ValueError(f"Unsupported file type: {file_type}")
+        
+        file_hash = file_content_hash(uploaded_file.getvalue())
+        for doc in documents:
+            doc.metadata['filename'] = uploaded_file.name
+            doc.metadata['file_hash'] = file_hash
+            yield doc
+    
+    def process_uploaded_file(self, uploaded_file, file_type: str) -> List[Document]:
+        return list(self.iter_uploaded_file(uploaded_file, file_type))
     
     def split_documents(self, documents: List[Document]) -> List[Document]:
         return self.text_splitter.split_documents(documents)
     
-    def process_documents(self, uploaded_files) -> List[Document]:
-        all_documents = []
+    def iter_documents(self, uploaded_files) -> Iterator[Document]:
+        if self.parallel:
+            yield from self.iter_documents_parallel(uploaded_files)
+            return
         
         for uploaded_file in uploaded_files:
             file_extension = uploaded_file.name.split('.')[-1].lower()
             
-            if file_extension in ['pdf', 'docx', 'doc']:
-                documents = self.process_uploaded_file(uploaded_file, file_extension)
-                all_documents.extend(documents)
-            else:
+            if file_extension not in SUPPORTED_FILE_TYPES:
                 raise ValueError(f"Unsupported file format: {file_extension}")
+            
+            yield from self.iter_uploaded_file(uploaded_file, file_extension)
+    
+    def _plan_parse_tasks(self, uploaded_files, tmp_dir: Path) -> List[tuple]:
+        tasks = []
+        
+        for file_index, uploaded_file in enumerate(uploaded_files):
+            file_type = uploaded_file.name.split('.')[-1].lower()
+            if file_type not in SUPPORTED_FILE_TYPES:
+                self.failed_files.append((uploaded_file.name, f"Unsupported file format: {file_type}"))
+                continue
+            
+            # Workers read the upload from a shared temp file rather than receiving a pickled
+            # copy of its bytes for every page range.
+            file_path = tmp_dir / f"{file_index}.{file_type}"
+            data = uploaded_file.getvalue()
+            file_path.write_bytes(data)
+            file_hash = file_content_hash(data)
+            
+            page_ranges = [(0, None)]
+            if file_type == 'pdf':
+                try:
+                    page_count = len(PdfReader(str(file_path)).pages)
+                except Exception as e:
+                    self.failed_files.append((uploaded_file.name, f"{type(e).__name__}: {e}"))
+                    continue
+                page_ranges = [
+                    (start, start + self.pages_per_task)
+                    for start in range(0, page_count, self.pages_per_task)
+                ] or [(0, 0)]
+            
+            for range_index, (start_page, end_page) in enumerate(page_ranges):
+                is_last = range_index == len(page_ranges) - 1
+                tasks.append((file_index, str(file_path), uploaded_file.name, file_type, start_page, end_page, is_last, file_hash))
+        
+        return tasks
+    
+    def iter_documents_parallel(self, uploaded_files) -> Iterator[Document]:
+        self.failed_files = []
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tasks = self._plan_parse_tasks(uploaded_files, Path(tmp_dir))
+            if not tasks:
+                return
+            
+            workers = min(self.max_workers, len(tasks))
+            # Workers are spawned rather than forked: the app forks from a process with embedding,
+            # search and job threads running, and a child can inherit a lock one of them held.
+            executor = (
+                ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                if len(tasks) > 1 else None
+            )
+            try:
+                # At most two ranges per worker are in flight, so parsed pages that the consumer
+                # hasn't reached yet don't pile up in memory for a large upload.
+                results = (
+                    _ordered_results(executor, _parse_file_range, tasks, window=2 * workers)
+                    if executor else map(_parse_file_range, tasks)
+                )
+                
+                # A file's pages are only released once every one of its ranges parsed cleanly,
+                # so a corrupt file is skipped as a whole instead of being half-indexed.
+                file_documents = []
+                file_error = None
+                for task, (documents, error, seconds) in zip(tasks, results):
+                    filename, file_type, is_last = task[2], task[3], task[6]
+                    # Workers can't update this process's metrics, so their timings come back with the pages.
+                    # A lone task is parsed in this process and has counted its pages already.
+                    metrics.observe("parse_range", seconds, file_type=file_type)
+                    if executor:
+                        metrics.increment("pages_parsed", len(documents), file_type=file_type)
+                    if error and file_error is None:
+                        file_error = error
+                    file_documents.extend(documents)
+                    
+                    if is_last:
+                        if file_error:
+                            metrics.increment("files_failed")
+                            self.failed_files.append((filename, file_error))
+                        else:
+                            yield from file_documents
+                        file_documents = []
+                        file_error = None
+            finally:
+                if executor:
+                    executor.shutdown(cancel_futures=True)
+    
+    def iter_chunk_batches(
+        self,
+        uploaded_files,
+        batch_size: Optional[int] = None,
+        on_progress: Optional[Callable[[dict], None]] = None
+    ) -> Iterator[List[Document]]:
+        # on_progress receives the files, pages, chunks and batches handled so far, after
+        # every file and every batch.
+        batch_size = batch_size or self.batch_size
+        uploaded_files = list(uploaded_files)
+        self.failed_files = []
+        progress = {"files_total": len(uploaded_files), "files_done": 0, "pages": 0, "chunks": 0, "batches": 0}
+        current_file = None
+        batch = []
+        
+        def report():
+            if on_progress:
+                on_progress(dict(progress, files_done=progress["files_done"] + len(self.failed_files)))
+        
+        for page in self.iter_documents(uploaded_files):
+            filename = page.metadata.get("filename")
+            if current_file is not None and filename != current_file:
+                progress["files_done"] += 1
+                report()
+            current_file = filename
+            progress["pages"] += 1
+            
+            started = time.perf_counter()
+            chunks = self.text_splitter.split_documents([page])
+            metrics.observe("split_page", time.perf_counter() - started)
+            metrics.increment("chunks_created", len(chunks))
+            progress["chunks"] += len(chunks)
+            
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) >= batch_size:
+                    progress["batches"] += 1
+                    report()
+                    yield batch
+                    batch = []
+        
+        if batch:
+            progress["batches"] += 1
+            yield batch
+        if current_file is not None:
+            progress["files_done"] += 1
+        report()
+    
+    def process_documents(self, uploaded_files) -> List[Document]:
+        return [chunk for batch in self.iter_chunk_batches(uploaded_files) for chunk in batch]
+
+
+def _parse_file_range(task: tuple) -> Tuple[List[Document], Optional[str], float]:
+    _, file_path, filename, file_type, start_page, end_page, _, file_hash = task
+    started = time.perf_counter()
+    try:
+        processor = DocumentProcessor()
+        if file_type == 'pdf':
+            documents = list(processor.iter_pdf_pages(file_path, filename, start_page, end_page))
+        else:
+            documents = processor.load_docx(file_path, filename)
         
-        return self.split_documents(all_documents)
\ No newline at end of file
+        for doc in documents:
+            doc.metadata['filename'] = filename
+            doc.metadata['file_hash'] = file_hash
+        return documents, None, time.perf_counter() - started
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}", time.perf_counter() - started
\ No newline at end of file
@@ -0,0 +1,140 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from metrics import metrics
+
+
+class EmbeddingCache:
+    _QUERY_BATCH = 500
+    
+    def __init__(self, db_path: str = "vector_stores/embedding_cache.sqlite", max_size_bytes: int = 2 * 1024 ** 3):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+        self._conn.commit()
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+    
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        hashes = [self.text_hash(text) for text in texts]
+        found = {}
+        now = time.time()
+        
+        with self._lock:
+            unique_hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique_hashes), self._QUERY_BATCH):
+                batch = unique_hashes[start:start + self._QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+            
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, text_hash) for text_hash in found]
+                )
+                self._conn.commit()
+            
+            results = [found.get(text_hash) for text_hash in hashes]
+            hit_count = sum(1 for vector in results if vector is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        metrics.increment("embedding_cache_lookups", hit_count, result="hit")
+        metrics.increment("embedding_cache_lookups", len(results) - hit_count, result="miss")
+        
+        return results
+    
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        if len(texts) != len(vectors):
+            raise ValueError("texts and vectors must have the same length")
+        
+        now = time.time()
+        with self._lock:
+            added_bytes = 0
+            for text, vector in zip(texts, vectors):
+                blob = np.asarray(vector, dtype=np.float32).tobytes()
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (model, self.text_hash(text), blob, len(blob), now)
+                )
+                if cursor.rowcount:
+                    added_bytes += len(blob)
+            self._conn.commit()
+            self._size_bytes += added_bytes
+            
+            if self._size_bytes > self.max_size_bytes:
+                self._evict()
+    
+    def _evict(self):
+        # Drop least recently used entries until the cache is back under 90% of its budget,
+        # so a full cache doesn't evict on every single insert.
+        target = int(self.max_size_bytes * 0.9)
+        to_delete = []
+        freed = 0
+        for model, text_hash, size in self._conn.execute(
+            "SELECT model, text_hash, size FROM embeddings ORDER BY last_access"
+        ):
+            if self._size_bytes - freed <= target:
+                break
+            to_delete.append((model, text_hash))
+            freed += size
+        
+        self._conn.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", to_delete)
+        self._conn.commit()
+        self._size_bytes -= freed
+        self.evictions += len(to_delete)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": self._size_bytes,
+                "max_size_bytes": self.max_size_bytes
+            }
+    
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._size_bytes = 0
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
\ No newline at end of file
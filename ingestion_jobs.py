@@ -0,0 +1,308 @@
+import json
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Union
+
+from langchain.schema import Document
+
+from document_processor import DocumentProcessor
+from metrics import metrics
+from vector_store_manager import VectorStoreManager, shared_vector_store_manager
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class SpooledUpload:
+    # An uploaded file kept on disk for a job; DocumentProcessor only needs name and getvalue().
+    def __init__(self, path: Path, name: str):
+        self.path = path
+        self.name = name
+    
+    def getvalue(self) -> bytes:
+        return self.path.read_bytes()
+
+
+class IngestionJobQueue:
+    # Runs document ingestion in background worker threads, outside any Streamlit script run.
+    # Jobs live in sqlite and their files are spooled to disk, so a job survives the browser
+    # going away and is picked up again after a restart. At most one job per knowledge base runs
+    # at a time; jobs for different knowledge bases run side by side, up to max_workers.
+    def __init__(
+        self,
+        vector_store_manager: VectorStoreManager,
+        document_processor_factory: Callable[[], DocumentProcessor] = lambda: DocumentProcessor(parallel=True),
+        db_path: Union[str, Path] = "vector_stores/ingestion_jobs.sqlite",
+        max_workers: int = 2,
+        poll_interval: float = 1.0
+    ):
+        self.vector_store_manager = vector_store_manager
+        self.document_processor_factory = document_processor_factory
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.spool_dir = self.db_path.parent / "ingestion_uploads"
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                store_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                index_spec TEXT NOT NULL,
+                files TEXT NOT NULL,
+                new_files TEXT,
+                progress TEXT NOT NULL DEFAULT '{}',
+                stats TEXT NOT NULL DEFAULT '{}',
+                failed_files TEXT NOT NULL DEFAULT '[]',
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        # Jobs that were running when the process stopped are started over; what they had
+        # already indexed is rolled back first, when the job is claimed again.
+        self._conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        self._conn.commit()
+        
+        self._workers = [
+            threading.Thread(target=self._work, name=f"ingestion-worker-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+    
+    def submit(self, store_name: str, uploaded_files, index_spec: Union[str, dict] = "auto") -> str:
+        job_id = uuid.uuid4().hex
+        job_dir = self.spool_dir / job_id
+        job_dir.mkdir(parents=True, exist_ok=True)
+        names = []
+        for i, uploaded_file in enumerate(uploaded_files):
+            (job_dir / str(i)).write_bytes(uploaded_file.getvalue())
+            names.append(uploaded_file.name)
+        
+        with self._wakeup:
+            self._conn.execute(
+                "INSERT INTO jobs (id, store_name, status, index_spec, files, progress, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, store_name, QUEUED, json.dumps(index_spec), json.dumps(names),
+                 json.dumps({"files_total": len(names)}), time.time())
+            )
+            self._conn.commit()
+            self._wakeup.notify()
+        metrics.increment("ingestion_jobs", status="submitted")
+        return job_id
+    
+    @staticmethod
+    def _to_job(columns: List[str], row: tuple) -> dict:
+        job = dict(zip(columns, row))
+        for field in ("files", "progress", "stats", "failed_files"):
+            job[field] = json.loads(job[field])
+        job["index_spec"] = json.loads(job["index_spec"])
+        job["new_files"] = json.loads(job["new_files"]) if job["new_files"] else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+    
+    def _select(self, where: str = "", params: tuple = ()) -> List[dict]:
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT * FROM jobs {where}", params)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        return [self._to_job(columns, row) for row in rows]
+    
+    def get(self, job_id: str) -> Optional[dict]:
+        jobs = self._select("WHERE id = ?", (job_id,))
+        return jobs[0] if jobs else None
+    
+    def list_jobs(self, store_name: Optional[str] = None, active_only: bool = False, limit: int = 20) -> List[dict]:
+        conditions, params = [], []
+        if store_name is not None:
+            conditions.append("store_name = ?")
+            params.append(store_name)
+        if active_only:
+            conditions.append(f"status IN ({','.join('?' * len(ACTIVE_STATUSES))})")
+            params.extend(ACTIVE_STATUSES)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        return self._select(f"{where}ORDER BY created_at DESC LIMIT ?", (*params, limit))
+    
+    def cancel(self, job_id: str) -> bool:
+        # A queued job is cancelled right away; a running one stops at its next file or batch
+        # and rolls back the files it had started to add.
+        with self._lock:
+            was_queued = self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED)
+            ).rowcount
+            was_running = not was_queued and self._conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, RUNNING)
+            ).rowcount
+            self._conn.commit()
+        if was_queued:
+            shutil.rmtree(self.spool_dir / job_id, ignore_errors=True)
+        return bool(was_queued or was_running)
+    
+    def shutdown(self, wait: bool = True):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+    
+    def _claim(self) -> Optional[dict]:
+        # The oldest queued job whose knowledge base has no job running.
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT id FROM jobs WHERE status = ? AND store_name NOT IN (
+                    SELECT store_name FROM jobs WHERE status = ?
+                ) ORDER BY created_at LIMIT 1""",
+                (QUEUED, RUNNING)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE jobs SET status = ?, started_at = ? WHERE id = ?", (RUNNING, time.time(), row[0]))
+            self._conn.commit()
+        return self.get(row[0])
+    
+    def _update(self, job_id: str, **fields):
+        for field in ("progress", "stats", "failed_files", "new_files"):
+            if field in fields:
+                fields[field] = json.dumps(fields[field])
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                (*fields.values(), job_id)
+            )
+            self._conn.commit()
+    
+    def _cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+    
+    def _work(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            job = self._claim()
+            if job is None:
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(self.poll_interval)
+                continue
+            self._run(job)
+            # Finishing a job may unblock a queued job for the same knowledge base.
+            with self._wakeup:
+                self._wakeup.notify()
+    
+    def _rollback(self, job: dict):
+        # Files that were not in the knowledge base before the job are removed again, so a
+        # cancelled, failed or interrupted job leaves no half-indexed file behind (which would
+        # otherwise look unchanged when uploaded again). Changed files are only replaced at the
+        # very end of a job, so their previous version is still intact.
+        present = self.vector_store_manager.get_file_hashes(job["store_name"])
+        for filename in job["new_files"] or ():
+            if filename in present:
+                self.vector_store_manager.delete_file(job["store_name"], filename)
+    
+    def _run(self, job: dict):
+        job_id, store_name = job["id"], job["store_name"]
+        manager = self.vector_store_manager
+        if job["new_files"] is not None:
+            self._rollback(job)
+        known_files = manager.get_file_hashes(store_name)
+        new_files = [name for name in job["files"] if name not in known_files]
+        self._update(job_id, new_files=new_files)
+        job["new_files"] = new_files
+        
+        processor = self.document_processor_factory()
+        # Each job counts into its own Counter; the manager is shared by every worker.
+        ingest_stats = Counter()
+        progress = dict(job["progress"])
+        stats = {}
+        
+        def check_cancelled():
+            if self._cancel_requested(job_id):
+                raise JobCancelled()
+        
+        def on_parse_progress(update):
+            progress.update(update)
+            self._update(job_id, progress=progress)
+            check_cancelled()
+        
+        def on_batch(update):
+            stats.update(update)
+            self._update(job_id, stats=stats)
+        
+        def cancellable(batches) -> Iterator[List[Document]]:
+            for batch in batches:
+                check_cancelled()
+                yield batch
+        
+        job_dir = self.spool_dir / job_id
+        uploads = [SpooledUpload(job_dir / str(i), name) for i, name in enumerate(job["files"])]
+        started = time.perf_counter()
+        try:
+            batches = cancellable(processor.iter_chunk_batches(uploads, on_progress=on_parse_progress))
+            vector_store = manager.load_vector_store(store_name)
+            if vector_store is None and store_name in manager.list_available_stores():
+                # The knowledge base exists but couldn't be loaded; adding to it as if it were new
+                # would replace it.
+                raise RuntimeError(f"Knowledge base {store_name} could not be loaded")
+            manager.ingest_document_batches(
+                batches, store_name, vector_store,
+                index_spec=job["index_spec"],
+                on_batch=on_batch,
+                stats=ingest_stats
+            )
+            status, error = DONE, None
+        except JobCancelled:
+            self._rollback(job)
+            status, error = CANCELLED, None
+        except Exception as e:
+            self._rollback(job)
+            status, error = FAILED, f"{type(e).__name__}: {e}"
+        
+        metrics.observe("ingestion_job", time.perf_counter() - started, status=status)
+        self._update(
+            job_id,
+            status=status,
+            error=error,
+            stats=dict(ingest_stats),
+            failed_files=processor.failed_files,
+            finished_at=time.time()
+        )
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+_shared_queue: Optional[IngestionJobQueue] = None
+_shared_queue_lock = threading.Lock()
+
+
+def shared_ingestion_queue(**kwargs) -> IngestionJobQueue:
+    # One queue per process, shared by every session; kwargs only apply when it is created.
+    global _shared_queue
+    with _shared_queue_lock:
+        if _shared_queue is None:
+            _shared_queue = IngestionJobQueue(shared_vector_store_manager(), **kwargs)
+        return _shared_queue
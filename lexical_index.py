@@ -0,0 +1,226 @@
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from chunk_store import save_npy_durably
+
+
+TERMS_FILE = "lexical_terms.txt"
+OFFSETS_FILE = "lexical_offsets.npy"
+ROWS_FILE = "lexical_rows.npy"
+FREQUENCIES_FILE = "lexical_tfs.npy"
+LENGTHS_FILE = "lexical_lengths.npy"
+
+# Runs of letters/digits, kept together across -, _, . and / so part numbers like "AB-1234.5"
+# and error codes like "E_CONN/42" survive as one term. Their pieces are indexed as well.
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:[-_./][^\W_]+)*")
+PART_PATTERN = re.compile(r"[-_./]")
+
+STOPWORDS = frozenset("""
+a about above after again all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers him his
+how i if in into is it its itself just me more most my no nor not of off on once only or other our ours out over
+own same she should so some such than that the their theirs them then there these they this those through to too
+under until up very was we were what when where which while who whom why will with would you your yours
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in TOKEN_PATTERN.findall(text.lower()):
+        if match not in STOPWORDS:
+            tokens.append(match)
+        if PART_PATTERN.search(match):
+            tokens.extend(part for part in PART_PATTERN.split(match) if part and part not in STOPWORDS)
+    return tokens
+
+
+def is_exact_term(term: str) -> bool:
+    # Terms that embeddings tend to blur: anything with a digit, or compound identifiers.
+    return any(c.isdigit() for c in term) or bool(PART_PATTERN.search(term))
+
+
+def build_postings(documents: Iterable[Document]) -> dict:
+    term_postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    lengths = []
+    for row, doc in enumerate(documents):
+        counts = Counter(tokenize(doc.page_content))
+        lengths.append(sum(counts.values()))
+        for term, frequency in counts.items():
+            term_postings[term].append((row, frequency))
+    
+    terms = sorted(term_postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    for i, term in enumerate(terms):
+        offsets[i + 1] = offsets[i] + len(term_postings[term])
+    postings = [posting for term in terms for posting in term_postings[term]]
+    return {
+        "terms": terms,
+        "offsets": offsets,
+        "rows": np.array([row for row, _ in postings], dtype=np.int32),
+        "frequencies": np.array([frequency for _, frequency in postings], dtype=np.int32),
+        "lengths": np.array(lengths, dtype=np.int32)
+    }
+
+
+def write_postings(segment_dir: Path, postings: dict):
+    segment_dir = Path(segment_dir)
+    with open(segment_dir / TERMS_FILE, "w", encoding="utf-8") as f:
+        f.write("\n".join(postings["terms"]))
+        f.flush()
+        os.fsync(f.fileno())
+    save_npy_durably(segment_dir / OFFSETS_FILE, postings["offsets"])
+    save_npy_durably(segment_dir / ROWS_FILE, postings["rows"])
+    save_npy_durably(segment_dir / FREQUENCIES_FILE, postings["frequencies"])
+    save_npy_durably(segment_dir / LENGTHS_FILE, postings["lengths"])
+
+
+def write_segment_postings(segment_dir: Path, documents: Iterable[Document]) -> dict:
+    postings = build_postings(documents)
+    write_postings(segment_dir, postings)
+    return postings
+
+
+def has_postings(segment_dir: Path) -> bool:
+    return (Path(segment_dir) / LENGTHS_FILE).exists()
+
+
+class SegmentPostings:
+    def __init__(self, terms: List[str], offsets: np.ndarray, rows: np.ndarray, frequencies: np.ndarray, lengths: np.ndarray):
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.rows = rows
+        self.frequencies = frequencies
+        self.lengths = lengths
+    
+    @classmethod
+    def load(cls, segment_dir: Path) -> "SegmentPostings":
+        segment_dir = Path(segment_dir)
+        text = (segment_dir / TERMS_FILE).read_text(encoding="utf-8")
+        return cls(
+            text.split("\n") if text else [],
+            np.load(segment_dir / OFFSETS_FILE, mmap_mode="r"),
+            np.load(segment_dir / ROWS_FILE, mmap_mode="r"),
+            np.load(segment_dir / FREQUENCIES_FILE, mmap_mode="r"),
+            np.load(segment_dir / LENGTHS_FILE, mmap_mode="r")
+        )
+    
+    @classmethod
+    def from_postings(cls, postings: dict) -> "SegmentPostings":
+        return cls(postings["terms"], postings["offsets"], postings["rows"], postings["frequencies"], postings["lengths"])
+    
+    def __len__(self) -> int:
+        return len(self.lengths)
+    
+    def lookup(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return None
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.rows[start:end], self.frequencies[start:end]
+
+
+def load_segment_postings(segment) -> SegmentPostings:
+    if has_postings(segment.path):
+        return SegmentPostings.load(segment.path)
+    # Segments written before the lexical index existed get their postings built on first use.
+    postings = build_postings(segment.document(row) for row in range(len(segment)))
+    try:
+        write_postings(segment.path, postings)
+    except OSError:
+        pass
+    return SegmentPostings.from_postings(postings)
+
+
+class LexicalIndex:
+    # BM25 over the store's segments. Each segment's postings are persisted next to its chunks,
+    # and positions are the same row positions the FAISS index uses.
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._segments: List[Tuple[int, SegmentPostings]] = []
+        self._lock = threading.Lock()
+        self.doc_count = 0
+        self.total_length = 0
+    
+    def add_segment(self, start: int, postings: SegmentPostings):
+        with self._lock:
+            self._segments.append((start, postings))
+            self.doc_count += len(postings)
+            self.total_length += int(np.sum(postings.lengths, dtype=np.int64))
+    
+    def _term_postings(self, term: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        positions, frequencies, lengths = [], [], []
+        for start, postings in self._segments:
+            found = postings.lookup(term)
+            if found is None:
+                continue
+            rows, segment_frequencies = found
+            positions.append(start + np.asarray(rows, dtype=np.int64))
+            frequencies.append(np.asarray(segment_frequencies, dtype=np.float32))
+            lengths.append(np.asarray(postings.lengths[rows], dtype=np.float32))
+        if not positions:
+            empty = np.zeros(0, dtype=np.float32)
+            return np.zeros(0, dtype=np.int64), empty, empty
+        return np.concatenate(positions), np.concatenate(frequencies), np.concatenate(lengths)
+    
+    def search(self, query: str, k: int = 10, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float, int]]:
+        # Returns (position, score, number of distinct query terms matched), best first. allowed is
+        # an optional boolean mask over positions; positions outside it are never returned.
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.doc_count:
+            return []
+        
+        average_length = self.total_length / self.doc_count or 1.0
+        all_positions, all_scores = [], []
+        for term in terms:
+            positions, frequencies, lengths = self._term_postings(term)
+            if not len(positions):
+                continue
+            df = len(positions)
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths / average_length)
+            all_positions.append(positions)
+            all_scores.append(idf * frequencies * (self.k1 + 1) / (frequencies + norm))
+        if not all_positions:
+            return []
+        
+        unique_positions, inverse = np.unique(np.concatenate(all_positions), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        matched = np.bincount(inverse)
+        if allowed is not None:
+            keep = allowed[unique_positions]
+            unique_positions, scores, matched = unique_positions[keep], scores[keep], matched[keep]
+            if not len(unique_positions):
+                return []
+        
+        k = min(k, len(unique_positions))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(unique_positions[i]), float(scores[i]), int(matched[i])) for i in top]
+    
+    def positions_with_all(self, terms: Sequence[str], allowed: Optional[np.ndarray] = None) -> np.ndarray:
+        result = None
+        for term in terms:
+            positions = self._term_postings(term)[0]
+            result = positions if result is None else np.intersect1d(result, positions, assume_unique=True)
+            if not len(result):
+                break
+        if result is None:
+            return np.zeros(0, dtype=np.int64)
+        return result[allowed[result]] if allowed is not None else result
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[int]:
+    scores: Dict[int, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda position: -scores[position])
\ No newline at end of file
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+from collections import defaultdict
+from datetime import date
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+
+FIELDS_FILE = "fields.json"
+
+# Metadata fields with a per-value position index. filename comes from the segment's files.json;
+# the others are written next to it. Values are kept as strings, as in the JSON they come from.
+INDEXED_FIELDS = ("filename", "page", "uploaded_at")
+_SEGMENT_FIELDS = ("page", "uploaded_at")
+
+
+def _field_rows(metadatas: Iterable[dict]) -> Dict[str, Dict[str, List[int]]]:
+    field_rows: Dict[str, Dict[str, List[int]]] = {field: {} for field in _SEGMENT_FIELDS}
+    for row, metadata in enumerate(metadatas):
+        for field in _SEGMENT_FIELDS:
+            if metadata.get(field) is not None:
+                field_rows[field].setdefault(str(metadata[field]), []).append(row)
+    return field_rows
+
+
+def _write_fields(segment_dir: Path, field_rows: Dict[str, Dict[str, List[int]]]):
+    with open(Path(segment_dir) / FIELDS_FILE, "wb") as f:
+        f.write(json.dumps(field_rows).encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_segment_fields(segment_dir: Path, documents: Iterable[Document]):
+    _write_fields(segment_dir, _field_rows(doc.metadata for doc in documents))
+
+
+def load_segment_fields(segment) -> Dict[str, Dict[str, List[int]]]:
+    try:
+        with open(segment.path / FIELDS_FILE, "r", encoding="utf-8") as f:
+            field_rows = json.load(f)
+    except FileNotFoundError:
+        # Segments written before the metadata index existed are scanned once; their chunks
+        # carry no upload date, so the segment's own write date stands in for it. A segment whose
+        # directory a compaction has already removed is still readable through its memory map,
+        # but has no date to offer; its chunks are then left out of the upload date index.
+        try:
+            uploaded_at = date.fromtimestamp(segment.path.stat().st_mtime).isoformat()
+        except OSError:
+            uploaded_at = None
+        field_rows = _field_rows({"uploaded_at": uploaded_at, **segment.metadata(row)} for row in range(len(segment)))
+        try:
+            _write_fields(segment.path, field_rows)
+        except OSError:
+            pass
+    return {"filename": segment.file_rows(), **field_rows}
+
+
+def split_filter(filter: Optional[dict]) -> Tuple[dict, dict]:
+    # Splits a filter into the conditions the index can answer and the rest, which are checked
+    # against each result's metadata the way LangChain's FAISS does.
+    if not filter:
+        return {}, {}
+    indexed = {field: condition for field, condition in filter.items() if field in INDEXED_FIELDS}
+    rest = {field: condition for field, condition in filter.items() if field not in INDEXED_FIELDS}
+    return indexed, rest
+
+
+def _sort_key(value) -> tuple:
+    try:
+        return 0, float(value), ""
+    except (TypeError, ValueError):
+        return 1, 0.0, str(value)
+
+
+def value_matches(value: str, condition) -> bool:
+    # A condition is a single value, a list of values (any of), or a {"gte": ..., "lte": ...}
+    # range, compared numerically for numbers and as text otherwise (ISO dates sort as text).
+    if isinstance(condition, dict):
+        key = _sort_key(value)
+        lower, upper = condition.get("gte"), condition.get("lte")
+        return (lower is None or key >= _sort_key(str(lower))) and (upper is None or key <= _sort_key(str(upper)))
+    if isinstance(condition, (list, tuple, set)):
+        return value in {str(item) for item in condition}
+    return value == str(condition)
+
+
+class MetadataIndex:
+    # value -> positions for each indexed field, over the same row positions as the FAISS index.
+    # A filter becomes a boolean mask over positions that FAISS and BM25 search within.
+    def __init__(self):
+        self._positions: Dict[str, Dict[str, List[np.ndarray]]] = {field: defaultdict(list) for field in INDEXED_FIELDS}
+        self._lock = threading.Lock()
+    
+    def add_segment(self, start: int, field_rows: Dict[str, Dict[str, List[int]]]):
+        with self._lock:
+            for field, values in field_rows.items():
+                for value, rows in values.items():
+                    self._positions[field][value].append(start + np.asarray(rows, dtype=np.int64))
+    
+    def values(self, field: str) -> List[str]:
+        with self._lock:
+            return sorted(self._positions[field], key=_sort_key)
+    
+    def mask(self, filter: dict, size: int) -> np.ndarray:
+        # Conditions on different fields are ANDed; values within one condition are ORed.
+        result = np.ones(size, dtype=bool)
+        with self._lock:
+            for field, condition in filter.items():
+                field_mask = np.zeros(size, dtype=bool)
+                for value, parts in self._positions[field].items():
+                    if value_matches(value, condition):
+                        for positions in parts:
+                            field_mask[positions[positions < size]] = True
+                result &= field_mask
+        return result
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+
+logger = logging.getLogger("rag.metrics")
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_key: LabelKey) -> str:
+    if not label_key:
+        return ""
+    escaped = (
+        f'{key}="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in label_key
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    # Process-wide counters and timings for every pipeline stage. Timings are kept as
+    # count / sum / max per stage and label set, which is all the Prometheus summary needs.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, LabelKey], float] = defaultdict(float)
+        self._timings: Dict[Tuple[str, LabelKey], list] = {}
+    
+    def increment(self, name: str, value: float = 1, **labels):
+        if not value:
+            return
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            timing = self._timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+    
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[dict]:
+        # The yielded dict collects extra fields (counts, sizes) for the log line.
+        fields = {}
+        started = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            duration = time.perf_counter() - started
+            self.observe(name, duration, **labels)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s took %.1f ms %s", name, duration * 1000, {**labels, **fields})
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(label_key), "value": value}
+                for (name, label_key), value in sorted(self._counters.items())
+            ]
+            timings = [
+                {
+                    "name": name,
+                    "labels": dict(label_key),
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count if count else 0.0,
+                    "max_seconds": maximum
+                }
+                for (name, label_key), (count, total, maximum) in sorted(self._timings.items())
+            ]
+        return {"counters": counters, "timings": timings}
+    
+    def render_prometheus(self, prefix: str = "rag_") -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted(self._timings.items())
+        
+        seen = set()
+        for (name, label_key), value in counters:
+            metric = f"{prefix}{name}_total"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            lines.append(f"{metric}{_format_labels(label_key)} {value:g}")
+        
+        by_name = defaultdict(list)
+        for (name, label_key), timing in timings:
+            by_name[name].append((label_key, timing))
+        for name, entries in by_name.items():
+            metric = f"{prefix}{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for label_key, (count, total, _) in entries:
+                lines.append(f"{metric}_count{_format_labels(label_key)} {count}")
+                lines.append(f"{metric}_sum{_format_labels(label_key)} {total:.6f}")
+            lines.append(f"# TYPE {metric}_max gauge")
+            for label_key, (_, _, maximum) in entries:
+                lines.append(f"{metric}_max{_format_labels(label_key)} {maximum:.6f}")
+        return "\n".join(lines) + "\n"
+    
+    def log_summary(self, level: int = logging.INFO):
+        for timing in self.snapshot()["timings"]:
+            logger.log(
+                level,
+                "%s %s: %d calls, %.1f ms mean, %.1f ms max",
+                timing["name"], timing["labels"], timing["count"], timing["mean_seconds"] * 1000, timing["max_seconds"] * 1000
+            )
+    
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+metrics = Metrics()
\ No newline at end of file
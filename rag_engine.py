@@ -1,19 +1,187 @@
-from typing import List, Optional
+import asyncio
+import json
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
 from langchain.vectorstores import FAISS
-from langchain.llms import OpenAI
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import RetrievalQA
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain.chat_models.base import BaseChatModel
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
 from langchain.prompts import PromptTemplate
-from langchain.schema import Document
+from langchain.schema import BaseRetriever, Document
+
+from context_packer import ContextPacker
+from lexical_index import is_exact_term, reciprocal_rank_fusion, tokenize
+from metrics import metrics
+
+if TYPE_CHECKING:
+    from langchain.chains import RetrievalQA
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = 2000, ttl_seconds: float = 24 * 3600, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[Hashable, str], dict]" = OrderedDict()
+    
+    @staticmethod
+    def normalize(question: str) -> str:
+        return re.sub(r"\s+", " ", question).strip().rstrip("?!.").strip().lower()
+    
+    @staticmethod
+    def exact_terms(question: str) -> frozenset:
+        # Part numbers, codes and versions barely move a question's embedding, so questions
+        # only match semantically if they name the same ones.
+        return frozenset(term for term in tokenize(question) if is_exact_term(term))
+    
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return now - entry["created"] > self.ttl_seconds
+    
+    def get(
+        self,
+        scope: Tuple[Hashable, ...],
+        question: str,
+        query_vector: Optional[Sequence[float]] = None,
+        record_miss: bool = True
+    ) -> Optional[dict]:
+        key = (scope, self.normalize(question))
+        now = time.time()
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                metrics.increment("answer_cache_lookups", result="exact_hit")
+                return entry
+            
+            if query_vector is not None:
+                terms = self.exact_terms(question)
+                candidates = [
+                    (candidate_key, candidate) for candidate_key, candidate in self._entries.items()
+                    if candidate_key[0] == scope and candidate["vector"] is not None and candidate["exact_terms"] == terms
+                    and not self._is_expired(candidate, now)
+                ]
+                if candidates:
+                    query = np.asarray(query_vector, dtype=np.float32)
+                    query /= np.linalg.norm(query) or 1.0
+                    similarities = np.stack([candidate["vector"] for _, candidate in candidates]) @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        best_key, best_entry = candidates[best]
+                        self._entries.move_to_end(best_key)
+                        self.semantic_hits += 1
+                        metrics.increment("answer_cache_lookups", result="semantic_hit")
+                        return best_entry
+            
+            if record_miss:
+                self.misses += 1
+                metrics.increment("answer_cache_lookups", result="miss")
+            return None
+    
+    def has_vectors(self, scope: Tuple[Hashable, ...]) -> bool:
+        # Whether a semantic match in scope is possible at all, i.e. worth embedding the question for.
+        with self._lock:
+            return any(key[0] == scope and entry["vector"] is not None for key, entry in self._entries.items())
+    
+    def put(
+        self,
+        scope: Tuple[Hashable, ...],
+        question: str,
+        answer: str,
+        source_documents: List[Document],
+        query_vector: Optional[Sequence[float]] = None
+    ):
+        vector = None
+        if query_vector is not None:
+            vector = np.asarray(query_vector, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        
+        with self._lock:
+            # Entries for older versions of the same store can never be hit again.
+            for stale_key in [key for key in self._entries if key[0][0] == scope[0] and key[0][1] != scope[1]]:
+                del self._entries[stale_key]
+            
+            key = (scope, self.normalize(question))
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                "answer": answer,
+                "source_documents": source_documents,
+                "vector": vector,
+                "exact_terms": self.exact_terms(question),
+                "created": time.time()
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, store_name: Hashable):
+        with self._lock:
+            for key in [key for key in self._entries if key[0][0] == store_name]:
+                del self._entries[key]
+    
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self._entries)
+            }
+
+
+shared_answer_cache = AnswerCache()
+
+
+class HybridRetriever(BaseRetriever):
+    # Same vectorstore / search_kwargs attributes as LangChain's VectorStoreRetriever, so code
+    # that inspects qa_chain.retriever works with either.
+    engine: Any
+    vectorstore: Any
+    search_kwargs: dict = {"k": 4}
+    
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.engine.retrieve(
+            self.vectorstore, query, k=self.search_kwargs.get("k", 4), filter=self.search_kwargs.get("filter")
+        )[0]
 
 
 class RAGEngine:
-    def __init__(self, model_name: str = "gpt-4-1106-preview"):
-        self.llm = ChatOpenAI(
-            model_name=model_name,
-            temperature=0,
-            max_tokens=1000
-        )
+    def __init__(
+        self,
+        model_name: str = "gpt-4-1106-preview",
+        answer_cache: Optional[AnswerCache] = None,
+        hybrid: bool = True,
+        lexical_min_coverage: float = 0.6,
+        max_context_tokens: int = 3000,
+        mmr_lambda: Optional[float] = None,
+        llm: Optional[BaseChatModel] = None,
+        max_parallel_searches: int = 8,
+        store_timeout_seconds: float = 5.0
+    ):
+        if llm is None:
+            from langchain.chat_models import ChatOpenAI
+            llm = ChatOpenAI(
+                model_name=model_name,
+                temperature=0,
+                max_tokens=1000
+            )
+        self.llm = llm
         
         self.prompt_template = PromptTemplate(
             input_variables=["context", "question"],
@@ -28,32 +196,304 @@ Question: {question}
 
 Answer: """
         )
+        self.answer_cache = answer_cache or shared_answer_cache
+        self.hybrid = hybrid
+        self.lexical_min_coverage = lexical_min_coverage
+        self.context_packer = ContextPacker(max_tokens=max_context_tokens, model_name=model_name, mmr_lambda=mmr_lambda)
+        self.store_timeout_seconds = store_timeout_seconds
+        self._search_pool = ThreadPoolExecutor(max_workers=max_parallel_searches, thread_name_prefix="store-search")
+        # Searches that overran their timeout and still hold a pool thread, per store.
+        self._overrunning_searches: Counter = Counter()
+        self._overrunning_lock = threading.Lock()
+        self._combine_chain = None
+        self._combine_chain_lock = threading.Lock()
     
-    def create_qa_chain(self, vector_store: FAISS, k: int = 4) -> RetrievalQA:
-        retriever = vector_store.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": k}
-        )
+    def combine_documents_chain(self):
+        # The prompt + LLM "stuff" chain is the same for every knowledge base, so it is built once
+        # per engine and only the retriever is new in each qa chain.
+        with self._combine_chain_lock:
+            if self._combine_chain is None:
+                from langchain.chains.question_answering import load_qa_chain
+                self._combine_chain = load_qa_chain(self.llm, chain_type="stuff", prompt=self.prompt_template)
+            return self._combine_chain
+    
+    def create_qa_chain(self, vector_store: FAISS, k: int = 4, filter: Optional[dict] = None) -> "RetrievalQA":
+        # filter restricts retrieval to chunks whose metadata matches, e.g.
+        # {"filename": ["contract.pdf"], "uploaded_at": {"gte": "2024-01-01"}}.
+        search_kwargs = {"k": k, "filter": filter} if filter else {"k": k}
+        if self._uses_hybrid(vector_store):
+            retriever = HybridRetriever(engine=self, vectorstore=vector_store, search_kwargs=search_kwargs)
+        else:
+            retriever = vector_store.as_retriever(
+                search_type="similarity",
+                search_kwargs=search_kwargs
+            )
         
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=self.llm,
-            chain_type="stuff",
+        from langchain.chains import RetrievalQA
+        qa_chain = RetrievalQA(
+            combine_documents_chain=self.combine_documents_chain(),
             retriever=retriever,
-            chain_type_kwargs={
-                "prompt": self.prompt_template
-            },
             return_source_documents=True
         )
         
         return qa_chain
     
-    def query(self, qa_chain: RetrievalQA, question: str) -> dict:
+    def _cache_scope(self, vector_store: FAISS, filter: Optional[dict] = None) -> Tuple[Hashable, int, str]:
+        # Answers are only valid for the exact content they were generated from, so the scope
+        # includes the store's content version (ingesting documents moves to a new, empty scope)
+        # and the metadata filter the question was asked under.
+        store_name = getattr(vector_store, "store_name", None) or id(vector_store)
+        filter_key = json.dumps(filter, sort_keys=True, default=str) if filter else ""
+        return store_name, getattr(vector_store, "content_version", 0), filter_key
+    
+    def _uses_hybrid(self, vector_store: FAISS) -> bool:
+        return self.hybrid and hasattr(vector_store, "lexical_search")
+    
+    @staticmethod
+    def _fetch_k(k: int) -> int:
+        return max(4 * k, 20)
+    
+    def _lexical_only_positions(
+        self,
+        vector_store: FAISS,
+        question: str,
+        lexical_hits: List[Tuple[int, float, int]],
+        k: int,
+        filter: Optional[dict] = None
+    ) -> Optional[List[int]]:
+        # The embedding call is skipped only when the question names exact identifiers (part
+        # numbers, error codes, ...), the best keyword hit contains all of them along with most of
+        # the other query terms, and the chunks containing them rank first lexically.
+        terms = list(dict.fromkeys(tokenize(question)))
+        exact_terms = [term for term in terms if is_exact_term(term)]
+        if not exact_terms or not lexical_hits:
+            return None
+        if lexical_hits[0][2] < self.lexical_min_coverage * len(terms):
+            return None
+        
+        with_all = set(vector_store.lexical_positions_with_all(exact_terms, filter=filter).tolist())
+        top = [position for position, _, _ in lexical_hits[:k]]
+        expected = min(k, len(with_all))
+        if not expected or not all(position in with_all for position in top[:expected]):
+            return None
+        return top[:expected]
+    
+    def _fuse(self, vector_store: FAISS, dense_positions: Sequence[int], lexical_hits: List[Tuple[int, float, int]], k: int) -> List[Document]:
+        rankings = [[int(i) for i in dense_positions if i >= 0], [position for position, _, _ in lexical_hits]]
+        return vector_store.documents_at(reciprocal_rank_fusion(rankings)[:k])
+    
+    def _search(
+        self,
+        vector_store: FAISS,
+        question: str,
+        k: int,
+        filter: Optional[dict] = None,
+        query_vector: Optional[List[float]] = None
+    ) -> Tuple[List[Document], Optional[List[float]], str]:
+        if not self._uses_hybrid(vector_store):
+            if query_vector is None:
+                query_vector = vector_store._embed_query(question)
+            return vector_store.similarity_search_by_vector(query_vector, k=k, filter=filter), query_vector, "dense"
+        
+        lexical_hits = vector_store.lexical_search(question, k=self._fetch_k(k), filter=filter)
+        lexical_only = self._lexical_only_positions(vector_store, question, lexical_hits, k, filter)
+        if lexical_only is not None:
+            return vector_store.documents_at(lexical_only), query_vector, "lexical"
+        
+        if query_vector is None:
+            query_vector = vector_store._embed_query(question)
+        _, dense_positions = vector_store.search_positions([query_vector], self._fetch_k(k), filter=filter)
+        return self._fuse(vector_store, dense_positions[0], lexical_hits, k), query_vector, "hybrid"
+    
+    def retrieve(
+        self,
+        vector_store: FAISS,
+        question: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        query_vector: Optional[List[float]] = None
+    ) -> Tuple[List[Document], Optional[List[float]]]:
+        # Returns the packed context documents and the question embedding, which is None when the
+        # keyword index answered on its own and no embedding was computed. A query_vector that
+        # is passed in (from the answer cache lookup) is used instead of embedding again.
+        started = time.perf_counter()
+        documents, query_vector, mode = self._search(vector_store, question, k, filter, query_vector)
+        metrics.observe("retrieve", time.perf_counter() - started, mode=mode)
+        with metrics.span("context_pack"):
+            return self.context_packer.pack(documents), query_vector
+    
+    def _dense_hits(self, vector_store: FAISS, query_vector: List[float], k: int, filter: Optional[dict]) -> List[Tuple[float, Any]]:
+        # (similarity, position or Document), where higher similarity is better for every
+        # distance strategy, so hits from different stores can be sorted together.
+        started = time.perf_counter()
+        if hasattr(vector_store, "search_positions"):
+            scores, positions = vector_store.search_positions([query_vector], k, filter=filter)
+            hits = [(float(score), int(position)) for score, position in zip(scores[0], positions[0]) if position >= 0]
+        else:
+            hits = [(score, doc) for doc, score in vector_store.similarity_search_with_score_by_vector(query_vector, k=k, filter=filter)]
+        metrics.observe("store_search", time.perf_counter() - started, kind="dense")
+        if vector_store.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD):
+            return hits
+        return [(-score, ref) for score, ref in hits]
+    
+    def _lexical_hits(self, vector_store: FAISS, question: str, k: int, filter: Optional[dict]) -> List[Tuple[float, Any]]:
+        started = time.perf_counter()
+        hits = [(score, position) for position, score, _ in vector_store.lexical_search(question, k=k, filter=filter)]
+        metrics.observe("store_search", time.perf_counter() - started, kind="lexical")
+        return hits
+    
+    @staticmethod
+    def _store_key(vector_store: FAISS) -> Hashable:
+        return getattr(vector_store, "store_name", None) or id(vector_store)
+    
+    @staticmethod
+    def _timed_search(search_started: List[Optional[float]], search: Callable, *args) -> List[Tuple[float, Any]]:
+        search_started[0] = time.perf_counter()
+        return search(*args)
+    
+    def _abandon_search(self, future: Future, store_key: Hashable):
+        if future.cancel():
+            return
+        with self._overrunning_lock:
+            self._overrunning_searches[store_key] += 1
+        future.add_done_callback(lambda _: self._overrun_finished(store_key))
+    
+    def _overrun_finished(self, store_key: Hashable):
+        with self._overrunning_lock:
+            self._overrunning_searches[store_key] -= 1
+            if self._overrunning_searches[store_key] <= 0:
+                del self._overrunning_searches[store_key]
+    
+    def multi_retrieve(
+        self,
+        vector_stores: Sequence[FAISS],
+        question: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        query_vector: Optional[List[float]] = None
+    ) -> Tuple[List[Document], Optional[List[float]], List[str]]:
+        # Scatter-gather over several knowledge bases: the question is embedded once, every
+        # store's dense and keyword searches run in parallel on the search pool, and the hits are
+        # merged globally (dense by similarity, keyword by BM25 score, then reciprocal-rank
+        # fusion). Searches still running after timeout seconds are left out, so a slow store
+        # costs its own results rather than the whole answer. Returns the packed documents, the
+        # question embedding and the names of the stores whose results are incomplete.
+        timeout = self.store_timeout_seconds if timeout is None else timeout
+        started = time.perf_counter()
+        if query_vector is None:
+            query_vector = vector_stores[0]._embed_query(question)
+        fetch_k = self._fetch_k(k)
+        
+        # A store whose earlier search is still running past its timeout is skipped, so a slow
+        # store holds at most one query's searches on the shared pool instead of piling up.
+        futures: Dict[Future, Tuple[int, str, List[Optional[float]]]] = {}
+        incomplete = set()
+        for store_index, vector_store in enumerate(vector_stores):
+            with self._overrunning_lock:
+                busy = self._overrunning_searches[self._store_key(vector_store)] > 0
+            if busy:
+                incomplete.add(store_index)
+                metrics.increment("store_search_incomplete", kind="all", reason="busy")
+                continue
+            searches = [("dense", self._dense_hits, query_vector)]
+            if self._uses_hybrid(vector_store):
+                searches.append(("lexical", self._lexical_hits, question))
+            for kind, search, query in searches:
+                search_started: List[Optional[float]] = [None]
+                futures[self._search_pool.submit(self._timed_search, search_started, search, vector_store, query, fetch_k, filter)] = (
+                    store_index, kind, search_started
+                )
+        
+        # Each search has timeout seconds from when it starts running, and the same from now to
+        # get a thread at all. Searches past their deadline are cancelled if still queued; one
+        # already running keeps its thread until it finishes, and its result is never read.
+        submitted = time.perf_counter()
+        pending = set(futures)
+        abandoned = set()
+        while pending:
+            now = time.perf_counter()
+            deadlines = {future: (futures[future][2][0] or submitted) + timeout for future in pending}
+            for future in [future for future in pending if deadlines[future] <= now]:
+                pending.discard(future)
+                abandoned.add(future)
+                store_index, kind, search_started = futures[future]
+                incomplete.add(store_index)
+                metrics.increment("store_search_incomplete", kind=kind, reason="timeout" if search_started[0] else "queued")
+                self._abandon_search(future, self._store_key(vector_stores[store_index]))
+            if pending:
+                done, _ = wait(pending, timeout=min(deadlines[future] for future in pending) - now, return_when=FIRST_COMPLETED)
+                pending -= done
+        
+        hits: Dict[str, List[Tuple[float, Tuple[int, Any]]]] = {"dense": [], "lexical": []}
+        # Plain FAISS stores return Documents, which aren't hashable; they are keyed by their text
+        # for fusion and looked up again here afterwards.
+        found_documents: Dict[Tuple[int, Any], Document] = {}
+        for future, (store_index, kind, _) in futures.items():
+            if future in abandoned:
+                continue
+            if future.exception() is not None:
+                incomplete.add(store_index)
+                metrics.increment("store_search_incomplete", kind=kind, reason="error")
+                continue
+            for score, ref in future.result():
+                key = (store_index, ref.page_content if isinstance(ref, Document) else ref)
+                if isinstance(ref, Document):
+                    found_documents.setdefault(key, ref)
+                hits[kind].append((score, key))
+        
+        rankings = [[key for _, key in sorted(hits[kind], key=lambda hit: -hit[0])] for kind in ("dense", "lexical")]
+        documents = []
+        for key in reciprocal_rank_fusion(rankings)[:k]:
+            store_index, ref = key
+            vector_store = vector_stores[store_index]
+            found = [found_documents[key]] if key in found_documents else vector_store.documents_at([ref])
+            for doc in found:
+                store_name = getattr(vector_store, "store_name", None)
+                documents.append(Document(page_content=doc.page_content, metadata={**doc.metadata, "store": store_name}) if store_name else doc)
+        
+        metrics.observe("retrieve", time.perf_counter() - started, mode="multi_store")
+        incomplete_names = [getattr(vector_stores[i], "store_name", None) or str(i) for i in sorted(incomplete)]
+        with metrics.span("context_pack"):
+            return self.context_packer.pack(documents), query_vector, incomplete_names
+    
+    def _cached_answer(self, vector_store: FAISS, scope: Tuple[Hashable, ...], question: str) -> Tuple[Optional[dict], Optional[List[float]]]:
+        # The answer cache is checked before any retrieval. An exact repeat costs a dictionary
+        # lookup; a paraphrase costs only the question embedding, which is returned so retrieval
+        # can reuse it on a miss. The embedding is skipped when nothing cached in scope has one.
+        cached = self.answer_cache.get(scope, question, record_miss=False)
+        if cached is not None:
+            return cached, None
+        query_vector = vector_store._embed_query(question) if self.answer_cache.has_vectors(scope) else None
+        return self.answer_cache.get(scope, question, query_vector), query_vector
+    
+    def query(self, qa_chain: "RetrievalQA", question: str) -> dict:
         try:
-            result = qa_chain({"query": question})
+            vector_store = qa_chain.retriever.vectorstore
+            search_kwargs = qa_chain.retriever.search_kwargs
+            scope = self._cache_scope(vector_store, search_kwargs.get("filter"))
+            cached, query_vector = self._cached_answer(vector_store, scope, question)
+            if cached is not None:
+                return {
+                    "answer": cached["answer"],
+                    "source_documents": cached["source_documents"],
+                    "success": True,
+                    "cached": True
+                }
+            
+            source_documents, query_vector = self.retrieve(
+                vector_store, question, k=search_kwargs.get("k", 4), filter=search_kwargs.get("filter"), query_vector=query_vector
+            )
+            # The documents retrieved above are passed straight to the combine step instead of
+            # letting the chain's retriever embed the question a second time.
+            with metrics.span("llm", mode="sync"):
+                answer = qa_chain.combine_documents_chain.run(input_documents=source_documents, question=question)
+            self.answer_cache.put(scope, question, answer, source_documents, query_vector)
             return {
-                "answer": result["result"],
-                "source_documents": result["source_documents"],
-                "success": True
+                "answer": answer,
+                "source_documents": source_documents,
+                "success": True,
+                "cached": False
             }
         except Exception as e:
             return {
@@ -62,9 +502,244 @@ Answer: """
                 "success": False
             }
     
-    def get_relevant_documents(self, vector_store: FAISS, question: str, k: int = 4) -> List[Document]:
-        retriever = vector_store.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": k}
-        )
-        return retriever.get_relevant_documents(question)
\ No newline at end of file
+    def get_relevant_documents(self, vector_store: FAISS, question: str, k: int = 4, filter: Optional[dict] = None) -> List[Document]:
+        return self.retrieve(vector_store, question, k=k, filter=filter)[0]
+    
+    def format_prompt(self, documents: List[Document], question: str) -> str:
+        # Same layout the "stuff" chain produces, so streamed and non-streamed answers match.
+        context = "\n\n".join(doc.page_content for doc in documents)
+        return self.prompt_template.format(context=context, question=question)
+    
+    def stream_answer(self, documents: List[Document], question: str) -> Iterator[str]:
+        started = time.perf_counter()
+        first_token = True
+        for chunk in self.llm.stream(self.format_prompt(documents, question)):
+            if chunk.content:
+                if first_token:
+                    metrics.observe("llm_first_token", time.perf_counter() - started, mode="stream")
+                    first_token = False
+                yield chunk.content
+        metrics.observe("llm", time.perf_counter() - started, mode="stream")
+    
+    async def aquery(self, vector_store: FAISS, question: str, k: int = 4, filter: Optional[dict] = None) -> dict:
+        return (await self.abatch_query(vector_store, [question], k=k, filter=filter))[0]
+    
+    async def abatch_query(
+        self,
+        vector_store: FAISS,
+        questions: List[str],
+        k: int = 4,
+        max_concurrency: int = 8,
+        filter: Optional[dict] = None
+    ) -> List[dict]:
+        if not questions:
+            return []
+        
+        def failed(e: Exception) -> dict:
+            return {"answer": f"Error processing query: {str(e)}", "source_documents": [], "success": False}
+        
+        def from_cache(cached: dict) -> dict:
+            return {"answer": cached["answer"], "source_documents": cached["source_documents"], "success": True, "cached": True}
+        
+        # Exact repeats are answered before anything is searched or embedded, so they neither
+        # wait for nor fail with the other questions' embedding request.
+        results: List[Optional[dict]] = [None] * len(questions)
+        try:
+            scope = self._cache_scope(vector_store, filter)
+        except Exception as e:
+            return [failed(e) for _ in questions]
+        for i, question in enumerate(questions):
+            cached = self.answer_cache.get(scope, question, record_miss=False)
+            if cached is not None:
+                results[i] = from_cache(cached)
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        
+        # Keyword search, FAISS search and context packing are CPU-bound, so they run on the
+        # search pool; only the embedding and LLM calls are awaited on the event loop itself.
+        loop = asyncio.get_running_loop()
+        lexical_hits: List[list] = [[] for _ in questions]
+        lexical_only: List[Optional[List[int]]] = [None] * len(questions)
+        query_vectors: List[Optional[List[float]]] = [None] * len(questions)
+        try:
+            hybrid = self._uses_hybrid(vector_store)
+            
+            def lexical_stage():
+                for i in pending:
+                    lexical_hits[i] = vector_store.lexical_search(questions[i], k=self._fetch_k(k), filter=filter)
+                    lexical_only[i] = self._lexical_only_positions(vector_store, questions[i], lexical_hits[i], k, filter)
+            
+            if hybrid:
+                await loop.run_in_executor(self._search_pool, lexical_stage)
+            # The remaining questions are embedded in a single request and, for cache misses,
+            # searched with a single multi-query FAISS call.
+            to_embed = [i for i in pending if lexical_only[i] is None]
+            if to_embed:
+                embedded = await vector_store.embeddings.aembed_documents([questions[i] for i in to_embed])
+                for i, query_vector in zip(to_embed, embedded):
+                    query_vectors[i] = query_vector
+        except Exception as e:
+            for i in pending:
+                results[i] = failed(e)
+            return results
+        
+        misses = []
+        for i in pending:
+            cached = self.answer_cache.get(scope, questions[i], query_vectors[i])
+            if cached is not None:
+                results[i] = from_cache(cached)
+            else:
+                misses.append(i)
+        
+        if misses:
+            def search_misses() -> Dict[int, List[Document]]:
+                retrieved = {i: vector_store.documents_at(lexical_only[i]) for i in misses if lexical_only[i] is not None}
+                dense_misses = [i for i in misses if lexical_only[i] is None]
+                miss_vectors = [query_vectors[i] for i in dense_misses]
+                if dense_misses and hybrid:
+                    _, dense_positions = vector_store.search_positions(miss_vectors, self._fetch_k(k), filter=filter)
+                    for i, positions in zip(dense_misses, dense_positions):
+                        retrieved[i] = self._fuse(vector_store, positions, lexical_hits[i], k)
+                elif dense_misses and hasattr(vector_store, "batch_similarity_search_with_score_by_vectors"):
+                    hits = vector_store.batch_similarity_search_with_score_by_vectors(miss_vectors, k=k, filter=filter)
+                    for i, docs in zip(dense_misses, hits):
+                        retrieved[i] = [doc for doc, _ in docs]
+                elif dense_misses:
+                    for i, vector in zip(dense_misses, miss_vectors):
+                        retrieved[i] = vector_store.similarity_search_by_vector(vector, k=k, filter=filter)
+                return {i: self.context_packer.pack(docs) for i, docs in retrieved.items()}
+            
+            retrieved = await loop.run_in_executor(self._search_pool, search_misses)
+            semaphore = asyncio.Semaphore(max_concurrency)
+            
+            async def answer(i: int, source_documents: List[Document]) -> dict:
+                async with semaphore:
+                    try:
+                        with metrics.span("llm", mode="async"):
+                            response = await self.llm.ainvoke(self.format_prompt(source_documents, questions[i]))
+                    except Exception as e:
+                        return {
+                            "answer": f"Error processing query: {str(e)}",
+                            "source_documents": source_documents,
+                            "success": False
+                        }
+                self.answer_cache.put(scope, questions[i], response.content, source_documents, query_vectors[i])
+                return {
+                    "answer": response.content,
+                    "source_documents": source_documents,
+                    "success": True,
+                    "cached": False
+                }
+            
+            answers = await asyncio.gather(*(answer(i, retrieved[i]) for i in misses))
+            for i, result in zip(misses, answers):
+                results[i] = result
+        
+        return results
+    
+    def _multi_cache_scope(self, vector_stores: Sequence[FAISS], filter: Optional[dict] = None) -> Tuple[Hashable, ...]:
+        scopes = [self._cache_scope(vector_store) for vector_store in vector_stores]
+        filter_key = json.dumps(filter, sort_keys=True, default=str) if filter else ""
+        return tuple(scope[0] for scope in scopes), tuple(scope[1] for scope in scopes), filter_key
+    
+    def stream_multi_query(
+        self,
+        vector_stores: Sequence[FAISS],
+        question: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        timeout: Optional[float] = None
+    ) -> dict:
+        # stream_query over several knowledge bases. "incomplete_stores" names the stores that
+        # timed out or failed; answers built from incomplete results are not cached.
+        try:
+            scope = self._multi_cache_scope(vector_stores, filter)
+            # Only answers built from complete results are cached, so a hit needs no retrieval.
+            cached, query_vector = self._cached_answer(vector_stores[0], scope, question)
+            if cached is not None:
+                return {
+                    "source_documents": cached["source_documents"],
+                    "tokens": iter([cached["answer"]]),
+                    "success": True,
+                    "cached": True,
+                    "incomplete_stores": []
+                }
+            source_documents, query_vector, incomplete = self.multi_retrieve(
+                vector_stores, question, k=k, filter=filter, timeout=timeout, query_vector=query_vector
+            )
+        except Exception as e:
+            return {
+                "answer": f"Error processing query: {str(e)}",
+                "source_documents": [],
+                "tokens": iter(()),
+                "success": False,
+                "incomplete_stores": []
+            }
+        
+        return {
+            "source_documents": source_documents,
+            "tokens": (
+                self.stream_answer(source_documents, question) if incomplete
+                else self._stream_and_cache(scope, question, query_vector, source_documents)
+            ),
+            "success": True,
+            "cached": False,
+            "incomplete_stores": incomplete
+        }
+    
+    def _stream_and_cache(
+        self,
+        scope: Tuple[Hashable, ...],
+        question: str,
+        query_vector: Optional[List[float]],
+        source_documents: List[Document]
+    ) -> Iterator[str]:
+        tokens = []
+        for token in self.stream_answer(source_documents, question):
+            tokens.append(token)
+            yield token
+        self.answer_cache.put(scope, question, "".join(tokens), source_documents, query_vector)
+    
+    def stream_query(self, vector_store: FAISS, question: str, k: int = 4, filter: Optional[dict] = None) -> dict:
+        # Retrieval happens up front so the sources can be shown right away; the answer tokens are
+        # produced lazily as the caller iterates over "tokens".
+        try:
+            scope = self._cache_scope(vector_store, filter)
+            cached, query_vector = self._cached_answer(vector_store, scope, question)
+            if cached is not None:
+                return {
+                    "source_documents": cached["source_documents"],
+                    "tokens": iter([cached["answer"]]),
+                    "success": True,
+                    "cached": True
+                }
+            source_documents, query_vector = self.retrieve(vector_store, question, k=k, filter=filter, query_vector=query_vector)
+        except Exception as e:
+            return {
+                "answer": f"Error processing query: {str(e)}",
+                "source_documents": [],
+                "tokens": iter(()),
+                "success": False
+            }
+        
+        return {
+            "source_documents": source_documents,
+            "tokens": self._stream_and_cache(scope, question, query_vector, source_documents),
+            "success": True,
+            "cached": False
+        }
+
+
+_shared_engine: Optional[RAGEngine] = None
+_shared_engine_lock = threading.Lock()
+
+
+def shared_rag_engine(**kwargs) -> RAGEngine:
+    # One engine (LLM client, prompt chain, tokenizer, search pool) per process, shared by every
+    # session; kwargs only apply when it is created.
+    global _shared_engine
+    with _shared_engine_lock:
+        if _shared_engine is None:
+            _shared_engine = RAGEngine(**kwargs)
+        return _shared_engine
@@ -0,0 +1,444 @@
+import json
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+
+from chunk_store import ChunkSegment, save_npy_durably, source_name, write_chunk_segment
+from deduplication import DUPLICATES_FILE, write_segment_signatures
+from lexical_index import write_segment_postings
+from metadata_index import write_segment_fields
+
+
+MANIFEST_FILE = "manifest.json"
+SEGMENTS_DIR = "segments"
+FORMAT_VERSION = 1
+
+_store_locks: Dict[str, threading.RLock] = {}
+_store_locks_guard = threading.Lock()
+
+
+def _lock_for(store_path: Path) -> threading.RLock:
+    key = str(store_path.resolve())
+    with _store_locks_guard:
+        if key not in _store_locks:
+            _store_locks[key] = threading.RLock()
+        return _store_locks[key]
+
+
+def _fsync_dir(path: Path):
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_file_durably(path: Path, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _tier(rows: int, merge_factor: int) -> int:
+    tier = 0
+    while rows >= merge_factor ** (tier + 1):
+        tier += 1
+    return tier
+
+
+def plan_compaction(live_counts: List[int], merge_factor: int = 4) -> Optional[int]:
+    # Size-tiered merging: segments fall into tiers a factor of merge_factor apart by live row
+    # count. Once the newest run of segments no larger than some tier holds merge_factor
+    # segments of that tier, the run is merged (smaller segments in it come along), trying the
+    # smallest tier first. A merge moves its rows up a tier, so each row is rewritten about once
+    # per tier instead of on every compaction. Returns the position of the first segment of the
+    # run, or None if there is nothing worth merging.
+    tiers = [_tier(count, merge_factor) for count in live_counts]
+    for tier in sorted(set(tiers)):
+        start = len(tiers)
+        while start > 0 and tiers[start - 1] <= tier:
+            start -= 1
+        if tiers[start:].count(tier) >= max(merge_factor, 2):
+            return start
+    return None
+
+
+# A knowledge base on disk is a set of immutable segment directories plus manifest.json.
+# Each add writes a new segment and then atomically replaces the manifest to reference it,
+# so a crash mid-write leaves the previous manifest (and store contents) intact. Deleted
+# chunks are tombstoned: the manifest points each segment at a file listing its deleted rows,
+# so row positions (and the FAISS index built over them) stay valid until compaction.
+class SegmentStore:
+    def __init__(self, store_path: Path):
+        self.store_path = Path(store_path)
+        self.segments_dir = self.store_path / SEGMENTS_DIR
+        self.manifest_path = self.store_path / MANIFEST_FILE
+        self._lock = _lock_for(self.store_path)
+    
+    def exists(self) -> bool:
+        return self.manifest_path.exists()
+    
+    def read_manifest(self) -> dict:
+        if not self.manifest_path.exists():
+            return {
+                "format_version": FORMAT_VERSION,
+                "version": 0,
+                "content_version": 0,
+                "next_segment_id": 1,
+                "segments": []
+            }
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    def _commit_manifest(self, manifest: dict, content_changed: bool = True):
+        # The summary fields are derived from the segment entries on every commit, so the
+        # manifest alone is enough to describe the store without opening any segment.
+        source_files = Counter()
+        for segment in manifest["segments"]:
+            source_files.update(segment.get("sources", {}))
+        file_hashes = manifest.get("file_hashes", {})
+        
+        now = time.time()
+        manifest["version"] = manifest.get("version", 0) + 1
+        if content_changed:
+            manifest["content_version"] = manifest.get("content_version", 0) + 1
+        manifest["row_count"] = sum(segment["count"] for segment in manifest["segments"])
+        manifest["chunk_count"] = manifest["row_count"] - sum(segment.get("deleted", 0) for segment in manifest["segments"])
+        manifest["size_bytes"] = sum(segment.get("size_bytes", 0) for segment in manifest["segments"])
+        manifest["duplicate_count"] = sum(segment.get("duplicates", 0) for segment in manifest["segments"])
+        manifest["dimension"] = next(
+            (segment["dimension"] for segment in manifest["segments"] if segment.get("dimension")),
+            manifest.get("dimension")
+        )
+        manifest["source_files"] = dict(sorted(source_files.items()))
+        manifest["file_hashes"] = {name: file_hashes[name] for name in manifest["source_files"] if name in file_hashes}
+        manifest.setdefault("created_at", now)
+        manifest["updated_at"] = now
+        
+        tmp_path = self.manifest_path.with_suffix(".json.tmp")
+        _write_file_durably(tmp_path, json.dumps(manifest, indent=2).encode("utf-8"))
+        os.replace(tmp_path, self.manifest_path)
+        _fsync_dir(self.store_path)
+    
+    def _write_segment(
+        self,
+        manifest: dict,
+        ids: List[str],
+        documents: List[Document],
+        vectors: np.ndarray,
+        duplicates: Optional[List[dict]] = None
+    ) -> dict:
+        segment_name = f"seg-{manifest['next_segment_id']:06d}"
+        manifest["next_segment_id"] += 1
+        
+        self.segments_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = self.segments_dir / f".tmp-{segment_name}"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir()
+        
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(tmp_dir / "vectors.npy", "wb") as f:
+            np.save(f, vectors)
+            f.flush()
+            os.fsync(f.fileno())
+        write_chunk_segment(tmp_dir, ids, documents)
+        write_segment_postings(tmp_dir, documents)
+        write_segment_fields(tmp_dir, documents)
+        write_segment_signatures(tmp_dir, [doc.page_content for doc in documents])
+        if duplicates:
+            # Rows that are near-duplicates, each linked to the chunk it duplicates and sharing
+            # its vector.
+            _write_file_durably(tmp_dir / DUPLICATES_FILE, json.dumps(duplicates, default=str).encode("utf-8"))
+        _fsync_dir(tmp_dir)
+        
+        size_bytes = sum(item.stat().st_size for item in tmp_dir.iterdir())
+        sources = Counter(source_name(doc.metadata) for doc in documents)
+        
+        os.replace(tmp_dir, self.segments_dir / segment_name)
+        _fsync_dir(self.segments_dir)
+        return {
+            "name": segment_name,
+            "count": len(ids),
+            "dimension": int(vectors.shape[1]) if vectors.ndim == 2 else None,
+            "size_bytes": size_bytes,
+            "sources": dict(sources),
+            "duplicates": len(duplicates or [])
+        }
+    
+    def append(
+        self,
+        ids: List[str],
+        documents: List[Document],
+        vectors: np.ndarray,
+        replace: bool = False,
+        duplicates: Optional[List[dict]] = None,
+        delete_ids: Collection[str] = (),
+        file_hashes: Optional[Dict[str, str]] = None,
+        **manifest_fields
+    ) -> dict:
+        # delete_ids are tombstoned in the same manifest commit that adds the new segment, so
+        # replacing a file's chunks is atomic.
+        with self._lock:
+            manifest = self.read_manifest()
+            segment = self._write_segment(manifest, ids, documents, vectors, duplicates)
+            replaced = manifest["segments"] if replace else []
+            stale_tombstones = [] if replace else self._tombstone(manifest, delete_ids)
+            manifest["segments"] = [segment] if replace else manifest["segments"] + [segment]
+            replaced_index = manifest.pop("index", None) if replace else None
+            if replace:
+                manifest.pop("created_at", None)
+                manifest.pop("file_hashes", None)
+            manifest.update(manifest_fields)
+            manifest.setdefault("file_hashes", {}).update(file_hashes or {})
+            manifest["format_version"] = FORMAT_VERSION
+            self._commit_manifest(manifest)
+        
+        for old_segment in replaced:
+            shutil.rmtree(self.segments_dir / old_segment["name"], ignore_errors=True)
+        if replaced_index:
+            (self.store_path / replaced_index["file"]).unlink(missing_ok=True)
+        self._remove_files(stale_tombstones)
+        return manifest
+    
+    def delete_chunks(self, delete_ids: Collection[str], file_hashes: Optional[Dict[str, str]] = None) -> dict:
+        with self._lock:
+            manifest = self.read_manifest()
+            stale_tombstones = self._tombstone(manifest, delete_ids)
+            manifest.setdefault("file_hashes", {}).update(file_hashes or {})
+            self._commit_manifest(manifest)
+        self._remove_files(stale_tombstones)
+        return manifest
+    
+    def record_file_hashes(self, file_hashes: Dict[str, str]) -> dict:
+        # For a re-uploaded file whose bytes changed but whose chunks didn't: nothing to write
+        # except its new hash.
+        with self._lock:
+            manifest = self.read_manifest()
+            manifest.setdefault("file_hashes", {}).update(file_hashes)
+            self._commit_manifest(manifest, content_changed=False)
+            return manifest
+    
+    def _tombstone(self, manifest: dict, delete_ids: Collection[str]) -> List[Path]:
+        # Writes a new tombstone file for every segment that holds one of delete_ids and points
+        # the segment's manifest entry at it; returns the files it supersedes.
+        if not delete_ids:
+            return []
+        wanted = np.array([chunk_id.encode("ascii") for chunk_id in delete_ids], dtype=bytes)
+        stale = []
+        for entry in manifest["segments"]:
+            segment = self.open_segment(entry["name"])
+            rows = np.nonzero(np.isin(segment.ids, wanted))[0]
+            existing = self.load_tombstones(entry)
+            deleted = np.union1d(existing, rows).astype(np.int64)
+            if len(deleted) == len(existing):
+                continue
+            
+            tombstone_file = f"deleted-v{manifest['version'] + 1}.npy"
+            tmp_path = self.segments_dir / entry["name"] / f".tmp-{tombstone_file}"
+            save_npy_durably(tmp_path, deleted)
+            os.replace(tmp_path, self.segments_dir / entry["name"] / tombstone_file)
+            _fsync_dir(self.segments_dir / entry["name"])
+            if entry.get("tombstones"):
+                stale.append(self.segments_dir / entry["name"] / entry["tombstones"])
+            
+            deleted_set = set(deleted.tolist())
+            sources = {
+                name: sum(1 for row in rows_of_file if row not in deleted_set)
+                for name, rows_of_file in segment.file_rows().items()
+            }
+            entry["tombstones"] = tombstone_file
+            entry["deleted"] = len(deleted)
+            entry["sources"] = {name: count for name, count in sources.items() if count}
+        return stale
+    
+    def load_tombstones(self, entry: dict) -> np.ndarray:
+        if not entry.get("tombstones"):
+            return np.zeros(0, dtype=np.int64)
+        return np.load(self.segments_dir / entry["name"] / entry["tombstones"])
+    
+    def file_chunk_ids(self, filename: str, manifest: Optional[dict] = None) -> List[str]:
+        manifest = manifest or self.read_manifest()
+        chunk_ids = []
+        for entry in manifest["segments"]:
+            if filename not in entry.get("sources", {}):
+                continue
+            segment = self.open_segment(entry["name"])
+            deleted = set(self.load_tombstones(entry).tolist())
+            chunk_ids.extend(segment.chunk_id(row) for row in segment.file_rows().get(filename, []) if row not in deleted)
+        return chunk_ids
+    
+    @staticmethod
+    def _remove_files(paths: List[Path]):
+        for path in paths:
+            path.unlink(missing_ok=True)
+    
+    def update_manifest(self, **fields) -> dict:
+        with self._lock:
+            manifest = self.read_manifest()
+            manifest.update(fields)
+            self._commit_manifest(manifest, content_changed=False)
+            return manifest
+    
+    def iter_vectors(self, manifest: dict, start_row: int = 0) -> Iterator[np.ndarray]:
+        row = 0
+        for segment in manifest["segments"]:
+            if row + segment["count"] > start_row:
+                vectors = self.load_vectors(segment["name"])
+                yield vectors[max(start_row - row, 0):]
+            row += segment["count"]
+    
+    def read_all_vectors(self, manifest: dict, rows: Optional[int] = None) -> np.ndarray:
+        parts = list(self.iter_vectors(manifest))
+        if not parts:
+            return np.zeros((0, manifest.get("dimension") or 0), dtype=np.float32)
+        vectors = np.concatenate(parts)
+        return vectors if rows is None else vectors[:rows]
+    
+    def save_index(self, index: faiss.Index, index_info: dict, created_at: float, segments: Optional[List[str]] = None) -> bool:
+        # The ANN index is derived from the segments' vectors: it covers the first
+        # index_info["rows"] rows, and rows added after it was built are appended on load.
+        # segments names the segments it was built from; if a compaction replaced any of them
+        # meanwhile, its row positions may no longer match and it isn't saved.
+        with self._lock:
+            manifest = self.read_manifest()
+            if manifest.get("created_at") != created_at:
+                return False
+            if segments is not None and [entry["name"] for entry in manifest["segments"][:len(segments)]] != segments:
+                return False
+            
+            index_file = f"index-v{manifest['version'] + 1}.faiss"
+            tmp_path = self.store_path / f".tmp-{index_file}"
+            faiss.write_index(index, str(tmp_path))
+            with open(tmp_path, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.store_path / index_file)
+            _fsync_dir(self.store_path)
+            
+            old_index = manifest.get("index")
+            manifest["index"] = {**index_info, "file": index_file}
+            self._commit_manifest(manifest, content_changed=False)
+        
+        if old_index and old_index.get("file"):
+            (self.store_path / old_index["file"]).unlink(missing_ok=True)
+        return True
+    
+    def clear_index(self):
+        with self._lock:
+            manifest = self.read_manifest()
+            old_index = manifest.pop("index", None)
+            if old_index is None:
+                return
+            self._commit_manifest(manifest, content_changed=False)
+        if old_index.get("file"):
+            (self.store_path / old_index["file"]).unlink(missing_ok=True)
+    
+    def load_index(self, manifest: dict) -> Optional[faiss.Index]:
+        index_info = manifest.get("index")
+        if not index_info or index_info["rows"] > manifest.get("row_count", manifest.get("chunk_count", 0)):
+            return None
+        return faiss.read_index(str(self.store_path / index_info["file"]))
+    
+    def open_segment(self, segment_name: str) -> ChunkSegment:
+        return ChunkSegment(self.segments_dir / segment_name)
+    
+    def load_vectors(self, segment_name: str) -> np.ndarray:
+        return np.load(self.segments_dir / segment_name / "vectors.npy", mmap_mode="r")
+    
+    def read_segment(self, segment_name: str) -> Tuple[List[str], List[Document], np.ndarray]:
+        segment = self.open_segment(segment_name)
+        ids = segment.chunk_ids()
+        documents = [segment.document(row) for row in range(len(segment))]
+        return ids, documents, self.load_vectors(segment_name)
+    
+    def read_duplicates(self, segment_name: str) -> List[dict]:
+        path = self.segments_dir / segment_name / DUPLICATES_FILE
+        if not path.exists():
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    def iter_segments(self, manifest: Optional[dict] = None) -> Iterator[Tuple[ChunkSegment, np.ndarray, np.ndarray]]:
+        # Yields each segment with its vectors and its tombstoned rows.
+        manifest = manifest or self.read_manifest()
+        for segment in manifest["segments"]:
+            yield self.open_segment(segment["name"]), self.load_vectors(segment["name"]), self.load_tombstones(segment)
+    
+    def compact(self, merge_factor: int = 4) -> bool:
+        # Merges the newest run of small segments chosen by plan_compaction into one; older,
+        # larger segments are left as they are.
+        with self._lock:
+            manifest = self.read_manifest()
+            start = plan_compaction([segment["count"] - segment.get("deleted", 0) for segment in manifest["segments"]], merge_factor)
+            if start is None:
+                return False
+            kept = [segment["name"] for segment in manifest["segments"][:start]]
+            merging = manifest["segments"][start:]
+            to_merge = [(segment["name"], segment.get("tombstones")) for segment in merging]
+        
+        # Tombstoned rows are dropped here, which shifts the rows after them, so an ANN index
+        # that covers any of those rows is discarded.
+        ids, documents, vectors, duplicates = [], [], [], []
+        purged = offset = 0
+        for entry in merging:
+            segment_ids, segment_documents, segment_vectors = self.read_segment(entry["name"])
+            deleted = set(self.load_tombstones(entry).tolist())
+            live = [row for row in range(len(segment_ids)) if row not in deleted]
+            ids.extend(segment_ids[row] for row in live)
+            documents.extend(segment_documents[row] for row in live)
+            vectors.append(np.asarray(segment_vectors)[live] if deleted else segment_vectors)
+            # Linked rows move with the rows they belong to; links of purged rows go with them.
+            merged_rows = {row: offset + i for i, row in enumerate(live)}
+            for duplicate in self.read_duplicates(entry["name"]):
+                if "row" not in duplicate:
+                    duplicates.append(duplicate)
+                elif duplicate["row"] in merged_rows:
+                    duplicates.append(dict(duplicate, row=merged_rows[duplicate["row"]]))
+            offset += len(live)
+            purged += len(deleted)
+        
+        with self._lock:
+            manifest = self.read_manifest()
+            current = [(segment["name"], segment.get("tombstones")) for segment in manifest["segments"]]
+            # Segments appended while we were merging stay after the merged one; if anything
+            # else changed (the store was rebuilt, or merged chunks were deleted) this compaction
+            # is simply abandoned.
+            if [name for name, _ in current[:start]] != kept or current[start:start + len(to_merge)] != to_merge:
+                return False
+            merged = self._write_segment(manifest, ids, documents, np.concatenate(vectors), duplicates)
+            start_row = sum(segment["count"] for segment in manifest["segments"][:start])
+            manifest["segments"] = manifest["segments"][:start] + [merged] + manifest["segments"][start + len(to_merge):]
+            index = manifest.get("index")
+            dropped_index = manifest.pop("index") if purged and index and index["rows"] > start_row else None
+            self._commit_manifest(manifest, content_changed=False)
+        if dropped_index:
+            (self.store_path / dropped_index["file"]).unlink(missing_ok=True)
+        return True
+    
+    def remove_unreferenced_segments(self):
+        # The segments a compaction replaced stay on disk until every loaded store has moved off
+        # them (see VectorStoreManager._compact); anything left by an earlier crash goes too.
+        with self._lock:
+            self._remove_unreferenced_segments(self.read_manifest())
+    
+    def _remove_unreferenced_segments(self, manifest: dict):
+        referenced = {segment["name"] for segment in manifest["segments"]}
+        if not self.segments_dir.exists():
+            return
+        for item in self.segments_dir.iterdir():
+            if item.is_dir() and item.name not in referenced:
+                shutil.rmtree(item, ignore_errors=True)
\ No newline at end of file
@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmark import HashingEmbeddings  # noqa: E402
+from vector_store_manager import LoadedStoreCache, VectorStoreManager  # noqa: E402
+
+
+@pytest.fixture
+def embeddings():
+    return HashingEmbeddings(dimension=32)
+
+
+@pytest.fixture
+def manager(tmp_path, embeddings):
+    return VectorStoreManager(embeddings=embeddings, vector_stores_dir=tmp_path / "stores", store_cache=LoadedStoreCache())
@@ -0,0 +1,38 @@
+import faiss
+import numpy as np
+from langchain.schema import Document
+
+import ann_index
+from segment_store import SegmentStore
+
+
+def test_training_sample_draws_from_every_part():
+    parts = [np.full((n, 4), i, dtype=np.float32) for i, n in enumerate((100, 5, 300))]
+    sample = ann_index.training_sample(parts, size=81)
+    assert sample.shape == (81, 4)
+    assert set(sample[:, 0].tolist()) <= {0.0, 1.0, 2.0}
+    assert (sample[:, 0] == 2).sum() > (sample[:, 0] == 0).sum()
+    # Fewer rows than the sample size: every row is used once.
+    assert len(ann_index.training_sample(parts, size=1000)) == 405
+
+
+def test_unbuilt_int8_index_is_trained_on_every_segment(manager, monkeypatch):
+    # Without a saved index, a compressed store must learn its int8 ranges from all segments:
+    # the later, single-word chunks here have much larger components than the first batch.
+    monkeypatch.setattr(manager, "_maybe_rebuild_index", lambda store_name: None)
+    spec = {"type": "flat", "dtype": "int8"}
+    wordy = [Document(page_content=" ".join(f"w{i}_{j}" for j in range(30)), metadata={"filename": "a.pdf", "page": i}) for i in range(20)]
+    short = [Document(page_content=f"term{i}", metadata={"filename": "b.pdf", "page": i}) for i in range(20)]
+    vector_store = manager.ingest_document_batches([wordy], "kb", index_spec=spec)
+    manager.ingest_document_batches([short], "kb", vector_store, index_spec=spec)
+
+    segment_store = SegmentStore(manager.vector_stores_dir / "kb")
+    manifest = segment_store.read_manifest()
+    assert manifest.get("index") is None and len(manifest["segments"]) == 2
+    loaded = manager._read_segments("kb", segment_store, manifest)
+
+    vectors = np.concatenate([vectors for _, vectors, _ in segment_store.iter_segments(manifest)])
+    trained = faiss.vector_to_array(faiss.downcast_index(loaded.index).sq.trained)
+    vmin, vdiff = trained[:vectors.shape[1]], trained[vectors.shape[1]:]
+    assert np.all(vmin <= vectors.min(axis=0) + 1e-6)
+    assert np.all(vmin + vdiff >= vectors.max(axis=0) - 1e-6)
@@ -0,0 +1,50 @@
+import threading
+
+from langchain.schema import Document
+
+from chunk_store import ChunkSegment, ChunkStore, write_chunk_segment
+
+
+def _write_segments(tmp_path, segments: int, rows: int):
+    written = []
+    for s in range(segments):
+        segment_dir = tmp_path / f"seg-{s}"
+        segment_dir.mkdir()
+        ids = [f"{s:04d}{row:08d}" for row in range(rows)]
+        write_chunk_segment(segment_dir, ids, [Document(page_content=f"chunk {s}/{row}", metadata={"filename": f"f{s}.pdf"}) for row in range(rows)])
+        written.append(ChunkSegment(segment_dir))
+    return written
+
+
+def test_lookup_and_tombstones(tmp_path):
+    first, second = _write_segments(tmp_path, 2, 3)
+    store = ChunkStore([first])
+    store.attach_segment(second, deleted_rows=[1])
+    assert store.search("000000000002").page_content == "chunk 0/2"
+    assert store.search("000100000001") == "ID 000100000001 not found."
+    assert len(store) == 5
+    store.delete(["000000000000"])
+    assert len(store) == 4
+
+
+def test_concurrent_first_lookups_see_every_chunk(tmp_path):
+    # The id map is built lazily by whichever lookup comes first; the others must wait for the
+    # complete map rather than search a half-built one.
+    segments = _write_segments(tmp_path, 4, 20_000)
+    for attempt in range(3):
+        store = ChunkStore(segments)
+        barrier = threading.Barrier(16)
+        missing = []
+        
+        def lookup(worker):
+            barrier.wait()
+            chunk_id = f"{3:04d}{19_999 - worker:08d}"
+            if not isinstance(store.search(chunk_id), Document):
+                missing.append(chunk_id)
+        
+        threads = [threading.Thread(target=lookup, args=(worker,)) for worker in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert missing == []
@@ -0,0 +1,178 @@
+import threading
+
+import faiss
+from langchain.schema import Document
+
+from segment_store import SegmentStore, plan_compaction
+
+
+def _batch(batch: int, size: int = 5):
+    return [
+        Document(page_content=f"batch {batch} chunk {i} term{batch}x{i} " + " ".join(f"w{batch}_{i}_{j}" for j in range(5)),
+                 metadata={"filename": f"file{batch}.pdf", "page": i})
+        for i in range(size)
+    ]
+
+
+def _ingest(manager, batches, store_name="kb"):
+    vector_store = None
+    for batch in batches:
+        vector_store = manager.ingest_document_batches([batch], store_name, vector_store, index_spec="flat")
+    return vector_store
+
+
+def test_plan_merges_only_the_small_newest_segments():
+    assert plan_compaction([10_000, 100, 100, 100, 100]) == 1
+    assert plan_compaction([10_000, 100, 100, 100]) is None
+    # A smaller trailing batch still joins the run of its larger neighbours.
+    assert plan_compaction([10_000, 300, 300, 300, 300, 10]) == 1
+    assert plan_compaction([10_000, 300, 300, 300, 10]) is None
+    assert plan_compaction([300, 300, 300, 300, 300]) == 0
+    assert plan_compaction([]) is None
+
+
+def test_rows_are_rewritten_a_logarithmic_number_of_times():
+    counts, rewritten = [], 0
+    for _ in range(200):
+        counts.append(256)
+        while len(counts) >= 8:
+            start = plan_compaction(counts)
+            if start is None:
+                break
+            rewritten += sum(counts[start:])
+            counts = counts[:start] + [sum(counts[start:])]
+    total = 256 * 200
+    assert sum(counts) == total
+    assert len(counts) < 8
+    # Merging everything on every compaction would rewrite the store ~25 times over here.
+    assert rewritten < 6 * total
+
+
+def test_compaction_keeps_every_chunk(manager):
+    manager.compaction_threshold = 100
+    vector_store = _ingest(manager, [_batch(b) for b in range(6)])
+    manager.delete_file("kb", "file2.pdf", vector_store)
+    before = {doc.page_content for doc in vector_store.docstore._pending.values()} | {
+        vector_store.docstore.search(chunk_id).page_content for chunk_id in vector_store.index_to_docstore_id.values()
+    }
+    
+    assert manager.compact_vector_store("kb")
+    segment_store = SegmentStore(manager.vector_stores_dir / "kb")
+    manifest = segment_store.read_manifest()
+    assert len(manifest["segments"]) == 1
+    assert manifest["chunk_count"] == manifest["row_count"] == 25
+    
+    reloaded = manager._read_store("kb")
+    after = {reloaded.docstore.search(chunk_id).page_content for chunk_id in reloaded.index_to_docstore_id.values()}
+    assert after == before
+    assert not any("batch 2 " in text for text in after)
+
+
+def test_overlapping_compactions_are_refused(manager, monkeypatch):
+    manager.compaction_threshold = 100
+    _ingest(manager, [_batch(b) for b in range(8)])
+    
+    started, release = threading.Event(), threading.Event()
+    compact = SegmentStore.compact
+    
+    def slow_compact(self, *args, **kwargs):
+        started.set()
+        release.wait(5)
+        return compact(self, *args, **kwargs)
+    
+    monkeypatch.setattr(SegmentStore, "compact", slow_compact)
+    errors = []
+    
+    def run():
+        try:
+            manager.compact_vector_store("kb")
+        except Exception as e:
+            errors.append(e)
+    
+    first = threading.Thread(target=run)
+    first.start()
+    assert started.wait(5)
+    assert manager.compact_vector_store("kb") is False
+    assert manager.compact_vector_store("kb", background=True) is False
+    release.set()
+    first.join()
+    assert errors == []
+    assert manager.compact_vector_store("kb") is False  # nothing left to merge
+
+
+def test_ingestion_triggers_compaction_without_errors(manager):
+    manager.compaction_threshold = 4
+    vector_store = _ingest(manager, [_batch(b) for b in range(12)])
+    for thread in threading.enumerate():
+        if thread.name.startswith(("compact-", "index-")):
+            thread.join(10)
+    manifest = SegmentStore(manager.vector_stores_dir / "kb").read_manifest()
+    assert manifest["chunk_count"] == 60
+    assert len(manifest["segments"]) < 12
+    assert len(vector_store.index_to_docstore_id) == 60
+
+
+def _wait_for_background_work():
+    for thread in threading.enumerate():
+        if thread.name.startswith(("compact-", "index-")):
+            thread.join(10)
+
+
+def _segment_dirs(manager, store_name="kb"):
+    return sorted(item.name for item in (manager.vector_stores_dir / store_name / "segments").iterdir() if item.is_dir())
+
+
+def test_live_stores_follow_compaction(manager, embeddings):
+    from vector_store_manager import LoadedStoreCache, VectorStoreManager
+    
+    manager.compaction_threshold = 100
+    _ingest(manager, [_batch(b) for b in range(10)])
+    cached = manager.load_vector_store("kb")
+    # A store loaded through another cache is not the cached object, but reads the same files.
+    other = VectorStoreManager(embeddings=embeddings, vector_stores_dir=manager.vector_stores_dir, store_cache=LoadedStoreCache())
+    uncached = other.load_vector_store("kb")
+    assert uncached is not cached
+    version = cached.content_version
+    
+    assert manager.compact_vector_store("kb")
+    manifest = SegmentStore(manager.vector_stores_dir / "kb").read_manifest()
+    on_disk = [entry["name"] for entry in manifest["segments"]]
+    assert _segment_dirs(manager) == sorted(on_disk)
+    assert manager.load_vector_store("kb") is cached
+    assert cached.content_version == version
+    
+    for vector_store in (cached, uncached):
+        assert [segment.path.name for _, segment, _ in vector_store.segments] == on_disk
+        hits = vector_store.similarity_search("term7x3", k=1, filter={"filename": "file7.pdf"})
+        assert hits and hits[0].page_content.startswith("batch 7 chunk 3")
+        assert vector_store.lexical_search("term4x1", k=1)
+        assert len(vector_store.index_to_docstore_id) == 50
+
+
+def test_cached_store_gets_the_rebuilt_index_after_compaction(manager):
+    manager.compaction_threshold = 4
+    vector_store = None
+    for b in range(8):
+        vector_store = manager.ingest_document_batches([_batch(b)], "kb", vector_store, index_spec={"type": "hnsw", "m": 8})
+    _wait_for_background_work()
+    
+    cached = manager.load_vector_store("kb")
+    manifest = SegmentStore(manager.vector_stores_dir / "kb").read_manifest()
+    assert manifest["index"]["type"] == "hnsw"
+    assert isinstance(faiss.downcast_index(cached.index), faiss.IndexHNSW)
+    assert cached.index.ntotal == manifest["row_count"]
+    assert [segment.path.name for _, segment, _ in cached.segments] == [entry["name"] for entry in manifest["segments"]]
+    assert _segment_dirs(manager) == sorted(entry["name"] for entry in manifest["segments"])
+
+
+def test_index_is_not_saved_over_a_different_layout(manager):
+    manager.compaction_threshold = 100
+    _ingest(manager, [_batch(b) for b in range(4)])
+    segment_store = SegmentStore(manager.vector_stores_dir / "kb")
+    manifest = segment_store.read_manifest()
+    built_from = [entry["name"] for entry in manifest["segments"]]
+    assert manager.compact_vector_store("kb")
+    
+    index = faiss.IndexFlatL2(32)
+    assert not segment_store.save_index(index, {"type": "hnsw", "rows": 0}, manifest["created_at"], built_from)
+    assert "index" not in segment_store.read_manifest()
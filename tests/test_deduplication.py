@@ -0,0 +1,62 @@
+from langchain.schema import Document
+
+SHARED = "The warranty covers parts and labour for twenty four months from the date of purchase " * 3
+
+
+def _file(name: str, extra: int = 3):
+    docs = [Document(page_content=SHARED, metadata={"filename": name, "page": 0})]
+    docs += [
+        Document(page_content=f"{name} unique paragraph {i} " + " ".join(f"{name}-{i}-{j}" for j in range(12)), metadata={"filename": name, "page": i + 1})
+        for i in range(extra)
+    ]
+    return docs
+
+
+def _texts(vector_store, filter=None):
+    return [doc.page_content for doc in vector_store.similarity_search(SHARED, k=20, filter=filter)]
+
+
+def test_duplicates_within_a_file_are_skipped(manager):
+    docs = _file("a.pdf") + [Document(page_content=SHARED, metadata={"filename": "a.pdf", "page": 9})]
+    manager.ingest_document_batches([docs], "kb", index_spec="flat")
+    assert manager.get_store_info("kb")["duplicate_count"] == 1
+
+
+def test_text_shared_between_files_is_linked_not_embedded(manager, monkeypatch):
+    vector_store = manager.ingest_document_batches([_file("a.pdf")], "kb", index_spec="flat")
+    embedded = []
+    embed_documents = manager.embed_documents
+    monkeypatch.setattr(manager, "embed_documents", lambda documents: embedded.extend(documents) or embed_documents(documents))
+    vector_store = manager.ingest_document_batches([_file("b.pdf")], "kb", vector_store, index_spec="flat")
+    assert manager.get_store_info("kb")["duplicate_count"] == 1
+    assert len(embedded) == 3 and SHARED not in [doc.page_content for doc in embedded]
+    
+    assert _texts(vector_store).count(SHARED) == 1
+    assert SHARED in _texts(vector_store, {"filename": "b.pdf"})
+    assert manager.delete_file("kb", "b.pdf", vector_store) == 4
+    assert SHARED in _texts(vector_store, {"filename": "a.pdf"})
+
+
+def test_duplicate_takes_over_when_the_original_file_is_deleted(manager):
+    vector_store = manager.ingest_document_batches([_file("a.pdf")], "kb", index_spec="flat")
+    vector_store = manager.ingest_document_batches([_file("b.pdf")], "kb", vector_store, index_spec="flat")
+    
+    assert manager.delete_file("kb", "a.pdf", vector_store) == 4
+    for store in (vector_store, manager._read_store("kb")):
+        assert _texts(store).count(SHARED) == 1
+        assert SHARED in _texts(store, {"filename": "b.pdf"})
+
+
+def test_links_survive_compaction(manager):
+    manager.compaction_threshold = 100
+    vector_store = None
+    for name in ("a.pdf", "b.pdf", "c.pdf", "d.pdf", "e.pdf"):
+        vector_store = manager.ingest_document_batches([_file(name)], "kb", vector_store, index_spec="flat")
+    manager.delete_file("kb", "a.pdf", vector_store)
+    
+    assert manager.compact_vector_store("kb")
+    reloaded = manager._read_store("kb")
+    assert manager.get_store_info("kb")["duplicate_count"] == 4
+    assert _texts(reloaded).count(SHARED) == 1
+    for name in ("b.pdf", "c.pdf", "d.pdf", "e.pdf"):
+        assert SHARED in _texts(reloaded, {"filename": name})
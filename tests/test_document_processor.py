@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import SyntheticUpload, make_pdf
+from document_processor import DocumentProcessor, _ordered_results
+from metrics import metrics
+
+
+def test_ordered_results_bounds_tasks_in_flight():
+    submitted = []
+    lock = threading.Lock()
+
+    def work(task):
+        with lock:
+            submitted.append(task)
+        return task * 2
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = _ordered_results(executor, work, range(100), window=4)
+        taken = []
+        for result in results:
+            taken.append(result)
+            # Nothing beyond the window ahead of the consumer is ever submitted.
+            assert len(submitted) <= len(taken) + 4
+    assert taken == [task * 2 for task in range(100)]
+
+
+def test_parallel_parsing_keeps_page_order():
+    uploads = [
+        SyntheticUpload(f"doc{i}.pdf", make_pdf([f"file {i} page {page}" for page in range(6)]))
+        for i in range(3)
+    ]
+    processor = DocumentProcessor(parallel=True, max_workers=2, pages_per_task=2)
+    pages = [(doc.metadata["filename"], doc.metadata["page"]) for doc in processor.iter_documents_parallel(uploads)]
+    assert [filename for filename, _ in pages] == [name for name in ("doc0.pdf", "doc1.pdf", "doc2.pdf") for _ in range(6)]
+    assert processor.failed_files == []
+
+
+def _pages_parsed():
+    return sum(counter["value"] for counter in metrics.snapshot()["counters"] if counter["name"] == "pages_parsed")
+
+
+def test_single_task_pages_are_counted_once():
+    upload = SyntheticUpload("small.pdf", make_pdf([f"page {page}" for page in range(3)]))
+    processor = DocumentProcessor(parallel=True, max_workers=2, pages_per_task=10)
+    before = _pages_parsed()
+    assert len(list(processor.iter_documents_parallel([upload]))) == 3
+    assert _pages_parsed() - before == 3
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from vector_store_manager import EmbeddingScheduler
+
+
+class FakeResponse:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = FakeResponse(headers)
+
+
+class FakeEndpoint:
+    # An embeddings client whose first calls fail with the given errors.
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.calls = []
+        self._lock = threading.Lock()
+    
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+            if self.failures:
+                raise self.failures.pop(0)
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def _scheduler(endpoint, **kwargs):
+    kwargs.setdefault("base_delay", 0.0)
+    return EmbeddingScheduler(endpoint, **kwargs)
+
+
+def test_results_keep_input_order_across_batches():
+    endpoint = FakeEndpoint()
+    texts = [f"text {'x' * i}" for i in range(25)]
+    vectors = _scheduler(endpoint, max_batch_size=4, max_concurrency=3).embed(texts)
+    assert vectors == [[float(len(text)), 1.0] for text in texts]
+    assert len(endpoint.calls) == 7
+    assert all(len(batch) <= 4 for batch in endpoint.calls)
+
+
+def test_batches_respect_token_budget():
+    scheduler = _scheduler(FakeEndpoint(), max_batch_tokens=10)
+    texts = ["word " * 4] * 6
+    batches = scheduler.make_batches(texts)
+    for batch in batches:
+        tokens = sum(len(scheduler.encoding.encode(texts[i], disallowed_special=())) for i in batch)
+        assert tokens <= 10 or len(batch) == 1
+    assert sorted(i for batch in batches for i in batch) == list(range(6))
+
+
+def test_rate_limit_is_retried_with_retry_after():
+    endpoint = FakeEndpoint([FakeAPIError(429, {"retry-after": "0"}), FakeAPIError(503)])
+    scheduler = _scheduler(endpoint)
+    assert scheduler.embed(["a", "bb"]) == [[1.0, 1.0], [2.0, 1.0]]
+    assert scheduler.retries == 2
+
+
+def test_client_errors_are_not_retried():
+    endpoint = FakeEndpoint([FakeAPIError(400)])
+    scheduler = _scheduler(endpoint)
+    with pytest.raises(FakeAPIError):
+        scheduler.embed(["a"])
+    assert len(endpoint.calls) == 1
+
+
+def test_gives_up_after_max_retries():
+    endpoint = FakeEndpoint([FakeAPIError(500)] * 3)
+    with pytest.raises(FakeAPIError):
+        _scheduler(endpoint, max_retries=2).embed(["a"])
+    assert len(endpoint.calls) == 3
+
+
+def test_on_batch_sees_every_batch():
+    seen = []
+    texts = [str(i) for i in range(10)]
+    _scheduler(FakeEndpoint(), max_batch_size=3).embed(texts, on_batch=lambda batch, vectors: seen.extend(batch))
+    assert sorted(seen) == sorted(texts)
+
+
+
+class RecordingOpenAIEmbeddings:
+    # Stands in for OpenAIEmbeddings, whose client needs the network to be constructed.
+    def __init__(self, max_retries=2, **kwargs):
+        self.max_retries = max_retries
+        self.kwargs = kwargs
+
+
+def test_only_document_batches_skip_client_retries(tmp_path, monkeypatch):
+    import langchain.embeddings
+    from vector_store_manager import LoadedStoreCache, VectorStoreManager
+    
+    monkeypatch.setattr(langchain.embeddings, "OpenAIEmbeddings", RecordingOpenAIEmbeddings)
+    manager = VectorStoreManager(
+        openai_api_base="http://127.0.0.1:9/v1", vector_stores_dir=tmp_path / "stores", store_cache=LoadedStoreCache()
+    )
+    # Query embeddings don't go through the scheduler, so their client keeps its own retries.
+    assert manager.embeddings.max_retries == 2
+    assert manager.embedding_scheduler.embeddings.max_retries == 0
+    assert manager.embedding_scheduler.embeddings.kwargs == manager.embeddings.kwargs
@@ -0,0 +1,84 @@
+from langchain.schema import Document
+
+from segment_store import SegmentStore
+
+
+def _file(name, file_hash, texts):
+    return [
+        Document(page_content=text, metadata={"filename": name, "page": page, "file_hash": file_hash})
+        for page, text in enumerate(texts)
+    ]
+
+
+def _text(i):
+    return f"paragraph {i} " + " ".join(f"p{i}_{j}" for j in range(12))
+
+
+def _recording(manager, monkeypatch):
+    embedded = []
+    embed_documents = manager.embed_documents
+    monkeypatch.setattr(manager, "embed_documents", lambda documents: embedded.extend(documents) or embed_documents(documents))
+    return embedded
+
+
+def _stored_texts(vector_store, filename):
+    return sorted(doc.page_content for doc in vector_store.file_chunks(filename)[1])
+
+
+def test_same_bytes_are_skipped(manager, monkeypatch):
+    texts = [_text(i) for i in range(4)]
+    vector_store = manager.ingest_document_batches([_file("a.pdf", "h1", texts)], "kb", index_spec="flat")
+    manifest = SegmentStore(manager.vector_stores_dir / "kb").read_manifest()
+    embedded = _recording(manager, monkeypatch)
+
+    manager.ingest_document_batches([_file("a.pdf", "h1", texts)], "kb", vector_store, index_spec="flat")
+    assert embedded == []
+    assert manager.last_ingest_stats["unchanged_files"] == 1
+    assert SegmentStore(manager.vector_stores_dir / "kb").read_manifest()["segments"] == manifest["segments"]
+
+
+def test_changed_bytes_with_the_same_chunks_only_record_the_hash(manager, monkeypatch):
+    texts = [_text(i) for i in range(4)]
+    vector_store = manager.ingest_document_batches([_file("a.pdf", "h1", texts)], "kb", index_spec="flat")
+    embedded = _recording(manager, monkeypatch)
+
+    manager.ingest_document_batches([_file("a.pdf", "h2", texts)], "kb", vector_store, index_spec="flat")
+    assert embedded == []
+    assert manager.get_file_hashes("kb") == {"a.pdf": "h2"}
+    assert manager.last_ingest_stats["unchanged_chunks"] == 4
+    assert len(SegmentStore(manager.vector_stores_dir / "kb").read_manifest()["segments"]) == 1
+
+
+def test_removed_chunks_are_deleted(manager, monkeypatch):
+    texts = [_text(i) for i in range(4)]
+    vector_store = manager.ingest_document_batches([_file("a.pdf", "h1", texts)], "kb", index_spec="flat")
+    embedded = _recording(manager, monkeypatch)
+
+    vector_store = manager.ingest_document_batches([_file("a.pdf", "h2", texts[:2])], "kb", vector_store, index_spec="flat")
+    assert embedded == []
+    assert manager.last_ingest_stats["deleted"] == 2
+    assert manager.get_file_hashes("kb") == {"a.pdf": "h2"}
+    assert _stored_texts(vector_store, "a.pdf") == sorted(texts[:2])
+    assert _stored_texts(manager._read_store("kb"), "a.pdf") == sorted(texts[:2])
+
+
+def test_moved_chunks_reuse_their_vectors(manager, monkeypatch):
+    texts = [_text(i) for i in range(4)]
+    vector_store = manager.ingest_document_batches([_file("a.pdf", "h1", texts)], "kb", index_spec="flat")
+    embedded = _recording(manager, monkeypatch)
+
+    # A new first page shifts every other chunk to the next page.
+    changed = [_text(9)] + texts
+    vector_store = manager.ingest_document_batches([_file("a.pdf", "h2", changed)], "kb", vector_store, index_spec="flat")
+    assert [doc.page_content for doc in embedded] == [_text(9)]
+    assert manager.last_ingest_stats["reused"] == 4
+    assert _stored_texts(vector_store, "a.pdf") == sorted(changed)
+    assert manager.get_file_hashes("kb") == {"a.pdf": "h2"}
+
+
+def test_hash_is_recorded_when_every_new_chunk_is_a_near_duplicate(manager):
+    vector_store = manager.ingest_document_batches(
+        [_file("a.pdf", "a1", [_text(0)]) + _file("b.pdf", "b1", [_text(1)])], "kb", index_spec="flat"
+    )
+    manager.ingest_document_batches([_file("b.pdf", "b2", [_text(1), _text(0)])], "kb", vector_store, index_spec="flat")
+    assert manager.get_file_hashes("kb") == {"a.pdf": "a1", "b.pdf": "b2"}
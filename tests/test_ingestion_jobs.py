@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+from langchain.schema import Document
+
+from benchmark import SyntheticUpload
+from ingestion_jobs import DONE, FAILED, IngestionJobQueue
+
+
+class FakeProcessor:
+    # Turns each line of an upload into a chunk and hands out one batch per file. Jobs wait for
+    # each other at the barrier after their first batch, so they are both mid-ingestion at once.
+    def __init__(self, barrier=None, fail_on=None):
+        self.barrier = barrier
+        self.fail_on = fail_on
+        self.failed_files = []
+
+    def iter_chunk_batches(self, uploads, on_progress=None):
+        for i, upload in enumerate(uploads):
+            if upload.name == self.fail_on:
+                raise ValueError(f"cannot parse {upload.name}")
+            lines = upload.getvalue().decode("utf-8").splitlines()
+            yield [
+                Document(page_content=line, metadata={"filename": upload.name, "page": row, "file_hash": f"{upload.name}-hash"})
+                for row, line in enumerate(lines)
+            ]
+            if i == 0 and self.barrier is not None:
+                self.barrier.wait(timeout=10)
+
+
+def _upload(name, lines):
+    return SyntheticUpload(name, "\n".join(f"{name} line {i} word{i} " + " ".join(f"t{name}{i}{j}" for j in range(4)) for i in range(lines)).encode("utf-8"))
+
+
+def _wait(queue, job_ids, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        jobs = [queue.get(job_id) for job_id in job_ids]
+        if all(job["status"] not in ("queued", "running") for job in jobs):
+            return jobs
+        time.sleep(0.05)
+    raise AssertionError("jobs did not finish")
+
+
+def test_concurrent_jobs_keep_their_own_stats(manager, tmp_path):
+    barrier = threading.Barrier(2)
+    queue = IngestionJobQueue(
+        manager, lambda: FakeProcessor(barrier), db_path=tmp_path / "jobs.sqlite", max_workers=2, poll_interval=0.05
+    )
+    try:
+        first = queue.submit("kb1", [_upload("a.pdf", 3), _upload("b.pdf", 2)], index_spec="flat")
+        second = queue.submit("kb2", [_upload("c.pdf", 7), _upload("d.pdf", 4)], index_spec="flat")
+        first_job, second_job = _wait(queue, [first, second])
+    finally:
+        queue.shutdown()
+
+    assert first_job["status"] == second_job["status"] == DONE
+    assert first_job["stats"]["indexed"] == 5 and first_job["stats"]["batches"] == 2
+    assert second_job["stats"]["indexed"] == 11 and second_job["stats"]["batches"] == 2
+    assert set(manager.get_file_hashes("kb1")) == {"a.pdf", "b.pdf"}
+    assert set(manager.get_file_hashes("kb2")) == {"c.pdf", "d.pdf"}
+
+
+def test_failed_job_rolls_back_its_new_files(manager, tmp_path):
+    queue = IngestionJobQueue(
+        manager, lambda: FakeProcessor(fail_on="bad.pdf"), db_path=tmp_path / "jobs.sqlite", max_workers=1, poll_interval=0.05
+    )
+    try:
+        done = queue.submit("kb", [_upload("a.pdf", 3)], index_spec="flat")
+        _wait(queue, [done])
+        failed = queue.submit("kb", [_upload("b.pdf", 3), _upload("bad.pdf", 1)], index_spec="flat")
+        (job,) = _wait(queue, [failed])
+    finally:
+        queue.shutdown()
+
+    assert job["status"] == FAILED and "cannot parse bad.pdf" in job["error"]
+    assert job["new_files"] == ["b.pdf", "bad.pdf"]
+    assert set(manager.get_file_hashes("kb")) == {"a.pdf"}
+
+
+def test_job_fails_instead_of_replacing_a_store_that_does_not_load(manager, tmp_path):
+    queue = IngestionJobQueue(manager, lambda: FakeProcessor(), db_path=tmp_path / "jobs.sqlite", max_workers=1, poll_interval=0.05)
+    try:
+        _wait(queue, [queue.submit("kb", [_upload("old.pdf", 3)], index_spec="flat")])
+        segments_dir = manager.vector_stores_dir / "kb" / "segments"
+        (segment_dir,) = [item for item in segments_dir.iterdir() if item.is_dir()]
+        (segment_dir / "vectors.npy").unlink()
+        manager.store_cache.invalidate(manager._cache_key("kb"))
+        (job,) = _wait(queue, [queue.submit("kb", [_upload("new.pdf", 2)], index_spec="flat")])
+    finally:
+        queue.shutdown()
+
+    assert job["status"] == FAILED and "could not be loaded" in job["error"]
+    assert segment_dir.exists()
+    assert set(manager.get_file_hashes("kb")) == {"old.pdf"}
+
+
+def test_ingesting_without_a_loaded_store_never_replaces_it(manager):
+    manager.ingest_document_batches([[Document(page_content="first chunk", metadata={"filename": "old.pdf"})]], "kb", index_spec="flat")
+    with pytest.raises(ValueError, match="already exists"):
+        manager.ingest_document_batches([[Document(page_content="second chunk", metadata={"filename": "new.pdf"})]], "kb", None, index_spec="flat")
+    vector_store = manager.load_vector_store("kb")
+    assert [vector_store.docstore.search(chunk_id).page_content for chunk_id in vector_store.index_to_docstore_id.values()] == ["first chunk"]
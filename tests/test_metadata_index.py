@@ -0,0 +1,33 @@
+from datetime import date
+
+from metadata_index import FIELDS_FILE, load_segment_fields
+
+
+class LegacySegment:
+    # A segment written before fields.json existed.
+    def __init__(self, path, pages):
+        self.path = path
+        self.pages = pages
+
+    def __len__(self):
+        return len(self.pages)
+
+    def metadata(self, row):
+        return {"filename": "a.pdf", "page": self.pages[row]}
+
+    def file_rows(self):
+        return {"a.pdf": list(range(len(self.pages)))}
+
+
+def test_legacy_segment_is_dated_by_its_directory(tmp_path):
+    fields = load_segment_fields(LegacySegment(tmp_path, [0, 1, 1]))
+    assert fields["page"] == {"0": [0], "1": [1, 2]}
+    assert fields["uploaded_at"] == {date.today().isoformat(): [0, 1, 2]}
+    assert (tmp_path / FIELDS_FILE).exists()
+
+
+def test_removed_segment_directory_is_not_an_error(tmp_path):
+    fields = load_segment_fields(LegacySegment(tmp_path / "seg-000001", [0, 1]))
+    assert fields["filename"] == {"a.pdf": [0, 1]}
+    assert fields["page"] == {"0": [0], "1": [1]}
+    assert fields["uploaded_at"] == {}
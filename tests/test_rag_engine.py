@@ -0,0 +1,161 @@
+from langchain.schema import Document
+from langchain_community.chat_models.fake import FakeListChatModel
+
+from rag_engine import AnswerCache, RAGEngine
+
+
+def _store(manager):
+    documents = [
+        Document(page_content=f"chunk {i} about topic{i} " + " ".join(f"w{i}_{j}" for j in range(6)),
+                 metadata={"filename": f"file{i}.pdf", "page": 0})
+        for i in range(8)
+    ]
+    return manager.ingest_document_batches([documents], "kb", None, index_spec="flat")
+
+
+def _engine(monkeypatch, **kwargs):
+    engine = RAGEngine(llm=FakeListChatModel(responses=["an answer"]), answer_cache=AnswerCache(), **kwargs)
+    retrievals = []
+    retrieve = engine.retrieve
+
+    def counting_retrieve(*args, **kwargs):
+        retrievals.append(args)
+        return retrieve(*args, **kwargs)
+
+    monkeypatch.setattr(engine, "retrieve", counting_retrieve)
+    return engine, retrievals
+
+
+def test_exact_cache_hit_skips_retrieval_and_embedding(manager, embeddings, monkeypatch):
+    vector_store = _store(manager)
+    engine, retrievals = _engine(monkeypatch, hybrid=False)
+    qa_chain = engine.create_qa_chain(vector_store)
+
+    first = engine.query(qa_chain, "Tell me about topic3")
+    assert first["success"] and not first["cached"]
+    assert len(retrievals) == 1
+
+    query_calls = embeddings.query_calls
+    second = engine.query(qa_chain, "tell me about topic3?")
+    assert second["cached"] and second["answer"] == first["answer"]
+    assert len(retrievals) == 1
+    assert embeddings.query_calls == query_calls
+    assert engine.answer_cache.exact_hits == 1 and engine.answer_cache.misses == 1
+
+
+def test_semantic_cache_hit_embeds_once_and_skips_retrieval(manager, embeddings, monkeypatch):
+    vector_store = _store(manager)
+    engine, retrievals = _engine(monkeypatch, hybrid=False)
+
+    "".join(engine.stream_query(vector_store, "Tell me about topic3")["tokens"])
+    assert len(retrievals) == 1
+
+    # Same terms, different punctuation: not an exact key, but the same embedding.
+    query_calls = embeddings.query_calls
+    result = engine.stream_query(vector_store, "Tell me, about topic3")
+    assert result["cached"]
+    assert len(retrievals) == 1
+    assert embeddings.query_calls == query_calls + 1
+    assert engine.answer_cache.semantic_hits == 1
+
+
+def test_cache_miss_reuses_the_lookup_embedding(manager, embeddings, monkeypatch):
+    vector_store = _store(manager)
+    engine, retrievals = _engine(monkeypatch, hybrid=False)
+    "".join(engine.stream_query(vector_store, "Tell me about topic3")["tokens"])
+
+    query_calls = embeddings.query_calls
+    result = engine.stream_query(vector_store, "What is chunk 5 about")
+    assert not result["cached"]
+    assert len(retrievals) == 2
+    assert embeddings.query_calls == query_calls + 1
+
+
+def test_multi_retrieve_accepts_plain_faiss_stores(manager, embeddings):
+    from langchain.vectorstores import FAISS
+
+    knowledge_base = _store(manager)
+    plain = FAISS.from_documents(
+        [Document(page_content=f"plain note about topic3 number {i}", metadata={"filename": "notes.txt"}) for i in range(3)],
+        embeddings
+    )
+    engine = RAGEngine(llm=FakeListChatModel(responses=["an answer"]), answer_cache=AnswerCache())
+    documents, _, incomplete = engine.multi_retrieve([knowledge_base, plain], "topic3", k=6)
+    assert incomplete == []
+    filenames = {doc.metadata["filename"] for doc in documents}
+    assert "notes.txt" in filenames and "file3.pdf" in filenames
+
+
+def test_abatch_query_searches_off_the_event_loop(manager, monkeypatch):
+    import asyncio
+    import threading
+
+    vector_store = _store(manager)
+    engine = RAGEngine(llm=FakeListChatModel(responses=["an answer"]), answer_cache=AnswerCache())
+    search_threads = []
+    for name in ("lexical_search", "search_positions"):
+        method = getattr(vector_store, name)
+
+        def recording(*args, _method=method, **kwargs):
+            search_threads.append(threading.current_thread())
+            return _method(*args, **kwargs)
+
+        monkeypatch.setattr(vector_store, name, recording)
+
+    results = asyncio.run(engine.abatch_query(vector_store, ["tell me about topic3", "what does chunk 5 cover"]))
+    assert all(result["success"] for result in results)
+    assert search_threads and threading.main_thread() not in search_threads
+
+
+def test_slow_store_only_costs_its_own_results(manager, embeddings):
+    import time
+
+    from langchain.vectorstores import FAISS
+
+    def plain_store(name):
+        store = FAISS.from_documents(
+            [Document(page_content=f"{name} note about topic3 number {i}", metadata={"filename": f"{name}.txt"}) for i in range(3)],
+            embeddings
+        )
+        store.store_name = name
+        return store
+
+    fast, slow = plain_store("fast"), plain_store("slow")
+    search = slow.similarity_search_with_score_by_vector
+
+    def slow_search(*args, **kwargs):
+        time.sleep(1.0)
+        return search(*args, **kwargs)
+
+    slow.similarity_search_with_score_by_vector = slow_search
+    engine = RAGEngine(llm=FakeListChatModel(responses=["an answer"]), answer_cache=AnswerCache(), max_parallel_searches=2)
+    for _ in range(4):
+        documents, _, incomplete = engine.multi_retrieve([slow, fast], "topic3", k=3, timeout=0.2)
+        assert incomplete == ["slow"]
+        assert {doc.metadata["store"] for doc in documents} == {"fast"}
+
+
+def test_abatch_query_answers_exact_hits_without_embedding(manager, embeddings, monkeypatch):
+    import asyncio
+
+    vector_store = _store(manager)
+    engine = RAGEngine(llm=FakeListChatModel(responses=["an answer"]), answer_cache=AnswerCache(), hybrid=False)
+    (first,) = asyncio.run(engine.abatch_query(vector_store, ["Tell me about topic3"]))
+    assert first["success"] and not first["cached"]
+
+    async def failing_embed(texts):
+        raise RuntimeError("embedding service unavailable")
+
+    monkeypatch.setattr(embeddings, "aembed_documents", failing_embed)
+    cached, missed = asyncio.run(engine.abatch_query(vector_store, ["tell me about topic3?", "What is chunk 5 about"]))
+    assert cached["success"] and cached["cached"] and cached["answer"] == first["answer"]
+    assert not missed["success"] and "embedding service unavailable" in missed["answer"]
+
+
+def test_semantic_cache_hit_needs_the_same_identifiers():
+    cache = AnswerCache()
+    vector = [1.0, 0.0, 0.0]
+    cache.put(("kb", 1, ""), "What is the price of PN-10234?", "answer for 10234", [], vector)
+    assert cache.get(("kb", 1, ""), "What is the price of PN-10235?", vector) is None
+    assert cache.get(("kb", 1, ""), "Price of PN-10234, please", vector)["answer"] == "answer for 10234"
+    assert cache.semantic_hits == 1 and cache.misses == 1
@@ -1,61 +1,1477 @@
+import bisect
+import json
 import os
 import pickle
-from typing import List, Optional
+import random
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import date
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
 from pathlib import Path
 
 import faiss
+import numpy as np
 from langchain.vectorstores import FAISS
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.vectorstores.utils import DistanceStrategy, maximal_marginal_relevance
 from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+import ann_index
+from chunk_store import ChunkSegment, ChunkStore, source_name
+from deduplication import NearDuplicateIndex, load_segment_links, load_segment_signatures, minhash_signatures
+from embedding_cache import EmbeddingCache
+from lexical_index import LexicalIndex, load_segment_postings
+from metadata_index import MetadataIndex, load_segment_fields, split_filter
+from metrics import metrics
+from segment_store import MANIFEST_FILE, SegmentStore
+
+
+def _is_retryable_error(error: Exception) -> bool:
+    import openai
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+class EmbeddingScheduler:
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_batch_tokens: int = 100_000,
+        max_batch_size: int = 512,
+        max_concurrency: int = 4,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+    ):
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self._encoding = None
+        self._cooldown_lock = threading.Lock()
+        self._resume_at = 0.0
+    
+    @property
+    def encoding(self):
+        # Loaded on the first batch rather than when the app starts.
+        if self._encoding is None:
+            from context_packer import load_encoding
+            self._encoding = load_encoding()
+        return self._encoding
+    
+    def make_batches(self, texts: Sequence[str]) -> List[List[int]]:
+        batches = []
+        current = []
+        current_tokens = 0
+        
+        for i, text in enumerate(texts):
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+            if current and (current_tokens + tokens > self.max_batch_tokens or len(current) >= self.max_batch_size):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += tokens
+            metrics.increment("embedding_tokens", tokens)
+        
+        if current:
+            batches.append(current)
+        return batches
+    
+    def embed(
+        self,
+        texts: Sequence[str],
+        on_batch: Optional[Callable[[List[str], List[List[float]]], None]] = None
+    ) -> List[List[float]]:
+        if not texts:
+            return []
+        
+        batches = self.make_batches(texts)
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            futures = {
+                executor.submit(self._embed_batch, [texts[i] for i in batch]): batch
+                for batch in batches
+            }
+            try:
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    vectors = future.result()
+                    for i, vector in zip(batch, vectors):
+                        results[i] = vector
+                    if on_batch:
+                        on_batch([texts[i] for i in batch], vectors)
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+        
+        return results
+    
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            self._wait_for_cooldown()
+            try:
+                with metrics.span("embedding_request") as fields:
+                    fields["texts"] = len(texts)
+                    vectors = self.embeddings.embed_documents(texts)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(vectors)}")
+                return vectors
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable_error(e):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                if getattr(e, "status_code", None) == 429:
+                    # Pause every worker, not just this one, so we stop hammering a rate-limited endpoint.
+                    with self._cooldown_lock:
+                        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                self.retries += 1
+                metrics.increment("embedding_retries", status=getattr(e, "status_code", None) or type(e).__name__)
+                attempt += 1
+                time.sleep(delay)
+    
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass
+        
+        delay = min(self.base_delay * (2 ** attempt), self.max_delay)
+        return delay * (0.5 + random.random() / 2)
+    
+    def _wait_for_cooldown(self):
+        with self._cooldown_lock:
+            wait = self._resume_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ReadWriteLock:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+    
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+    
+    @contextmanager
+    def write(self):
+        with self._condition:
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class KnowledgeBaseStore(FAISS):
+    # A FAISS store that can be shared between sessions: searches take a read lock and
+    # VectorStoreManager takes the write lock while it adds vectors in place. Deleted chunks keep
+    # their rows in the index (positions never shift) and are masked out of every search.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = ReadWriteLock()
+        self.store_name: Optional[str] = None
+        self.content_version = 0
+        self.segments: List[Tuple[int, ChunkSegment, np.ndarray]] = []
+        self.deleted_positions: Set[int] = set()
+        self._allowed: Optional[np.ndarray] = None
+        self._lexical_index: Optional[LexicalIndex] = None
+        self._metadata_index: Optional[MetadataIndex] = None
+        self._filter_masks: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._filter_masks_lock = threading.Lock()
+        self._lazy_index_lock = threading.Lock()
+        self._near_duplicate_index: Optional[NearDuplicateIndex] = None
+        # Near-duplicate rows: position -> id of the chunk it duplicates, as written at ingest,
+        # and (lazily) position -> position of the live chunk that currently stands in for it.
+        self._duplicate_links: Dict[int, str] = {}
+        self._linked_positions: Optional[Dict[int, int]] = None
+        # Set when the index holds compressed vectors (see ann_index.resolve_compression); the
+        # full-precision vectors stay in the memory-mapped segments and re-score its candidates.
+        self.compression: Optional[dict] = None
+    
+    @property
+    def row_count(self) -> int:
+        if not self.segments:
+            return 0
+        start, segment, _ = self.segments[-1]
+        return start + len(segment)
+    
+    @property
+    def dimension(self) -> int:
+        # Of the stored embeddings, which a truncated index is shorter than.
+        return self.segments[0][2].shape[1] if self.segments else self.index.d
+    
+    def vectors_at(self, positions: Sequence[int]) -> np.ndarray:
+        # Full-precision vectors for index positions, read from the segments.
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = np.asarray([start for start, _, _ in self.segments], dtype=np.int64)
+        segment_indexes = np.searchsorted(starts, positions, side="right") - 1
+        vectors = np.empty((len(positions), self.dimension), dtype=np.float32)
+        for segment_index in np.unique(segment_indexes):
+            start, _, segment_vectors = self.segments[segment_index]
+            rows = segment_indexes == segment_index
+            vectors[rows] = segment_vectors[positions[rows] - start]
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        return vectors
+    
+    def add_segment(self, start: int, segment: ChunkSegment, vectors: np.ndarray):
+        self.segments.append((start, segment, vectors))
+        links = load_segment_links(segment)
+        if links:
+            self._duplicate_links.update({start + row: chunk_id for row, chunk_id in links.items()})
+            self._linked_positions = None
+        self._allowed = None
+        self._filter_masks.clear()
+        if self._lexical_index is not None:
+            self._lexical_index.add_segment(start, load_segment_postings(segment))
+        if self._metadata_index is not None:
+            self._metadata_index.add_segment(start, load_segment_fields(segment))
+        if self._near_duplicate_index is not None:
+            self._near_duplicate_index.add_many(segment.chunk_ids(), load_segment_signatures(segment))
+    
+    def adopt(self, other: "KnowledgeBaseStore"):
+        # Takes over the contents of a store freshly loaded from the same knowledge base, so
+        # every session holding this object follows a compaction onto the new segments. The
+        # lazily built indexes are dropped and rebuilt from those. Callers hold the write lock.
+        self.index = other.index
+        self.docstore = other.docstore
+        self.index_to_docstore_id = other.index_to_docstore_id
+        self.segments = other.segments
+        self.deleted_positions = other.deleted_positions
+        self._duplicate_links = other._duplicate_links
+        self._linked_positions = None
+        self.compression = other.compression
+        self.content_version = other.content_version
+        self._allowed = None
+        with self._filter_masks_lock:
+            self._filter_masks.clear()
+        with self._lazy_index_lock:
+            self._lexical_index = None
+            self._metadata_index = None
+            self._near_duplicate_index = None
+    
+    def mark_deleted(self, positions: Iterable[int]):
+        # Callers hold the write lock.
+        positions = [int(position) for position in positions]
+        self.deleted_positions.update(positions)
+        self._linked_positions = None
+        self._allowed = None
+        self._filter_masks.clear()
+        if self._near_duplicate_index is not None:
+            self._near_duplicate_index.remove(self._chunk_ids_at(positions))
+    
+    def _chunk_ids_at(self, positions: Iterable[int]) -> List[str]:
+        starts = [start for start, _, _ in self.segments]
+        chunk_ids = []
+        for position in positions:
+            start, segment, _ = self.segments[bisect.bisect_right(starts, int(position)) - 1]
+            chunk_ids.append(segment.chunk_id(int(position) - start))
+        return chunk_ids
+    
+    def position_of(self, chunk_id: str) -> Optional[int]:
+        # Index position of a live chunk, or None if it was deleted.
+        location = self.docstore.location(chunk_id) if isinstance(self.docstore, ChunkStore) else None
+        if location is None:
+            return None
+        segment_index, row = location
+        return self.segments[segment_index][0] + row
+    
+    def linked_positions(self) -> Dict[int, int]:
+        # Near-duplicate rows are stored with their own file, page and date, so filters, file
+        # listings and deletion see them, but they share the vector of the chunk they duplicate
+        # and are never searched themselves: each maps to the live chunk that stands in for it.
+        # When that chunk is deleted, the first remaining duplicate of it takes its place.
+        # Recomputed from the links after every change, in position order, so a duplicate's
+        # chunk is always resolved before it.
+        linked = self._linked_positions
+        if linked is None:
+            linked, stand_in = {}, {}
+            for position, duplicate_of in sorted(self._duplicate_links.items()):
+                if position in self.deleted_positions:
+                    continue
+                target = stand_in.get(duplicate_of)
+                if target is None:
+                    target = self.position_of(duplicate_of)
+                chunk_id = self.index_to_docstore_id.get(position)
+                if target is None:
+                    stand_in[duplicate_of] = stand_in[chunk_id] = position
+                else:
+                    linked[position] = stand_in[chunk_id] = target
+            self._linked_positions = linked
+        return linked
+    
+    def allowed_mask(self) -> Optional[np.ndarray]:
+        # None while nothing has been deleted or linked, so the common case searches without a
+        # selector.
+        if not self.deleted_positions and not self._duplicate_links:
+            return None
+        if self._allowed is None or len(self._allowed) != self.index.ntotal:
+            allowed = np.ones(self.index.ntotal, dtype=bool)
+            allowed[np.fromiter(self.deleted_positions, dtype=np.int64, count=len(self.deleted_positions))] = False
+            allowed[np.fromiter(self.linked_positions(), dtype=np.int64)] = False
+            self._allowed = allowed
+        return self._allowed
+    
+    def file_chunks(self, filename: str) -> Tuple[List[str], List[Document], np.ndarray]:
+        # The live chunks of one source file with their vectors, read from the segments.
+        ids, documents, vectors = [], [], []
+        for start, segment, segment_vectors in self.segments:
+            rows = [row for row in segment.file_rows().get(filename, []) if start + row not in self.deleted_positions]
+            if rows:
+                ids.extend(segment.chunk_id(row) for row in rows)
+                documents.extend(segment.document(row) for row in rows)
+                vectors.append(np.asarray(segment_vectors[rows], dtype=np.float32))
+        return ids, documents, np.concatenate(vectors) if vectors else np.zeros((0, self.dimension), dtype=np.float32)
+    
+    def near_duplicate_index(self, threshold: float = 0.9) -> NearDuplicateIndex:
+        # Only needed while ingesting, so the MinHash signatures are loaded on the first add.
+        with self._lazy_index_lock:
+            if self._near_duplicate_index is None:
+                near_duplicate_index = NearDuplicateIndex(threshold)
+                for _, segment, _ in self.segments:
+                    near_duplicate_index.add_many(segment.chunk_ids(), load_segment_signatures(segment))
+                near_duplicate_index.remove(self._chunk_ids_at(self.deleted_positions))
+                self._near_duplicate_index = near_duplicate_index
+            return self._near_duplicate_index
+    
+    def lexical_index(self) -> LexicalIndex:
+        # The BM25 postings are only opened on the first keyword search.
+        with self._lazy_index_lock:
+            if self._lexical_index is None:
+                lexical_index = LexicalIndex()
+                for start, segment, _ in self.segments:
+                    lexical_index.add_segment(start, load_segment_postings(segment))
+                self._lexical_index = lexical_index
+            return self._lexical_index
+    
+    def metadata_index(self) -> MetadataIndex:
+        # Built on the first filtered search from each segment's fields.json and files.json.
+        with self._lazy_index_lock:
+            if self._metadata_index is None:
+                metadata_index = MetadataIndex()
+                for start, segment, _ in self.segments:
+                    metadata_index.add_segment(start, load_segment_fields(segment))
+                self._metadata_index = metadata_index
+            return self._metadata_index
+    
+    def search_mask(self, filter: Optional[dict] = None) -> Optional[np.ndarray]:
+        # Positions a search may return: live rows that match the indexed part of filter, as a
+        # boolean mask, or None when every row is allowed. Recent masks are kept so repeated
+        # questions in the same scope don't rebuild them.
+        allowed = self.allowed_mask()
+        indexed, _ = split_filter(filter)
+        if not indexed:
+            return allowed
+        
+        key = json.dumps(indexed, sort_keys=True, default=str)
+        with self._filter_masks_lock:
+            mask = self._filter_masks.get(key)
+        if mask is None or len(mask) != self.index.ntotal:
+            mask = self.metadata_index().mask(indexed, self.index.ntotal)
+            linked = self.linked_positions()
+            if linked:
+                # A matching near-duplicate row is found through the chunk standing in for it.
+                duplicates = np.fromiter(linked, dtype=np.int64, count=len(linked))
+                stand_ins = np.fromiter(linked.values(), dtype=np.int64, count=len(linked))
+                mask[stand_ins[mask[duplicates]]] = True
+            if allowed is not None:
+                mask &= allowed
+            with self._filter_masks_lock:
+                self._filter_masks[key] = mask
+                while len(self._filter_masks) > 32:
+                    self._filter_masks.popitem(last=False)
+        return mask
+    
+    def lexical_search(self, query: str, k: int = 20, filter: Optional[dict] = None) -> List[Tuple[int, float, int]]:
+        with self.lock.read():
+            return self.lexical_index().search(query, k, allowed=self.search_mask(filter))
+    
+    def lexical_positions_with_all(self, terms: Sequence[str], filter: Optional[dict] = None) -> np.ndarray:
+        with self.lock.read():
+            return self.lexical_index().positions_with_all(terms, allowed=self.search_mask(filter))
+    
+    def _index_search(self, vectors: np.ndarray, k: int, allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        if allowed is None:
+            return self.index.search(vectors, k)
+        return ann_index.filtered_search(self.index, vectors, k, allowed)
+    
+    def _search_locked(self, vectors: np.ndarray, k: int, filter: Optional[dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+        allowed = self.search_mask(filter)
+        if self.compression is None:
+            return self._index_search(vectors, k, allowed)
+        # The compressed index shortlists rescore × k candidates, which are then ranked by their
+        # exact distance, so scores are the same as with an uncompressed flat index.
+        _, candidates = self._index_search(ann_index.compress_vectors(self.compression, vectors), k * self.compression["rescore"], allowed)
+        return ann_index.rescore(vectors, candidates, self.vectors_at, k)
+    
+    def search_positions(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        k: int = 4,
+        filter: Optional[dict] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Only the indexed fields of filter (see metadata_index) are applied here.
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        with self.lock.read():
+            return self._search_locked(vectors, k, filter)
+    
+    def document(self, chunk_id: str) -> Optional[Document]:
+        # Search results carry their chunk_id, so callers such as the chat history can keep a
+        # (store, chunk_id) reference instead of the document.
+        doc = self.docstore.search(chunk_id)
+        if not isinstance(doc, Document):
+            return None
+        return Document(page_content=doc.page_content, metadata={**doc.metadata, "chunk_id": chunk_id})
+    
+    def documents_at(self, positions: Sequence[int]) -> List[Document]:
+        with self.lock.read():
+            chunk_ids = [self.index_to_docstore_id.get(int(i)) for i in positions if i >= 0]
+            documents = [self.document(chunk_id) for chunk_id in chunk_ids if chunk_id is not None]
+        return [doc for doc in documents if doc is not None]
+    
+    def _scored_documents(self, scores: np.ndarray, positions: np.ndarray) -> List[Tuple[Document, float, int]]:
+        found = []
+        for score, i in zip(scores, positions):
+            chunk_id = self.index_to_docstore_id.get(int(i)) if i >= 0 else None
+            doc = self.document(chunk_id) if chunk_id is not None else None
+            if doc is not None:
+                found.append((doc, float(score), int(i)))
+        return found
+    
+    def _filter_hits(
+        self,
+        hits: List[Tuple[Document, float, int]],
+        filter: Optional[dict],
+        score_threshold: Optional[float] = None
+    ) -> List[Tuple[Document, float, int]]:
+        # For filter fields the metadata index doesn't cover: same semantics as LangChain's FAISS,
+        # an exact-match metadata filter (a list means any of), then a score cutoff whose
+        # direction depends on the distance strategy.
+        if filter:
+            hits = [
+                hit for hit in hits
+                if all(
+                    hit[0].metadata.get(key) in value if isinstance(value, list) else hit[0].metadata.get(key) == value
+                    for key, value in filter.items()
+                )
+            ]
+        if score_threshold is not None:
+            higher_is_better = self.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD)
+            hits = [hit for hit in hits if (hit[1] >= score_threshold if higher_is_better else hit[1] <= score_threshold)]
+        return hits
+    
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        fetch_k: int = 20,
+        **kwargs
+    ) -> List[Tuple[Document, float]]:
+        # Reimplemented rather than wrapped: LangChain's version searches the raw index and
+        # post-filters, which returns deleted rows and needs a larger k for selective filters.
+        # Indexed filter fields restrict the search itself; only other fields are post-filtered.
+        _, rest = split_filter(filter)
+        vectors = np.asarray([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        with self.lock.read():
+            scores, positions = self._search_locked(vectors, max(k, fetch_k) if rest else k, filter)
+            hits = self._scored_documents(scores[0], positions[0])
+        hits = self._filter_hits(hits, rest, kwargs.get("score_threshold"))
+        return [(doc, score) for doc, score, _ in hits[:k]]
+    
+    def max_marginal_relevance_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        *,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        _, rest = split_filter(filter)
+        vectors = np.asarray([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        with self.lock.read():
+            scores, positions = self._search_locked(vectors, fetch_k * 2 if rest else fetch_k, filter)
+            hits = self._filter_hits(self._scored_documents(scores[0], positions[0]), rest)[:fetch_k]
+            if not hits:
+                return []
+            candidates = self.vectors_at([position for _, _, position in hits])
+        selected = maximal_marginal_relevance(vectors[0], candidates, k=min(k, len(hits)), lambda_mult=lambda_mult)
+        return [(hits[i][0], hits[i][1]) for i in selected]
+    
+    def batch_similarity_search_with_score_by_vectors(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        k: int = 4,
+        filter: Optional[dict] = None
+    ) -> List[List[tuple]]:
+        # One FAISS call for many queries, instead of one search per question.
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        
+        with self.lock.read():
+            scores, indices = self._search_locked(vectors, k, filter)
+            return [
+                [(doc, score) for doc, score, _ in self._scored_documents(query_scores, query_indices)]
+                for query_scores, query_indices in zip(scores, indices)
+            ]
+    
+    def memory_usage_bytes(self) -> int:
+        # Vectors live in the FAISS index; chunk text and full-precision vectors are memory-mapped
+        # and shared through the page cache, so only the id mapping is counted on top of the index.
+        return self.index.ntotal * ann_index.bytes_per_vector(self.compression, self.dimension) + len(self.index_to_docstore_id) * 128
+
+
+class LoadedStoreCache:
+    def __init__(self, memory_budget_bytes: int = 4 * 1024 ** 3):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._refs: Counter = Counter()
+        self._load_locks: Dict[str, threading.Lock] = {}
+    
+    def _lookup(self, key: str, version: int) -> Optional[FAISS]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["version"] != version:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry["store"]
+    
+    def get_or_load(self, key: str, version: int, loader: Callable[[], Optional[KnowledgeBaseStore]]) -> Optional[FAISS]:
+        with self._lock:
+            vector_store = self._lookup(key, version)
+            if vector_store is not None:
+                self.hits += 1
+                return vector_store
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        
+        # Only one thread loads a given store; the others wait here and then hit the cache.
+        with load_lock:
+            with self._lock:
+                vector_store = self._lookup(key, version)
+                if vector_store is not None:
+                    self.hits += 1
+                    return vector_store
+                self.misses += 1
+            
+            vector_store = loader()
+            if vector_store is not None:
+                self.put(key, vector_store)
+            return vector_store
+    
+    def put(self, key: str, vector_store: KnowledgeBaseStore):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                "store": vector_store,
+                "version": vector_store.content_version,
+                "size": vector_store.memory_usage_bytes()
+            }
+            self._evict()
+    
+    def peek(self, key: str) -> Optional[FAISS]:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry["store"] if entry else None
+    
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def acquire(self, key: str):
+        with self._lock:
+            self._refs[key] += 1
+    
+    def release(self, key: str):
+        with self._lock:
+            if self._refs[key] > 0:
+                self._refs[key] -= 1
+            if not self._refs[key]:
+                del self._refs[key]
+            self._evict()
+    
+    def _evict(self):
+        total = sum(entry["size"] for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.memory_budget_bytes:
+                break
+            if self._refs[key]:
+                continue
+            total -= self._entries.pop(key)["size"]
+            self.evictions += 1
+    
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "stores": len(self._entries),
+                "pinned": sum(1 for key in self._entries if self._refs[key]),
+                "memory_bytes": sum(entry["size"] for entry in self._entries.values()),
+                "memory_budget_bytes": self.memory_budget_bytes
+            }
+
+
+shared_store_cache = LoadedStoreCache()
+
+_index_rebuilds_in_progress = set()
+_index_rebuilds_pending = set()
+_index_rebuilds_lock = threading.Lock()
+
+# Every store loaded in this process, by cache key, whether or not it is still in a cache: a
+# compaction re-points all of them before it removes the segments they read from.
+_live_stores: Dict[str, "weakref.WeakSet[KnowledgeBaseStore]"] = {}
+_live_stores_lock = threading.Lock()
+
+
+def _register_live_store(key: str, vector_store: KnowledgeBaseStore):
+    with _live_stores_lock:
+        _live_stores.setdefault(key, weakref.WeakSet()).add(vector_store)
+
+
+def _live_stores_for(key: str) -> List[KnowledgeBaseStore]:
+    with _live_stores_lock:
+        return list(_live_stores.get(key, ()))
+
+_compactions_in_progress = set()
+_compactions_lock = threading.Lock()
+
+
+class StoreHandle:
+    # Pins a cached store while a session uses it. The pin is dropped by release() or, if the
+    # session simply goes away, when the handle is garbage collected.
+    def __init__(self, cache: LoadedStoreCache, key: str, vector_store: FAISS):
+        self.vector_store = vector_store
+        cache.acquire(key)
+        self._finalizer = weakref.finalize(self, cache.release, key)
+    
+    def release(self):
+        self._finalizer()
 
 
 class VectorStoreManager:
-    def __init__(self, embeddings_model: str = "text-embedding-3-large"):
-        self.embeddings = OpenAIEmbeddings(model=embeddings_model)
-        self.vector_stores_dir = Path("vector_stores")
-        self.vector_stores_dir.mkdir(exist_ok=True)
+    def __init__(
+        self,
+        embeddings_model: str = "text-embedding-3-large",
+        embedding_cache: Optional[EmbeddingCache] = None,
+        max_concurrent_embedding_requests: int = 4,
+        openai_api_base: Optional[str] = None,
+        compaction_threshold: int = 8,
+        store_cache: Optional[LoadedStoreCache] = None,
+        dedup_threshold: Optional[float] = 0.9,
+        embeddings: Optional[Embeddings] = None,
+        vector_stores_dir: Union[str, Path] = "vector_stores"
+    ):
+        self.embeddings_model = embeddings_model
+        batch_embeddings = embeddings
+        if embeddings is None:
+            embeddings_kwargs = {"openai_api_base": openai_api_base} if openai_api_base else {}
+            # Document batches are retried by the EmbeddingScheduler so retries can be coordinated
+            # across batches, so its client doesn't retry on its own. Questions are embedded by the
+            # stores with a second client that keeps the client's default retries.
+            from langchain.embeddings import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings(model=embeddings_model, **embeddings_kwargs)
+            batch_embeddings = OpenAIEmbeddings(model=embeddings_model, max_retries=0, **embeddings_kwargs)
+        self.embeddings = embeddings
+        self.embedding_scheduler = EmbeddingScheduler(batch_embeddings, max_concurrency=max_concurrent_embedding_requests)
+        self.vector_stores_dir = Path(vector_stores_dir)
+        self.vector_stores_dir.mkdir(parents=True, exist_ok=True)
+        self.embedding_cache = embedding_cache or EmbeddingCache(self.vector_stores_dir / "embedding_cache.sqlite")
+        self.compaction_threshold = compaction_threshold
+        self.store_cache = store_cache or shared_store_cache
+        self.dedup_threshold = dedup_threshold
+        self._ingest_state = threading.local()
+        # The app asks for these on every rerun; see list_available_stores and get_store_info.
+        self._store_names: Optional[Tuple[int, List[str]]] = None
+        self._store_infos: Dict[str, Tuple[tuple, dict]] = {}
+    
+    @property
+    def last_ingest_stats(self) -> Counter:
+        # Kept per thread, so ingestion jobs running side by side on one manager don't mix
+        # their totals.
+        if not hasattr(self._ingest_state, "stats"):
+            self._ingest_state.stats = Counter()
+        return self._ingest_state.stats
+    
+    @last_ingest_stats.setter
+    def last_ingest_stats(self, stats: Counter):
+        self._ingest_state.stats = stats
     
-    def create_vector_store(self, documents: List[Document], store_name: str) -> FAISS:
+    def embed_documents(self, documents: List[Document]) -> List[List[float]]:
+        texts = [doc.page_content for doc in documents]
+        vectors = self.embedding_cache.get_many(self.embeddings_model, texts)
+        
+        missing_texts = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing_texts:
+            with metrics.span("embed") as fields:
+                fields["texts"] = len(missing_texts)
+                new_vectors = self.embedding_scheduler.embed(
+                    missing_texts,
+                    on_batch=lambda batch_texts, batch_vectors: self.embedding_cache.put_many(
+                        self.embeddings_model, batch_texts, batch_vectors
+                    )
+                )
+            embedded = dict(zip(missing_texts, new_vectors))
+            vectors = [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors)]
+        
+        return vectors
+    
+    def _segment_store(self, store_name: str) -> SegmentStore:
+        return SegmentStore(self.vector_stores_dir / store_name)
+    
+    def _cache_key(self, store_name: str) -> str:
+        return str((self.vector_stores_dir / store_name).resolve())
+    
+    def _new_store(
+        self,
+        store_name: str,
+        dimension: int,
+        index: Optional[faiss.Index] = None,
+        compression: Optional[dict] = None
+    ) -> KnowledgeBaseStore:
+        vector_store = KnowledgeBaseStore(self.embeddings, index or ann_index.new_flat_index(dimension, compression), ChunkStore(), {})
+        vector_store.store_name = store_name
+        vector_store.compression = compression
+        return vector_store
+    
+    def _attach_segment(
+        self,
+        vector_store: FAISS,
+        segment: ChunkSegment,
+        vectors: np.ndarray,
+        indexed_rows: int = 0,
+        deleted_rows: Sequence[int] = ()
+    ):
+        # indexed_rows is the number of leading rows of this segment that are already in the index
+        # (when it was loaded from a persisted ANN index); only their ids still need mapping.
+        # Tombstoned rows still take their place in the index but get no id mapping.
+        if isinstance(vector_store, KnowledgeBaseStore):
+            start = vector_store.row_count
+        else:
+            start = len(vector_store.index_to_docstore_id)
+        if indexed_rows < len(vectors):
+            ann_index.add_vectors(vector_store.index, vectors[indexed_rows:], getattr(vector_store, "compression", None))
+        deleted = set(int(row) for row in deleted_rows)
+        for row, chunk_id in enumerate(segment.chunk_ids()):
+            if row not in deleted:
+                vector_store.index_to_docstore_id[start + row] = chunk_id
+        
+        if isinstance(vector_store.docstore, ChunkStore):
+            vector_store.docstore.attach_segment(segment, deleted)
+        else:
+            vector_store.docstore.add({chunk_id: doc for row, (chunk_id, doc) in enumerate(segment.iter_documents()) if row not in deleted})
+        if isinstance(vector_store, KnowledgeBaseStore):
+            vector_store.add_segment(start, segment, vectors)
+            if deleted:
+                vector_store.mark_deleted(start + row for row in deleted)
+    
+    def _remove_chunks(self, vector_store: FAISS, chunk_ids: Collection[str]):
+        # The in-memory counterpart of tombstoning: callers hold the write lock.
+        chunk_ids = set(chunk_ids)
+        positions = [position for position, chunk_id in vector_store.index_to_docstore_id.items() if chunk_id in chunk_ids]
+        if isinstance(vector_store, KnowledgeBaseStore):
+            vector_store.mark_deleted(positions)
+        removed = [vector_store.index_to_docstore_id.pop(position) for position in positions]
+        if removed:
+            vector_store.docstore.delete(removed)
+    
+    def _deduplicate(
+        self,
+        vector_store: Optional[FAISS],
+        ids: List[str],
+        documents: List[Document],
+        stats: Counter,
+        exclude: Collection[str] = ()
+    ) -> Dict[int, Tuple[str, float]]:
+        # Each chunk is checked against the chunks already in the store and the new ones kept so
+        # far from this batch. Near-duplicates are returned as row -> (id of the chunk they
+        # repeat, similarity): they are still stored, under their own file and metadata, but
+        # share that chunk's vector instead of being embedded. exclude holds chunk ids that are
+        # about to be deleted and so can't stand in for new chunks.
+        with metrics.span("dedup"):
+            known = vector_store.near_duplicate_index(self.dedup_threshold) if isinstance(vector_store, KnowledgeBaseStore) else None
+            batch_index = NearDuplicateIndex(self.dedup_threshold)
+            links = {}
+            for row, (chunk_id, signature) in enumerate(zip(ids, minhash_signatures([doc.page_content for doc in documents]))):
+                match = known.find(signature, self.dedup_threshold, exclude) if known is not None else None
+                match = match or batch_index.find(signature)
+                if match is None:
+                    batch_index.add(chunk_id, signature)
+                else:
+                    links[row] = match
+        
+        metrics.increment("chunks_deduplicated", len(links))
+        stats.update(checked=len(documents), duplicates=len(links))
+        return links
+    
+    def _vectors_for(self, documents: List[Document], stats: Counter, reuse_vectors: Optional[Dict[str, np.ndarray]] = None) -> np.ndarray:
+        # reuse_vectors maps chunk text to a vector that is already stored, so only text that
+        # actually changed goes to the embedding cache and API.
+        reuse_vectors = reuse_vectors or {}
+        missing = [doc for doc in documents if doc.page_content not in reuse_vectors]
+        embedded = iter(self.embed_documents(missing) if missing else ())
+        stats.update(reused=len(documents) - len(missing))
+        return np.asarray(
+            [reuse_vectors[doc.page_content] if doc.page_content in reuse_vectors else next(embedded) for doc in documents],
+            dtype=np.float32
+        )
+    
+    def _linked_vectors(
+        self,
+        vector_store: Optional[FAISS],
+        ids: List[str],
+        documents: List[Document],
+        links: Dict[int, Tuple[str, float]],
+        stats: Counter,
+        reuse_vectors: Optional[Dict[str, np.ndarray]] = None
+    ) -> np.ndarray:
+        # Only chunks that aren't near-duplicates are embedded; a linked row stores a copy of the
+        # vector of the chunk it duplicates, from this batch or from the store, so it can take
+        # that chunk's place in the index if the chunk is deleted.
+        embedded_rows = [row for row in range(len(documents)) if row not in links]
+        embedded = self._vectors_for([documents[row] for row in embedded_rows], stats, reuse_vectors) if embedded_rows else None
+        dimension = embedded.shape[1] if embedded is not None else vector_store.dimension
+        vectors = np.empty((len(documents), dimension), dtype=np.float32)
+        if embedded is not None:
+            vectors[embedded_rows] = embedded
+        batch_rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+        for row, (duplicate_of, _) in links.items():
+            if duplicate_of in batch_rows:
+                vectors[row] = vectors[batch_rows[duplicate_of]]
+            else:
+                vectors[row] = vector_store.vectors_at([vector_store.position_of(duplicate_of)])[0]
+        return vectors
+    
+    def _index_documents(
+        self,
+        vector_store: Optional[FAISS],
+        documents: List[Document],
+        store_name: str,
+        index_spec: Union[str, dict] = "auto",
+        delete_ids: Collection[str] = (),
+        reuse_vectors: Optional[Dict[str, np.ndarray]] = None,
+        file_hashes: Optional[Dict[str, str]] = None,
+        stats: Optional[Counter] = None
+    ) -> FAISS:
+        # Source files are recorded with their content hash, so uploading the same file again can
+        # be recognised without parsing it. Counts go to stats, or to last_ingest_stats if none
+        # is given.
+        if stats is None:
+            stats = self.last_ingest_stats
+        if file_hashes is None:
+            file_hashes = {source_name(doc.metadata): doc.metadata["file_hash"] for doc in documents if doc.metadata.get("file_hash")}
+        segment_store = self._segment_store(store_name)
+        if vector_store is None and segment_store.exists():
+            # load_vector_store also returns None for a knowledge base that failed to load;
+            # treating that as a new store would replace, and so delete, all of its segments.
+            raise ValueError(f"Knowledge base {store_name} already exists but is not loaded; refusing to replace it")
+        uploaded_at = date.today().isoformat()
+        for doc in documents:
+            doc.metadata.setdefault("uploaded_at", uploaded_at)
+        ids = [uuid.uuid4().hex for _ in documents]
+        links = {}
+        if self.dedup_threshold is not None and documents:
+            links = self._deduplicate(vector_store, ids, documents, stats, set(delete_ids))
+        if not documents and not delete_ids:
+            # Nothing to write, but a re-uploaded file whose chunks didn't change still gets its
+            # new hash, or every later upload of it would be diffed again.
+            if file_hashes and segment_store.exists():
+                segment_store.record_file_hashes(file_hashes)
+            return vector_store
+        vectors = self._linked_vectors(vector_store, ids, documents, links, stats, reuse_vectors) if documents else None
+        duplicates = [
+            {"row": row, "duplicate_of": duplicate_of, "similarity": round(similarity, 3)}
+            for row, (duplicate_of, similarity) in sorted(links.items())
+        ]
+        
+        # Only the new chunks are written; a new store starts with a fresh manifest.
+        # The segment is committed before the in-memory index changes, and the index then reads
+        # the chunks back from the segment so they aren't kept in memory twice.
+        is_new_store = vector_store is None
+        if is_new_store:
+            compression = ann_index.resolve_compression(index_spec, vectors.shape[1])
+            vector_store = self._new_store(store_name, vectors.shape[1], compression=compression)
+            _register_live_store(self._cache_key(store_name), vector_store)
+        
+        manifest_fields = {"embedding_model": self.embeddings_model}
+        if is_new_store:
+            manifest_fields["index_spec"] = index_spec
+        lock = vector_store.lock.write() if isinstance(vector_store, KnowledgeBaseStore) else nullcontext()
+        with lock:
+            with metrics.span("segment_write"):
+                if documents:
+                    manifest = segment_store.append(
+                        ids, documents, vectors, replace=is_new_store, duplicates=duplicates,
+                        delete_ids=delete_ids, file_hashes=file_hashes, **manifest_fields
+                    )
+                else:
+                    manifest = segment_store.delete_chunks(delete_ids, file_hashes=file_hashes)
+            with metrics.span("index_add"):
+                if documents:
+                    segment = segment_store.open_segment(manifest["segments"][-1]["name"])
+                    self._attach_segment(vector_store, segment, vectors)
+                if delete_ids:
+                    self._remove_chunks(vector_store, delete_ids)
+        metrics.increment("chunks_indexed", len(ids))
+        metrics.increment("chunks_deleted", len(delete_ids))
+        stats.update(indexed=len(ids), deleted=len(delete_ids))
+        
+        self._publish(vector_store, store_name, manifest, is_new_store)
+        if len(manifest["segments"]) >= self.compaction_threshold:
+            self.compact_vector_store(store_name, background=True)
+        return vector_store
+    
+    def _publish(self, vector_store: FAISS, store_name: str, manifest: dict, is_new_store: bool = False):
+        if is_new_store:
+            self._store_names = None
+        if isinstance(vector_store, KnowledgeBaseStore):
+            # Only publish this store to other sessions if it was up to date before the change;
+            # otherwise the cached copy is stale and the next load should come from disk.
+            was_current = is_new_store or vector_store.content_version == manifest["content_version"] - 1
+            vector_store.content_version = manifest["content_version"]
+            if was_current:
+                self.store_cache.put(self._cache_key(store_name), vector_store)
+            else:
+                self.store_cache.invalidate(self._cache_key(store_name))
+        else:
+            self.store_cache.invalidate(self._cache_key(store_name))
+    
+    def _replace_file(
+        self,
+        vector_store: KnowledgeBaseStore,
+        store_name: str,
+        filename: str,
+        documents: List[Document],
+        stats: Counter
+    ) -> FAISS:
+        # A changed file is diffed against its stored chunks: chunks with the same text and
+        # metadata stay where they are, the rest are tombstoned, and new chunks reuse the stored
+        # vector of any old chunk with identical text, so only changed text is embedded.
+        old_ids, old_documents, old_vectors = vector_store.file_chunks(filename)
+        
+        def chunk_key(doc: Document) -> Tuple[str, str]:
+            metadata = {key: value for key, value in doc.metadata.items() if key not in ("file_hash", "uploaded_at")}
+            return doc.page_content, json.dumps(metadata, sort_keys=True, default=str)
+        
+        unmatched: Dict[Tuple[str, str], List[int]] = {}
+        for i, doc in enumerate(old_documents):
+            unmatched.setdefault(chunk_key(doc), []).append(i)
+        added = []
+        for doc in documents:
+            matches = unmatched.get(chunk_key(doc))
+            if matches:
+                matches.pop()
+            else:
+                added.append(doc)
+        removed_ids = [old_ids[i] for rows in unmatched.values() for i in rows]
+        
+        file_hash = next((doc.metadata["file_hash"] for doc in documents if doc.metadata.get("file_hash")), None)
+        stats.update(replaced_files=1, unchanged_chunks=len(documents) - len(added))
+        return self._index_documents(
+            vector_store,
+            added,
+            store_name,
+            delete_ids=removed_ids,
+            reuse_vectors={doc.page_content: vector for doc, vector in zip(old_documents, old_vectors)},
+            file_hashes={filename: file_hash} if file_hash else {},
+            stats=stats
+        )
+    
+    def create_vector_store(
+        self,
+        documents: List[Document],
+        store_name: str,
+        index_spec: Union[str, dict] = "auto"
+    ) -> FAISS:
         if not documents:
             raise ValueError("Cannot create vector store with empty documents")
         
-        vector_store = FAISS.from_documents(documents, self.embeddings)
-        self.save_vector_store(vector_store, store_name)
+        stats = self.last_ingest_stats = Counter()
+        vector_store = self._index_documents(None, documents, store_name, index_spec, stats=stats)
+        self._maybe_rebuild_index(store_name)
         return vector_store
     
+    def ingest_document_batches(
+        self,
+        batches: Iterable[List[Document]],
+        store_name: str,
+        vector_store: Optional[FAISS] = None,
+        index_spec: Union[str, dict] = "auto",
+        on_batch: Optional[Callable[[dict], None]] = None,
+        stats: Optional[Counter] = None
+    ) -> FAISS:
+        # Embeds and indexes one batch at a time so only a single batch of chunks is held
+        # outside the index at any point, regardless of how many documents are being ingested.
+        # The running totals are counted into stats (a new Counter if none is given), which is
+        # also left in last_ingest_stats; on_batch receives a copy after every batch.
+        # Chunks of files the store already has are handled per file: an unchanged file (same
+        # content hash) is skipped, and a changed one is collected and then replaced in place.
+        if stats is None:
+            stats = Counter()
+        self.last_ingest_stats = stats
+        known_hashes = self.get_file_hashes(store_name) if vector_store is not None else {}
+        unchanged, replaced = set(), {}
+        for batch in batches:
+            new_chunks = []
+            for doc in batch:
+                name = source_name(doc.metadata)
+                if name not in known_hashes:
+                    new_chunks.append(doc)
+                elif doc.metadata.get("file_hash") == known_hashes[name]:
+                    unchanged.add(name)
+                else:
+                    replaced.setdefault(name, []).append(doc)
+            if new_chunks:
+                vector_store = self._index_documents(vector_store, new_chunks, store_name, index_spec, stats=stats)
+            if batch:
+                stats["batches"] += 1
+                if on_batch:
+                    on_batch(dict(stats))
+        
+        for name, documents in replaced.items():
+            if isinstance(vector_store, KnowledgeBaseStore):
+                vector_store = self._replace_file(vector_store, store_name, name, documents, stats)
+            else:
+                self.delete_file(store_name, name, vector_store)
+                vector_store = self._index_documents(vector_store, documents, store_name, index_spec, stats=stats)
+        stats["unchanged_files"] = len(unchanged)
+        if replaced and on_batch:
+            on_batch(dict(stats))
+        
+        if vector_store is None:
+            raise ValueError("Cannot create vector store with empty documents")
+        
+        self._maybe_rebuild_index(store_name)
+        return vector_store
+    
+    def get_file_hashes(self, store_name: str) -> Dict[str, str]:
+        # Source file name -> content hash of the version currently in the store.
+        segment_store = self._segment_store(store_name)
+        if not segment_store.exists():
+            return {}
+        return segment_store.read_manifest().get("file_hashes", {})
+    
+    def get_file_chunk_ids(self, store_name: str, filename: str) -> List[str]:
+        segment_store = self._segment_store(store_name)
+        if not segment_store.exists():
+            return []
+        return segment_store.file_chunk_ids(filename)
+    
+    def delete_file(self, store_name: str, filename: str, vector_store: Optional[FAISS] = None) -> int:
+        # Removes one source file's chunks in place: they are tombstoned on disk and dropped
+        # from the live store (the given one, or the shared cached copy), without re-embedding
+        # anything else. Returns the number of chunks removed.
+        segment_store = self._segment_store(store_name)
+        chunk_ids = self.get_file_chunk_ids(store_name, filename)
+        if not chunk_ids:
+            return 0
+        
+        vector_store = vector_store if vector_store is not None else self.store_cache.peek(self._cache_key(store_name))
+        lock = vector_store.lock.write() if isinstance(vector_store, KnowledgeBaseStore) else nullcontext()
+        with lock:
+            manifest = segment_store.delete_chunks(chunk_ids)
+            if vector_store is not None:
+                self._remove_chunks(vector_store, chunk_ids)
+        metrics.increment("chunks_deleted", len(chunk_ids))
+        
+        if vector_store is not None:
+            self._publish(vector_store, store_name, manifest)
+        else:
+            self.store_cache.invalidate(self._cache_key(store_name))
+        return len(chunk_ids)
+    
     def load_vector_store(self, store_name: str) -> Optional[FAISS]:
         store_path = self.vector_stores_dir / store_name
         if not store_path.exists():
             return None
         
+        return self.store_cache.get_or_load(
+            self._cache_key(store_name),
+            self.get_store_version(store_name),
+            lambda: self._load_from_disk(store_name)
+        )
+    
+    def acquire_vector_store(self, store_name: str) -> Optional[StoreHandle]:
+        vector_store = self.load_vector_store(store_name)
+        if vector_store is None:
+            return None
+        return StoreHandle(self.store_cache, self._cache_key(store_name), vector_store)
+    
+    def acquire_vector_stores(self, store_names: Sequence[str]) -> Dict[str, StoreHandle]:
+        # Loads several stores in parallel for a multi-store query; stores that fail to load are
+        # left out of the result.
+        if not store_names:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(len(store_names), 8)) as executor:
+            handles = dict(zip(store_names, executor.map(self.acquire_vector_store, store_names)))
+        return {store_name: handle for store_name, handle in handles.items() if handle is not None}
+    
+    def _load_from_disk(self, store_name: str) -> Optional[KnowledgeBaseStore]:
+        with metrics.span("store_load"):
+            return self._read_store(store_name)
+    
+    def _read_store(self, store_name: str) -> Optional[KnowledgeBaseStore]:
         try:
-            return FAISS.load_local(str(store_path), self.embeddings, allow_dangerous_deserialization=True)
+            segment_store = self._segment_store(store_name)
+            if not segment_store.exists():
+                return self._migrate_legacy_store(store_name)
+            
+            # A compaction that commits while the store is loading may remove segments it is
+            # about to open, and only re-points stores that were already loaded, so the load is
+            # repeated on the new layout.
+            for attempt in range(3):
+                manifest = segment_store.read_manifest()
+                try:
+                    vector_store = self._read_segments(store_name, segment_store, manifest)
+                except FileNotFoundError:
+                    if attempt == 2:
+                        raise
+                    continue
+                if vector_store is None:
+                    return None
+                _register_live_store(self._cache_key(store_name), vector_store)
+                current = segment_store.read_manifest()
+                if [entry["name"] for entry in current["segments"]] == [entry["name"] for entry in manifest["segments"]] or attempt == 2:
+                    return vector_store
         except Exception as e:
             print(f"Error loading vector store {store_name}: {e}")
             return None
     
-    def save_vector_store(self, vector_store: FAISS, store_name: str):
+    def _read_segments(self, store_name: str, segment_store: SegmentStore, manifest: dict) -> Optional[KnowledgeBaseStore]:
+        compression = ann_index.resolve_compression(manifest.get("index_spec"), manifest["dimension"])
+        base_index = segment_store.load_index(manifest)
+        if base_index is not None and ann_index.resolve_compression(manifest["index"], manifest["dimension"]) != compression:
+            # Built for earlier compression settings; the rebuild they started replaces it.
+            base_index = None
+        if base_index is not None:
+            ann_index.apply_search_params(base_index, manifest["index"])
+        indexed_rows = base_index.ntotal if base_index is not None else 0
+        
+        parts = list(segment_store.iter_segments(manifest))
+        vector_store = None
+        row = 0
+        for segment, vectors, deleted_rows in parts:
+            if vector_store is None:
+                vector_store = self._new_store(store_name, vectors.shape[1], base_index, compression)
+                if not vector_store.index.is_trained:
+                    # Until the background build has saved a compressed index, the int8 ranges are
+                    # learned from a sample of every segment rather than from the first one alone.
+                    sample = ann_index.training_sample([part[1] for part in parts])
+                    vector_store.index.train(ann_index.compress_vectors(compression, sample))
+            self._attach_segment(vector_store, segment, vectors, min(max(indexed_rows - row, 0), len(vectors)), deleted_rows)
+            row += len(vectors)
+        if vector_store is not None:
+            vector_store.content_version = manifest.get("content_version", 0)
+        return vector_store
+    
+    def _migrate_legacy_store(self, store_name: str) -> Optional[FAISS]:
         store_path = self.vector_stores_dir / store_name
-        store_path.mkdir(exist_ok=True)
-        vector_store.save_local(str(store_path))
+        if not (store_path / "index.faiss").exists():
+            return None
+        
+        # The legacy format is a pickled docstore; it is unpickled this one time and rewritten
+        # as a segment, after which the store is only ever memory-mapped.
+        legacy_store = FAISS.load_local(str(store_path), self.embeddings, allow_dangerous_deserialization=True)
+        self.save_vector_store(legacy_store, store_name)
+        for legacy_file in ("index.faiss", "index.pkl"):
+            (store_path / legacy_file).unlink(missing_ok=True)
+        return self._read_store(store_name)
+    
+    def save_vector_store(self, vector_store: FAISS, store_name: str):
+        # Full snapshot of an in-memory store as a single segment; incremental adds go
+        # through _index_documents and only write the new chunks. Deleted rows are left out.
+        positions = sorted(vector_store.index_to_docstore_id)
+        ids = [vector_store.index_to_docstore_id[i] for i in positions]
+        documents = [vector_store.docstore.search(chunk_id) for chunk_id in ids]
+        if isinstance(vector_store, KnowledgeBaseStore):
+            # Its index may hold compressed vectors; the segments have the originals.
+            vectors = vector_store.vectors_at(positions)
+        else:
+            vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)[positions]
+        self._segment_store(store_name).append(
+            ids, documents, vectors, replace=True, embedding_model=self.embeddings_model
+        )
+    
+    def compact_vector_store(self, store_name: str, background: bool = False) -> bool:
+        # One compaction per store at a time; a request while one is running is dropped, and the
+        # next add that finds the store over compaction_threshold asks again.
+        key = self._cache_key(store_name)
+        with _compactions_lock:
+            if key in _compactions_in_progress:
+                return False
+            _compactions_in_progress.add(key)
+        
+        if background:
+            threading.Thread(target=self._compact, args=(store_name,), name=f"compact-{store_name}", daemon=True).start()
+            return True
+        return self._compact(store_name)
+    
+    def _compact(self, store_name: str) -> bool:
+        # Compaction purges deleted rows, which may drop the ANN index built over the old positions.
+        # Loaded stores still read the segments that were merged, so they are re-pointed to the
+        # new layout first and the old segment directories removed only after that.
+        segment_store = self._segment_store(store_name)
+        try:
+            compacted = segment_store.compact()
+            if compacted:
+                if self._repoint_live_stores(store_name):
+                    segment_store.remove_unreferenced_segments()
+                self._maybe_rebuild_index(store_name)
+            return compacted
+        finally:
+            with _compactions_lock:
+                _compactions_in_progress.discard(self._cache_key(store_name))
+    
+    def _repoint_live_stores(self, store_name: str) -> bool:
+        # Each live store is loaded again from disk and takes over the fresh copy's contents in
+        # place, so sessions keep using the object they hold. The load happens outside the
+        # store's write lock; if the store changed meanwhile (an add or delete), it is redone
+        # under the lock. Returns False if any store could not be re-pointed.
+        segment_store = self._segment_store(store_name)
+        repointed = True
+        for vector_store in _live_stores_for(self._cache_key(store_name)):
+            fresh = self._read_store(store_name)
+            with vector_store.lock.write():
+                manifest = segment_store.read_manifest()
+                if fresh is None or not self._matches_manifest(fresh, manifest):
+                    fresh = self._read_store(store_name)
+                if fresh is None:
+                    repointed = False
+                    continue
+                vector_store.adopt(fresh)
+        return repointed
+    
+    @staticmethod
+    def _matches_manifest(vector_store: KnowledgeBaseStore, manifest: dict) -> bool:
+        return (
+            vector_store.content_version == manifest.get("content_version", 0)
+            and [segment.path.name for _, segment, _ in vector_store.segments] == [entry["name"] for entry in manifest["segments"]]
+        )
+    
+    def _maybe_rebuild_index(self, store_name: str):
+        manifest = self._segment_store(store_name).read_manifest()
+        chunk_count = manifest.get("row_count", manifest.get("chunk_count", 0))
+        if not chunk_count:
+            return
+        
+        params = ann_index.resolve_index_spec(manifest.get("index_spec", "auto"), chunk_count, manifest["dimension"])
+        compression = ann_index.resolve_compression(params, manifest["dimension"])
+        current = manifest.get("index")
+        if params["type"] == "flat" and compression is None:
+            needs_rebuild = current is not None
+        else:
+            # Rows added since the last build are appended to the index when it's loaded; once
+            # they're a sizeable fraction of the store, rebuild (and retrain) instead. A compressed
+            # flat index is persisted and retrained the same way, since its int8 ranges come
+            # from the vectors it was trained on.
+            needs_rebuild = (
+                current is None
+                or current["type"] != params["type"]
+                or ann_index.resolve_compression(current, manifest["dimension"]) != compression
+                or chunk_count - current["rows"] > current["rows"] * 0.25
+            )
+        
+        if needs_rebuild:
+            self.rebuild_index(store_name, background=True)
+    
+    def rebuild_index(self, store_name: str, index_spec: Optional[Union[str, dict]] = None, background: bool = False) -> Optional[dict]:
+        # A request while a rebuild of the same store is running makes that rebuild run once more
+        # when it finishes, since it may predate the latest rows or a compaction.
+        key = self._cache_key(store_name)
+        with _index_rebuilds_lock:
+            if key in _index_rebuilds_in_progress:
+                _index_rebuilds_pending.add(key)
+                return None
+            _index_rebuilds_in_progress.add(key)
+        
+        if background:
+            threading.Thread(
+                target=self._rebuild_index, args=(store_name, index_spec), name=f"index-{store_name}", daemon=True
+            ).start()
+            return None
+        return self._rebuild_index(store_name, index_spec)
+    
+    def _rebuild_index(self, store_name: str, index_spec: Optional[Union[str, dict]]) -> Optional[dict]:
+        key = self._cache_key(store_name)
+        while True:
+            params = self._build_index(store_name, index_spec)
+            with _index_rebuilds_lock:
+                if key not in _index_rebuilds_pending:
+                    _index_rebuilds_in_progress.discard(key)
+                    return params
+                _index_rebuilds_pending.discard(key)
+            index_spec = None
+    
+    def _build_index(self, store_name: str, index_spec: Optional[Union[str, dict]]) -> Optional[dict]:
+        segment_store = self._segment_store(store_name)
+        try:
+            if index_spec is not None:
+                segment_store.update_manifest(index_spec=index_spec)
+            manifest = segment_store.read_manifest()
+            vectors = segment_store.read_all_vectors(manifest)
+            if not len(vectors):
+                return None
+            params = ann_index.resolve_index_spec(manifest.get("index_spec", "auto"), len(vectors), vectors.shape[1])
+            compression = ann_index.resolve_compression(params, vectors.shape[1])
+            
+            if params["type"] == "flat" and compression is None:
+                segment_store.clear_index()
+                index = faiss.IndexFlatL2(vectors.shape[1])
+                index.add(np.ascontiguousarray(vectors))
+            else:
+                with metrics.span("ann_build", index_type=params["type"]):
+                    index = ann_index.build_index(params, vectors)
+                built_from = [entry["name"] for entry in manifest["segments"]]
+                if not segment_store.save_index(index, {**params, "rows": len(vectors)}, manifest.get("created_at"), built_from):
+                    return None
+            
+            cached = self.store_cache.peek(self._cache_key(store_name))
+            if isinstance(cached, KnowledgeBaseStore):
+                with cached.lock.write():
+                    # Catch the new index up with anything added to the live store while it was being built.
+                    current = segment_store.read_manifest()
+                    for extra in segment_store.iter_vectors(current, start_row=index.ntotal):
+                        ann_index.add_vectors(index, extra, compression)
+                    # A layout that differs here means a compaction committed after the index was
+                    # saved. The index is left alone: the compaction re-points the cached store,
+                    # which loads it from the manifest, or drops it and asks for a new one.
+                    same_layout = [segment.path.name for _, segment, _ in cached.segments] == [entry["name"] for entry in current["segments"]]
+                    if same_layout and index.ntotal == cached.index.ntotal:
+                        cached.index = index
+                        cached.compression = compression
+            return params
+        except Exception as e:
+            print(f"Error rebuilding index for {store_name}: {e}")
+            return None
+    
+    def set_index_search_params(self, store_name: str, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> dict:
+        segment_store = self._segment_store(store_name)
+        manifest = segment_store.read_manifest()
+        if not manifest.get("index"):
+            raise ValueError(f"Knowledge base {store_name} uses an exact flat index; there are no search parameters to tune")
+        
+        params = dict(manifest["index"])
+        if nprobe is not None:
+            params["nprobe"] = nprobe
+        if ef_search is not None:
+            params["ef_search"] = ef_search
+        segment_store.update_manifest(index=params)
+        
+        cached = self.store_cache.peek(self._cache_key(store_name))
+        if cached is not None:
+            with cached.lock.write():
+                ann_index.apply_search_params(cached.index, params)
+        return params
+    
+    def evaluate_index(self, store_name: str, k: int = 10, num_queries: int = 200) -> dict:
+        # Scores the persisted ANN index against an exact flat search over the same rows, for a
+        # sweep of nprobe / efSearch values, so each knowledge base can be tuned.
+        segment_store = self._segment_store(store_name)
+        manifest = segment_store.read_manifest()
+        index = segment_store.load_index(manifest)
+        if index is None:
+            raise ValueError(f"Knowledge base {store_name} has no ANN index; it is searched exactly")
+        
+        vectors = segment_store.read_all_vectors(manifest, rows=index.ntotal)
+        report = ann_index.evaluate_index(index, manifest["index"], vectors, k=k, num_queries=num_queries)
+        report["store"] = store_name
+        return report
+    
+    def evaluate_compression(
+        self,
+        store_name: str,
+        settings: Optional[List[dict]] = None,
+        k: int = 10,
+        num_queries: int = 200
+    ) -> dict:
+        # Memory saved vs. recall lost for compressed vector storage of this knowledge base, for
+        # settings such as {"dtype": "int8", "dimension": 1024} (default: ann_index.COMPRESSION_SWEEP).
+        # Apply one with rebuild_index(store_name, {"type": ..., "dtype": ..., "dimension": ...}).
+        segment_store = self._segment_store(store_name)
+        manifest = segment_store.read_manifest()
+        vectors = segment_store.read_all_vectors(manifest)
+        if not len(vectors):
+            raise ValueError(f"Knowledge base {store_name} has no vectors to evaluate")
+        report = ann_index.evaluate_compression(vectors, settings, k=k, num_queries=num_queries)
+        report["store"] = store_name
+        report["current"] = ann_index.resolve_compression(manifest.get("index_spec"), manifest["dimension"])
+        return report
     
     def add_documents_to_store(self, vector_store: FAISS, documents: List[Document], store_name: str) -> FAISS:
         if not documents:
             return vector_store
         
-        vector_store.add_documents(documents)
-        self.save_vector_store(vector_store, store_name)
+        vector_store = self._index_documents(vector_store, documents, store_name)
+        self._maybe_rebuild_index(store_name)
         return vector_store
     
     def list_available_stores(self) -> List[str]:
-        if not self.vector_stores_dir.exists():
+        # Rescanned only when the directory changes or this manager creates or deletes a store
+        # (a new store's directory can appear before its manifest does).
+        try:
+            mtime = self.vector_stores_dir.stat().st_mtime_ns
+        except OSError:
             return []
+        if self._store_names is not None and self._store_names[0] == mtime:
+            return list(self._store_names[1])
         
         stores = []
         for item in self.vector_stores_dir.iterdir():
-            if item.is_dir() and (item / "index.faiss").exists():
+            if item.is_dir() and ((item / MANIFEST_FILE).exists() or (item / "index.faiss").exists()):
                 stores.append(item.name)
         
+        self._store_names = (mtime, sorted(stores))
         return sorted(stores)
     
     def delete_vector_store(self, store_name: str) -> bool:
@@ -66,18 +1482,74 @@ class VectorStoreManager:
         try:
             import shutil
             shutil.rmtree(store_path)
+            self.store_cache.invalidate(self._cache_key(store_name))
+            self._store_names = None
+            self._store_infos.pop(store_name, None)
             return True
         except Exception as e:
             print(f"Error deleting vector store {store_name}: {e}")
             return False
     
     def get_store_info(self, store_name: str) -> dict:
-        vector_store = self.load_vector_store(store_name)
-        if not vector_store:
+        segment_store = self._segment_store(store_name)
+        if not segment_store.exists():
+            return {}
+        
+        # The manifest is only ever replaced, never rewritten in place, so the parsed info is
+        # reused until the file itself changes.
+        try:
+            stat = segment_store.manifest_path.stat()
+        except OSError:
+            return {}
+        signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        cached = self._store_infos.get(store_name)
+        if cached is not None and cached[0] == signature:
+            return dict(cached[1])
+        
+        try:
+            manifest = segment_store.read_manifest()
+        except (OSError, ValueError) as e:
+            print(f"Error reading manifest for {store_name}: {e}")
             return {}
         
-        return {
+        info = {
             "name": store_name,
-            "document_count": len(vector_store.docstore._dict),
-            "created": os.path.getctime(self.vector_stores_dir / store_name)
-        }
\ No newline at end of file
+            "document_count": manifest.get("chunk_count", sum(segment["count"] for segment in manifest.get("segments", []))),
+            "dimension": manifest.get("dimension"),
+            "embedding_model": manifest.get("embedding_model"),
+            "source_files": manifest.get("source_files", {}),
+            "file_hashes": manifest.get("file_hashes", {}),
+            "size_bytes": manifest.get("size_bytes", 0),
+            "duplicate_count": manifest.get("duplicate_count", 0),
+            "segment_count": len(manifest.get("segments", [])),
+            "index_spec": manifest.get("index_spec", "auto"),
+            "index": manifest.get("index") or {"type": "flat"},
+            "compression": ann_index.resolve_compression(manifest.get("index_spec"), manifest["dimension"]) if manifest.get("dimension") else None,
+            "version": manifest.get("version", 0),
+            "content_version": manifest.get("content_version", manifest.get("version", 0)),
+            "format_version": manifest.get("format_version"),
+            "created": manifest.get("created_at", os.path.getctime(segment_store.manifest_path)),
+            "updated": manifest.get("updated_at")
+        }
+        self._store_infos[store_name] = (signature, info)
+        return dict(info)
+    
+    def list_store_infos(self) -> List[dict]:
+        return [info for info in (self.get_store_info(name) for name in self.list_available_stores()) if info]
+    
+    def get_store_version(self, store_name: str) -> int:
+        return self.get_store_info(store_name).get("content_version", 0)
+
+
+_shared_manager: Optional[VectorStoreManager] = None
+_shared_manager_lock = threading.Lock()
+
+
+def shared_vector_store_manager(**kwargs) -> VectorStoreManager:
+    # One manager (embedding client, embedding cache connection, store listings) per process,
+    # shared by every session; kwargs only apply when it is created.
+    global _shared_manager
+    with _shared_manager_lock:
+        if _shared_manager is None:
+            _shared_manager = VectorStoreManager(**kwargs)
+        return _shared_manager